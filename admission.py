@@ -0,0 +1,190 @@
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from time import monotonic, time
+
+import metrics
+from broadcast import TokenBucket, PRIORITIES, INTERACTIVE
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# results of Admission.check
+ADMITTED = 'admitted'
+DUPLICATE = 'duplicate' # same command of the chat is running or was sent before its reply
+THROTTLED = 'throttled' # chat is over its rate
+SHED = 'shed' # bot is overloaded, or busy and update waited too long
+
+
+class Admission():
+
+    def __init__(self, rate=0.5, burst=5, sender=None, max_waiting=30, max_age=30, exempt=(), on_throttled=None, notice_interval=30, report_interval=60):
+        '''
+        Admission control in front of command handlers: token bucket per chat,
+        coalescing of identical commands of a chat and cheap load shedding;
+        rejected updates cost no DB, CMC or Telegram call
+
+        :param rate - commands per second of one chat
+        :param burst - commands one chat may send at once
+        :param sender - PrioritySender; new commands are shed while more than <max_waiting> replies wait for budget
+        :param max_waiting - number of waiting replies of overloaded bot
+        :param max_age - seconds after which a queued message is dropped while more than half of <max_waiting>
+                         replies wait (its user has given up); an idle bot answers backlog of a restart or outage
+        :param exempt - chat IDs never rejected (admins)
+        :param on_throttled - function of (chat ID, seconds till next token) telling the chat to slow down
+        :param notice_interval - min seconds between on_throttled calls for one chat
+        :param report_interval - seconds between log reports of rejected commands
+        '''
+        self.rate = rate
+        self.burst = burst
+        self.sender = sender
+        self.max_waiting = max_waiting
+        self.max_age = max_age
+        self.exempt = set(exempt)
+        self.on_throttled = on_throttled
+        self.notice_interval = notice_interval
+        self.report_interval = report_interval
+        self.buckets = {} # chat ID -> TokenBucket
+        self.running = set() # (chat ID, command) of admitted commands being handled
+        self.finished = {} # (chat ID, command) -> time() its handling finished
+        self.notified = {} # chat ID -> monotonic time of the last on_throttled call
+        self.results = Counter() # result -> number since last report
+        self.rejected = Counter() # chat ID -> rejected commands since last report
+        self.reported = monotonic()
+        self.lock = threading.Lock()
+
+
+    @staticmethod
+    def command(text):
+        '''
+        Normalized command, so "/top  100" and "/TOP 100" are the same
+
+        :param text - message text or callback data
+        :return - text
+        '''
+        return ' '.join(text.lower().split())
+
+
+    def check(self, chat_id, text, sent=None):
+        '''
+        Decides whether the command is handled; admitted one must be followed by done()
+
+        :param chat_id - telegram chat ID
+        :param text - message text or callback data
+        :param sent - unix time the message was sent (message.date); None for callbacks
+        :return - one of ADMITTED, DUPLICATE, THROTTLED, SHED
+        '''
+        key = (chat_id, self.command(text))
+        wait = 0
+        waiting = self.sender.waiting[PRIORITIES.index(INTERACTIVE)] if self.sender else 0
+        with self.lock:
+            if chat_id in self.exempt:
+                result = ADMITTED
+            elif waiting > self.max_waiting:
+                result = SHED
+            elif sent is not None and waiting > self.max_waiting // 2 and time() - sent > self.max_age:
+                # fresh commands go first while replies queue up
+                result = SHED
+            elif key in self.running or self.sent_before_reply(key, sent):
+                result = DUPLICATE
+            else:
+                bucket = self.buckets.get(chat_id)
+                if bucket is None:
+                    bucket = self.buckets[chat_id] = TokenBucket(self.rate, capacity=self.burst)
+                wait = bucket.take()
+                result = THROTTLED if wait else ADMITTED
+            if result == ADMITTED:
+                self.running.add(key)
+            else:
+                self.rejected[chat_id] += 1
+            self.results[result] += 1
+            notify = result == THROTTLED and monotonic() - self.notified.get(chat_id, 0) >= self.notice_interval
+            if notify:
+                self.notified[chat_id] = monotonic()
+        metrics.admission.inc(result=result)
+        if notify and self.on_throttled:
+            try:
+                self.on_throttled(chat_id, wait)
+            except Exception as e:
+                logger.exception(e)
+        if monotonic() - self.reported >= self.report_interval:
+            self.report()
+        return result
+
+
+    def sent_before_reply(self, key, sent):
+        '''
+        Checks whether the command repeats one which was answered after it was sent (called under lock)
+
+        :param key - (chat ID, command)
+        :param sent - unix time the message was sent; None for callbacks
+        :return - True/False
+        '''
+        finished = self.finished.get(key)
+        if finished is None:
+            return False
+        if sent is None:
+            # callbacks have no time; a double click comes within a second
+            return time() - finished < 1
+        # message.date has seconds precision
+        return sent < int(finished)
+
+
+    def done(self, chat_id, text):
+        '''
+        Marks admitted command as handled
+
+        :param chat_id - telegram chat ID
+        :param text - message text or callback data
+        :return:
+        '''
+        key = (chat_id, self.command(text))
+        with self.lock:
+            self.running.discard(key)
+            self.finished[key] = time()
+
+
+    @contextmanager
+    def admit(self, chat_id, text, sent=None):
+        '''
+        Runs enclosed handler only if the command is admitted
+
+        :param chat_id - telegram chat ID
+        :param text - message text or callback data
+        :param sent - unix time the message was sent (message.date); None for callbacks
+        :return - True if the handler must run
+        '''
+        result = self.check(chat_id, text, sent)
+        if result != ADMITTED:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            self.done(chat_id, text)
+
+
+    def report(self):
+        '''
+        Logs rejected commands since last report and forgets idle chats
+
+        :return:
+        '''
+        with self.lock:
+            now = monotonic()
+            if now - self.reported < self.report_interval:
+                return
+            seconds = now - self.reported
+            results, rejected = self.results, self.rejected
+            self.results, self.rejected = Counter(), Counter()
+            self.reported = now
+            # full buckets are the same as new ones
+            idle = (self.burst - 1) / self.rate
+            self.buckets = {chat_id: bucket for chat_id, bucket in self.buckets.items() if now - bucket.updated < idle}
+            self.finished = {key: finished for key, finished in self.finished.items() if time() - finished < self.max_age}
+            self.notified = {chat_id: notified for chat_id, notified in self.notified.items() if now - notified < self.notice_interval}
+        if results[ADMITTED] == sum(results.values()):
+            return
+        logger.warning('commands in last %.0fs: %s; top rejected chats: %s', seconds,
+                       ', '.join('{}={}'.format(k, v) for k, v in sorted(results.items())),
+                       ', '.join('{}:{}'.format(chat_id, n) for chat_id, n in rejected.most_common(10)))
@@ -0,0 +1,816 @@
+# asyncio runtime: one event loop handles updates, CoinMarketCap requests and broadcasts;
+# blocking DB/mmap work runs on one dedicated thread
+#
+# usage: python aio.py
+#
+# limited runtime: /currency, /price, /profile, inline queries and CreditPlanner budgeting of bot.Bot
+# aren't supported: these commands are answered with UNSUPPORTED_TEXT and all prices are in USD
+import asyncio
+import random
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import partial
+from time import monotonic, perf_counter, time
+
+import aiohttp
+from telebot import types
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_helper import ApiTelegramException
+
+import api
+import config
+import metrics
+import profiling
+import bot as texts
+from api import ListingsCache, RETRY_STATUSES, parse_listings
+from alerts import AlertEngine
+from admission import Admission
+from broadcast import TokenBucket
+from db_worker import DB
+from history import PriceHistory
+from logger import get_logger
+from scheduler import HourlyDelivery, hour_slot, run_id as slot_run_id
+
+logger = get_logger(__name__)
+
+UNSUPPORTED_TEXT = '⚠️this command is not supported by the asyncio runtime'
+
+
+class AsyncAPI():
+
+    def __init__(self, name, key, timeout=(3.05, 10), retries=2, backoff=0.5):
+        '''
+        CoinMarketCap API on aiohttp; same contract as api.API
+
+        :param name - API's name
+        :param key - API's key
+        :param timeout - (connect, read) timeouts in seconds
+        :param retries - attempts after the first one on network errors and 429/5xx
+        :param backoff - base delay between attempts in seconds
+        '''
+        self.name = name
+        self.key = key
+        self.timeout = aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+        self.retries = retries
+        self.backoff = backoff
+        self.headers = {
+            'Accept':'application/json',
+            'Accept-Encoding':'gzip, deflate',
+            'X-CMC_PRO_API_KEY': self.key
+        }
+        self.session = None # created inside the running loop
+
+
+    async def close(self):
+        '''
+        Closes keep-alive connections
+
+        :return:
+        '''
+        if self.session is not None:
+            await self.session.close()
+
+
+    async def get(self, path, parameters):
+        '''
+        GET request with timeouts and bounded retries (jittered exponential backoff)
+
+        :param path - endpoint path
+        :param parameters - query parameters
+        :return - (status code, body, timing dict)
+        '''
+        if self.session is None:
+            self.session = aiohttp.ClientSession(headers=self.headers, timeout=self.timeout, connector=aiohttp.TCPConnector(limit=4))
+        started = perf_counter()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                with metrics.cmc_latency.time(), profiling.span('cmc.request'):
+                    async with self.session.get(api.base_url + path, params=parameters) as response:
+                        status, content = response.status, await response.read()
+                metrics.cmc_requests.inc(status=status)
+                if status not in RETRY_STATUSES or attempt > self.retries:
+                    break
+                logger.warning('API request failed; status_code: %s; attempt: %s', status, attempt)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                metrics.cmc_requests.inc(status=type(e).__name__)
+                if attempt > self.retries:
+                    raise
+                logger.warning('API request failed; error: %s; attempt: %s', e, attempt)
+            await asyncio.sleep(self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+        return status, content, {'seconds': perf_counter() - started, 'attempts': attempt}
+
+
+    async def latest_listings(self, limit=100, converts=('USD',)):
+        '''
+        Latest listings
+
+        :param limit - number of requested coins
+        :param converts - currencies of prices; the first one is USD
+        :return - same as api.API.latest_listings
+        '''
+        logger.info('limit=%s; converts=%s', limit, converts)
+        try:
+            parameters = {
+                'start':'1',
+                'limit':limit,
+                'convert':','.join(converts),
+            }
+            status, content, timing = await self.get('/v1/cryptocurrency/listings/latest', parameters)
+            if status != 200:
+                logger.error('API request failed; status_code: %s; text: %s', status, content[:200])
+                return {'status':0, 'timing':timing}
+            response = parse_listings(content, converts)
+            response['timing'] = timing
+            return response
+        except Exception as e:
+            logger.exception(e)
+            return {'status':0}
+
+
+class AsyncDB():
+
+    def __init__(self, db):
+        '''
+        Runs DB methods on one dedicated thread, so the loop never waits for SQLite
+        and all calls share one connection
+
+        :param db - DB instance
+        '''
+        self.db = db
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db')
+
+
+    async def call(self, func, *args, **kwargs):
+        '''
+        Runs blocking function on DB thread
+
+        :param func - function
+        :param args - function arguments
+        :return - function result
+        '''
+        # DB thread has no trace; the span is queueing plus the call
+        with profiling.span('db.' + getattr(func, '__name__', 'call')):
+            return await asyncio.get_running_loop().run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+
+    def __getattr__(self, name):
+        # db.get_schedule(tg_id) -> awaitable
+        return partial(self.call, getattr(self.db, name))
+
+
+class AsyncListingsCache():
+
+    def __init__(self, api, run_blocking, ttl=60, limit=100, max_stale=3600):
+        '''
+        Shared snapshot of latest listings; same policy as api.ListingsCache
+        but concurrent misses wait for one asyncio task
+
+        :param api - AsyncAPI instance
+        :param run_blocking - coroutine function running listeners off the loop
+        :param ttl - seconds before snapshot is refetched
+        :param limit - number of coins in snapshot
+        :param max_stale - seconds the last good snapshot is served while API fails
+        '''
+        self.api = api
+        self.run_blocking = run_blocking
+        self.ttl = ttl
+        self.limit = limit
+        self.max_stale = max_stale
+        self.snapshot = None
+        self.fetched = 0
+        self.inflight = None # task of running fetch
+        self.notifying = None # task calling listeners
+        self.listeners = [] # blocking functions called with every new snapshot
+
+
+    def subscribe(self, listener):
+        '''
+        Registers function called with every new snapshot (on DB thread)
+
+        :param listener - function of API response
+        :return:
+        '''
+        self.listeners.append(listener)
+
+
+    async def top_text(self, limit=100, prefix='', currency='USD'):
+        '''
+        TOP coins message; rendered once per snapshot for every (limit, prefix, currency)
+
+        :param limit - number of coins
+        :param prefix - text before header
+        :param currency - convert currency; USD if snapshot has no such prices
+        :return - {'status':1, 'text':...} or {'status':0} on API error
+        '''
+        snapshot = await self.current()
+        if snapshot is None:
+            return {'status':0}
+        return {'status':1, 'text':ListingsCache.render(snapshot, limit, prefix, currency)}
+
+
+    async def current(self):
+        '''
+        Gets fresh snapshot; fetches it if needed or waits for running fetch
+
+        :return - API response or None if there is no usable snapshot
+        '''
+        age = monotonic() - self.fetched
+        if self.snapshot is not None and age < self.ttl:
+            return self.snapshot
+        if self.inflight is None:
+            self.inflight = asyncio.ensure_future(self.refresh())
+        elif self.snapshot is not None and age < self.max_stale:
+            # stale-while-revalidate; somebody is already fetching
+            return self.snapshot
+        # shielded: a cancelled caller must not cancel the fetch of the others
+        await asyncio.shield(self.inflight)
+        if self.snapshot is None or monotonic() - self.fetched >= self.max_stale:
+            return None
+        return self.snapshot
+
+
+    async def refresh(self):
+        '''
+        Fetches new snapshot and notifies listeners
+
+        :return:
+        '''
+        try:
+            response = await self.api.latest_listings(limit=self.limit)
+            if response['status'] == 1:
+                response['texts'] = {}
+                self.snapshot = response
+                self.fetched = monotonic()
+            else:
+                logger.warning('API request failed; serving stale snapshot; age: %s', monotonic() - self.fetched if self.snapshot else None)
+        finally:
+            self.inflight = None
+        if response['status'] == 1:
+            # waiting callers get the snapshot without waiting for listeners
+            self.notifying = asyncio.ensure_future(self.notify(response))
+
+
+    async def notify(self, response):
+        '''
+        Calls listeners with new snapshot one by one
+
+        :param response - API response
+        :return:
+        '''
+        for listener in self.listeners:
+            try:
+                await self.run_blocking(listener, response)
+            except Exception as e:
+                logger.exception(e)
+
+
+class AsyncBroadcaster():
+
+    def __init__(self, bot, workers=32, rate=30, chat_rate=1, retries=3):
+        '''
+        Sends messages to many chats with concurrent tasks within Telegram limits;
+        same contract as broadcast.Broadcaster
+
+        :param bot - AsyncTeleBot instance
+        :param workers - number of sending tasks
+        :param rate - global messages per second
+        :param chat_rate - messages per second to one chat
+        :param retries - attempts per message after the first one
+        '''
+        self.bot = bot
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.retries = retries
+        self.bucket = TokenBucket(rate)
+        self.chat_buckets = {}
+        self.loop = None # loop of the last send(); used by send_threadsafe()
+
+
+    async def acquire(self, bucket):
+        '''
+        Waits until token is taken without blocking the loop
+
+        :param bucket - TokenBucket
+        :return:
+        '''
+        wait = bucket.take()
+        while wait:
+            await asyncio.sleep(wait)
+            wait = bucket.take()
+
+
+    async def send(self, messages, on_result=None, **kwargs):
+        '''
+        Sends messages and waits until all of them are delivered or failed
+
+        :param messages - iterable or async iterable of (chat ID, text)
+        :param on_result - function of (chat ID, True/False, number of attempts)
+        :param kwargs - extra arguments of send_message (e.g. parse_mode)
+        :return - dict with run stats
+        '''
+        self.loop = asyncio.get_running_loop()
+        stats = {'sent': 0, 'failed': 0, 'retried': 0}
+        jobs = asyncio.Queue(maxsize=self.workers * 4)
+        workers = [asyncio.ensure_future(self.worker(jobs, stats, on_result, kwargs)) for _ in range(self.workers)]
+        started = monotonic()
+        try:
+            if hasattr(messages, '__aiter__'):
+                async for job in messages:
+                    await jobs.put(job)
+            else:
+                for job in messages:
+                    await jobs.put(job)
+        finally:
+            for _ in workers:
+                await jobs.put(None)
+            await asyncio.gather(*workers)
+            self.chat_buckets.clear()
+        stats['seconds'] = round(monotonic() - started, 3)
+        metrics.broadcast_latency.observe(stats['seconds'])
+        metrics.broadcast_messages.inc(stats['sent'], result='sent')
+        metrics.broadcast_messages.inc(stats['failed'], result='failed')
+        stats['rate'] = round(stats['sent'] / stats['seconds'], 2) if stats['seconds'] else 0
+        logger.info('broadcast finished; %s', stats)
+        return stats
+
+
+    def send_threadsafe(self, messages, **kwargs):
+        '''
+        Blocking send() for other threads (e.g. AlertEngine)
+
+        :param messages - iterable of (chat ID, text)
+        :param kwargs - extra arguments of send_message
+        :return - dict with run stats
+        '''
+        return asyncio.run_coroutine_threadsafe(self.send(messages, **kwargs), self.loop).result()
+
+
+    async def worker(self, jobs, stats, on_result, kwargs):
+        '''
+        Takes messages from queue and sends them until stop sign (None)
+
+        :param jobs - queue of (chat ID, text)
+        :param stats - shared stats of the run
+        :param on_result - function of (chat ID, True/False, number of attempts) or None
+        :param kwargs - extra arguments of send_message
+        :return:
+        '''
+        while True:
+            job = await jobs.get()
+            if job is None:
+                return
+            sent, attempts = await self.deliver(job[0], job[1], kwargs)
+            stats['sent' if sent else 'failed'] += 1
+            stats['retried'] += attempts - 1
+            if on_result is not None:
+                on_result(job[0], sent, attempts)
+
+
+    async def deliver(self, chat_id, text, kwargs):
+        '''
+        Sends one message; retries on flood control and temporary errors
+
+        :param chat_id - telegram chat ID
+        :param text - message text
+        :param kwargs - extra arguments of send_message
+        :return - (True/False, number of attempts)
+        '''
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, capacity=1)
+        attempt = 0
+        while True:
+            attempt += 1
+            await self.acquire(bucket)
+            await self.acquire(self.bucket)
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                return True, attempt
+            except ApiTelegramException as e:
+                if attempt > self.retries or (e.error_code != 429 and e.error_code < 500):
+                    logger.warning('tg_id=%s; error_code=%s; description=%s', chat_id, e.error_code, e.description)
+                    return False, attempt
+                if e.error_code == 429:
+                    retry_after = (e.result_json.get('parameters') or {}).get('retry_after', 1)
+                    logger.warning('flood control; retry_after=%s', retry_after)
+                    self.bucket.pause(retry_after)
+                else:
+                    await asyncio.sleep(2 ** attempt * random.uniform(0.5, 1))
+            except Exception:
+                if attempt > self.retries:
+                    logger.exception('tg_id=%s', chat_id)
+                    return False, attempt
+                await asyncio.sleep(2 ** attempt * random.uniform(0.5, 1))
+
+
+class MeteredAsyncTeleBot(AsyncTeleBot):
+    '''
+    AsyncTeleBot which records latency and errors of outgoing calls
+    '''
+
+    async def send_message(self, *args, **kwargs):
+        with metrics.telegram_call('sendMessage'), profiling.span('telegram.sendMessage'):
+            return await super().send_message(*args, **kwargs)
+
+
+    async def edit_message_text(self, *args, **kwargs):
+        with metrics.telegram_call('editMessageText'), profiling.span('telegram.editMessageText'):
+            return await super().edit_message_text(*args, **kwargs)
+
+
+    async def answer_callback_query(self, *args, **kwargs):
+        with metrics.telegram_call('answerCallbackQuery'), profiling.span('telegram.answerCallbackQuery'):
+            return await super().answer_callback_query(*args, **kwargs)
+
+
+class BlockingBroadcaster():
+
+    def __init__(self, broadcaster):
+        '''
+        Broadcaster facade for code running in threads (AlertEngine)
+
+        :param broadcaster - AsyncBroadcaster instance
+        '''
+        self.broadcaster = broadcaster
+
+
+    def send(self, messages, **kwargs):
+        '''
+        Sends messages on the loop and waits for the result
+
+        :param messages - iterable of (chat ID, text)
+        :param kwargs - extra arguments of send_message
+        :return - dict with run stats
+        '''
+        return self.broadcaster.send_threadsafe(messages, **kwargs)
+
+
+class AsyncBot():
+
+    def __init__(self, token, listings_ttl=60, admin_ids=(), max_catch_up=3):
+        '''
+        Telegram bot for monitoring cryptocurrency prices on asyncio; commands of bot.Bot except
+        /currency, /price and /profile
+
+        :param token - bot's API key
+        :param listings_ttl - seconds the listings snapshot is shared between users
+        :param admin_ids - telegram IDs allowed to use admin commands
+        :param max_catch_up - max number of missed hours delivered after restart
+        '''
+        self.admin_ids = set(admin_ids)
+        self.bot = MeteredAsyncTeleBot(token=token)
+        # throttled chats aren't told to slow down here; rejected commands are dropped silently
+        self.admission = Admission(getattr(config, 'chat_rate', 0.5), getattr(config, 'chat_burst', 5), exempt=self.admin_ids)
+        self.db = AsyncDB(DB('data.db'))
+        self.api = AsyncAPI(name='CoinMarketCap', key=config.cmc_key)
+        self.listings = AsyncListingsCache(self.api, self.db.call, ttl=listings_ttl)
+        self.history = PriceHistory('history.bin')
+        self.listings.subscribe(lambda response: self.history.append(time(), response['quotes']))
+        self.broadcaster = AsyncBroadcaster(self.bot, rate=30)
+        self.outbox_batch = 500
+        self.alerts = AlertEngine(self.db.db, BlockingBroadcaster(self.broadcaster))
+        self.listings.subscribe(self.alerts.check)
+        # HourlyDelivery is only used for its bookkeeping; the timer is run_schedule()
+        self.delivery = HourlyDelivery(None, self.db.db, None, max_catch_up)
+        self.slots = set() # running deliveries; the loop keeps only weak references to tasks
+        self.bot.message_handler(commands=['start', 'top', 'settings', 'schedule', 'n', 'stats', 'alert', 'alerts', 'unalert',
+                                           'currency', 'price', 'profile'])(self.on_message)
+        self.bot.callback_query_handler(lambda call: True)(self.on_callback)
+        logger.info('Bot started')
+
+
+    async def run(self):
+        '''
+        Receives updates by long polling and delivers schedule until cancelled
+
+        :return:
+        '''
+        try:
+            await self.bot.delete_webhook()
+            self.broadcaster.loop = asyncio.get_running_loop()
+            # replies don't wait for command registration (it logs its own errors)
+            await asyncio.gather(self.set_default_commands(), self.bot.infinity_polling(), self.run_schedule())
+        finally:
+            await self.api.close()
+            await self.bot.close_session()
+            self.history.close()
+
+
+    async def set_default_commands(self):
+        '''
+        Sets default commands for every private chat; Telegram is called only
+        when commands differ from the ones registered before (hash in Meta)
+
+        :return:
+        '''
+        logger.info('setting default commands')
+        try:
+            commands = texts.default_commands()
+            digest = texts.commands_hash(self.bot.token, commands)
+            if await self.db.get_meta('commands_hash') == digest:
+                logger.info('default commands are up to date')
+                return
+            scope = types.BotCommandScopeAllPrivateChats()
+            await self.bot.set_my_commands(commands=commands, scope=scope, language_code='en')
+            await self.bot.get_my_commands(scope=scope, language_code='en')
+            await self.db.set_meta('commands_hash', digest)
+        except Exception as e:
+            # not saved; registration is retried on next start
+            logger.exception(e)
+
+
+    async def on_message(self, message):
+        '''
+        Dispatches command message
+
+        :param message - telegram message
+        :return:
+        '''
+        try:
+            # keyed by user, who gets the reply (in groups too)
+            with self.admission.admit(message.from_user.id, message.text, message.date) as admitted, profiling.trace(texts.command_name(message.text), message.from_user.id):
+                if not admitted:
+                    return
+                if message.text == '/start':
+                    await self.start(message)
+                elif message.text.startswith('/top'):
+                    await self.top(message)
+                elif message.text == '/settings':
+                    await self.send(message, '<b>Settings</b>', reply_markup=texts.settings_markup())
+                elif message.text.startswith('/schedule'):
+                    await self.edit_schedule(message)
+                elif message.text.startswith('/n'):
+                    await self.change_top_coins_number(message)
+                elif message.text == '/stats':
+                    await self.stats(message)
+                elif message.text.startswith('/alerts'):
+                    await self.send(message, texts.alerts_text(await self.db.get_alerts(message.from_user.id)))
+                elif message.text.startswith('/alert'):
+                    await self.add_alert(message)
+                elif message.text.startswith('/unalert'):
+                    await self.remove_alert(message)
+                elif texts.command_name(message.text) in ('/currency', '/price', '/profile'):
+                    await self.send(message, UNSUPPORTED_TEXT)
+                else:
+                    logger.warning('No command handler; message=%s', message)
+        except Exception:
+            logger.exception('message=%s', message)
+
+
+    async def on_callback(self, call):
+        '''
+        Dispatches callback of settings menu
+
+        :param call - user's callback
+        :return:
+        '''
+        logger.info('tg_id=%s', call.from_user.id)
+        tg_id = call.from_user.id
+        try:
+            with self.admission.admit(tg_id, 'callback ' + call.data) as admitted, profiling.trace('callback ' + call.data, tg_id):
+                if not admitted:
+                    return
+                if call.data == 'markup_notify':
+                    text = texts.schedule_text(await self.db.get_schedule(tg_id))
+                    markup = texts.schedule_markup()
+                elif call.data == 'settings_coins':
+                    text = texts.coins_settings_text(await self.db.get_top_coins_number(tg_id))
+                    markup = None
+                elif call.data == 'edit_schedule':
+                    text, markup = texts.EDIT_SCHEDULE_TEXT, None
+                else:
+                    return
+                await self.bot.edit_message_text(chat_id=tg_id, message_id=call.message.id, text=text, parse_mode='HTML', reply_markup=markup)
+        except Exception:
+            logger.exception('call=%s', call)
+            try:
+                await self.bot.answer_callback_query(callback_query_id=call.id, show_alert=True, text='⚠️error; Please, contact developer')
+            except Exception as e:
+                logger.exception(e)
+
+
+    async def send(self, message, text, **kwargs):
+        '''
+        Replies to user with HTML text
+
+        :param message - telegram message
+        :param text - text
+        :return:
+        '''
+        await self.bot.send_message(chat_id=message.from_user.id, text=text, parse_mode='HTML', **kwargs)
+
+
+    async def start(self, message):
+        '''
+        Adds user to DB and greets
+
+        :param message - telegram message
+        :return:
+        '''
+        logger.info('tg_id=%s', message.from_user.id)
+        await self.db.add_user(message.from_user.id)
+        await self.bot.send_message(chat_id=message.from_user.id, text='Hello, ' + message.from_user.first_name + ' 😊')
+
+
+    async def top(self, message):
+        '''
+        Sends TOP of coins to the user
+
+        :param message - telegram message
+        :return:
+        '''
+        logger.info('tg_id=%s', message.from_user.id)
+        correct, coins_n = texts.parse_top(message.text)
+        if not correct:
+            await self.send(message, texts.TOP_USAGE_TEXT)
+            return
+        if coins_n is None:
+            coins_n = await self.db.get_top_coins_number(message.from_user.id)
+        response = await self.listings.top_text(limit=coins_n)
+        await self.send(message, response['text'] if response['status'] else texts.ERROR_TEXT)
+
+
+    async def stats(self, message):
+        '''
+        Sends latency and error stats to admin
+
+        :param message - telegram message
+        :return:
+        '''
+        logger.info('tg_id=%s', message.from_user.id)
+        if message.from_user.id not in self.admin_ids:
+            logger.warning('not admin; tg_id=%s', message.from_user.id)
+            return
+        await self.send(message, texts.stats_text())
+
+
+    async def add_alert(self, message):
+        '''
+        Adds price alert, e.g. /alert BTC > 70000
+
+        :param message - telegram message
+        :return:
+        '''
+        logger.info('tg_id=%s', message.from_user.id)
+        text = texts.ALERT_USAGE_TEXT
+        alert = texts.parse_alert(message.text)
+        if alert:
+            text = texts.alert_symbol_error(alert[0], await self.listings.current())
+        if alert and text is None:
+            alert_id = await self.db.call(self.alerts.add, message.from_user.id, *alert)
+            if alert_id is None:
+                text = '❌failure; max {} alerts'.format(self.alerts.max_per_user)
+            else:
+                text = '✅success; alert #{}'.format(alert_id)
+        await self.send(message, text)
+
+
+    async def remove_alert(self, message):
+        '''
+        Removes price alert, e.g. /unalert 5
+
+        :param message - telegram message
+        :return:
+        '''
+        logger.info('tg_id=%s', message.from_user.id)
+        alert_id = texts.parse_alert_id(message.text)
+        success = alert_id is not None and await self.db.call(self.alerts.remove, message.from_user.id, alert_id)
+        await self.send(message, '✅success' if success else '❌failure')
+
+
+    async def change_top_coins_number(self, message):
+        '''
+        Changes number of top coins in user's settings
+
+        :param message - telegram message
+        :return:
+        '''
+        logger.info('tg_id=%s', message.from_user.id)
+        n = texts.parse_coins_number(message.text)
+        success = n is not None and await self.db.save_settings(tg_id=message.from_user.id, field='coins_number', val=n)
+        await self.send(message, '✅success' if success else '❌failure')
+
+
+    async def edit_schedule(self, message):
+        '''
+        Edits notification schedule
+
+        :param message - telegram message
+        :return:
+        '''
+        logger.info('tg_id=%s', message.from_user.id)
+        args = texts.parse_hours(message.text)
+        success = args and await self.db.edit_schedule(message.from_user.id, args)
+        await self.send(message, '✅success' if success else texts.SCHEDULE_ERROR_TEXT)
+
+
+    async def top_all(self, hour=None, run_id=None):
+        '''
+        Sends TOP coins to users who scheduled the hour through Outbox; same as bot.Bot.top_all
+
+        :param hour - scheduled hour; current hour by default
+        :param run_id - run ID; today's slot of the hour by default
+        :return - broadcast stats
+        '''
+        logger.info('hour=%s; run_id=%s', hour, run_id)
+        try:
+            slot = hour_slot(time())
+            if hour is not None:
+                slot = slot.replace(hour=int(hour))
+            run_id = run_id or slot_run_id(slot)
+            enqueued = await self.db.create_run(run_id, slot.hour)
+            logger.info('run_id=%s; enqueued=%s', run_id, enqueued)
+            results = []
+            stats = await self.broadcaster.send(self.outbox_messages(run_id, results), on_result=lambda *result: results.append(result), parse_mode='HTML')
+            await self.save_results(run_id, results)
+            logger.info('run_id=%s; jobs by status: %s', run_id, await self.db.finish_run(run_id))
+            return stats
+        except Exception as e:
+            logger.exception(e)
+
+
+    async def outbox_messages(self, run_id, results):
+        '''
+        Yields messages of pending Outbox jobs batch by batch; text is rendered once per (coins number, currency)
+
+        :param run_id - run ID
+        :param results - list of (telegram ID, True/False, number of attempts) to save
+        :return - async generator of (telegram ID, text)
+        '''
+        messages = {}
+        while True:
+            await self.save_results(run_id, results)
+            jobs = await self.db.claim_outbox(run_id, self.outbox_batch)
+            if not jobs:
+                return
+            for tg_id, coins_number, currency in jobs:
+                text = messages.get((coins_number, currency))
+                if text is None:
+                    response = await self.listings.top_text(limit=coins_number, prefix='*\n', currency=currency)
+                    text = messages[coins_number, currency] = response['text'] if response['status'] else texts.ERROR_TEXT
+                yield tg_id, text
+
+
+    async def save_results(self, run_id, results):
+        '''
+        Saves delivery results collected so far
+
+        :param run_id - run ID
+        :param results - list of (telegram ID, True/False, number of attempts)
+        :return:
+        '''
+        batch = results[:]
+        del results[:]
+        await self.db.finish_outbox(run_id, batch)
+
+
+    async def run_slot(self, slot):
+        '''
+        Delivers slot and remembers it as done
+
+        :param slot - datetime of round hour
+        :return:
+        '''
+        try:
+            await self.top_all(slot.hour, slot_run_id(slot))
+        finally:
+            await self.db.call(self.delivery.mark, slot)
+
+
+    async def run_schedule(self):
+        '''
+        Catches up missed hours, then delivers every round hour
+
+        :return:
+        '''
+        for slot in await self.db.call(self.delivery.missed_slots):
+            logger.info('catch up slot: %s', slot)
+            await self.run_slot(slot)
+        nxt = hour_slot(time()) + timedelta(hours=1)
+        while True:
+            delay = datetime.timestamp(nxt) - time()
+            if delay > 0:
+                # woken up early (clock change); wait again
+                await asyncio.sleep(delay)
+                continue
+            # started as task so a long broadcast can't shift the timer
+            task = asyncio.ensure_future(self.run_slot(nxt))
+            self.slots.add(task)
+            task.add_done_callback(self.slots.discard)
+            nxt += timedelta(hours=1)
+
+
+def main():
+    if getattr(config, 'metrics_port', None):
+        metrics.start_http_server(config.metrics_port)
+    bot = AsyncBot(config.token, admin_ids=getattr(config, 'admin_ids', ()))
+    try:
+        asyncio.run(bot.run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+import threading
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict
+
+from api import escape_html, format_price
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+OPS = ('>', '<')
+
+
+class AlertIndex():
+
+    def __init__(self):
+        '''
+        Price alerts kept in sorted lists per coin:
+        above[symbol] - thresholds of '>' alerts, below[symbol] - thresholds of '<' alerts,
+        so alerts triggered by a price are a prefix/suffix found by binary search
+        '''
+        self.above = defaultdict(list) # symbol -> sorted [(threshold, alert ID)]
+        self.below = defaultdict(list)
+        self.alerts = {} # alert ID -> (telegram ID, symbol, op, threshold)
+        self.lock = threading.Lock()
+
+
+    def add(self, alert_id, tg_id, symbol, op, threshold):
+        '''
+        Adds alert to index
+
+        :param alert_id - alert ID
+        :param tg_id - telegram ID
+        :param symbol - coin symbol
+        :param op - '>' or '<'
+        :param threshold - price
+        :return:
+        '''
+        with self.lock:
+            self.alerts[alert_id] = (tg_id, symbol, op, threshold)
+            insort((self.above if op == '>' else self.below)[symbol], (threshold, alert_id))
+
+
+    def remove(self, alert_id):
+        '''
+        Removes alert from index
+
+        :param alert_id - alert ID
+        :return:
+        '''
+        with self.lock:
+            alert = self.alerts.pop(alert_id, None)
+            if alert is None:
+                return
+            _, symbol, op, threshold = alert
+            entries = (self.above if op == '>' else self.below)[symbol]
+            i = bisect_left(entries, (threshold, alert_id))
+            if i < len(entries) and entries[i] == (threshold, alert_id):
+                del entries[i]
+
+
+    def trigger(self, symbol, price):
+        '''
+        Pops alerts triggered by the price: O(log n + k)
+
+        :param symbol - coin symbol
+        :param price - current price
+        :return - list of (alert ID, telegram ID, symbol, op, threshold)
+        '''
+        with self.lock:
+            triggered = []
+            above = self.above.get(symbol)
+            if above:
+                # thresholds lower than price
+                i = bisect_left(above, (price,))
+                triggered.extend(above[:i])
+                del above[:i]
+            below = self.below.get(symbol)
+            if below:
+                # thresholds higher than price
+                i = bisect_right(below, (price, float('inf')))
+                triggered.extend(below[i:])
+                del below[i:]
+            return [(alert_id,) + self.alerts.pop(alert_id) for _, alert_id in triggered]
+
+
+class AlertEngine():
+
+    def __init__(self, db, broadcaster, max_per_user=20):
+        '''
+        Checks price alerts against every listings snapshot and notifies users
+
+        :param db - DB instance
+        :param broadcaster - Broadcaster instance used to send notifications
+        :param max_per_user - max number of active alerts of one user
+        '''
+        self.db = db
+        self.broadcaster = broadcaster
+        self.max_per_user = max_per_user
+        self.index = AlertIndex()
+        # alerts are loaded in background, so a restart isn't delayed by a big Alerts table
+        self.loaded = threading.Event()
+        threading.Thread(target=self.load, daemon=True).start()
+
+
+    def load(self):
+        '''
+        Builds index of all alerts in DB
+
+        :return:
+        '''
+        try:
+            for alert in self.db.get_alerts():
+                self.index.add(*alert)
+            logger.info('alerts loaded: %s', len(self.index.alerts))
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            self.loaded.set()
+
+
+    def add(self, tg_id, symbol, op, threshold):
+        '''
+        Adds alert
+
+        :param tg_id - telegram ID
+        :param symbol - coin symbol
+        :param op - '>' or '<'
+        :param threshold - price
+        :return - alert ID or None if limit is reached
+        '''
+        self.loaded.wait()
+        if len(self.db.get_alerts(tg_id)) >= self.max_per_user:
+            return None
+        alert_id = self.db.add_alert(tg_id, symbol, op, threshold)
+        if alert_id is not None:
+            self.index.add(alert_id, tg_id, symbol, op, threshold)
+        return alert_id
+
+
+    def remove(self, tg_id, alert_id):
+        '''
+        Removes alert of the user
+
+        :param tg_id - telegram ID
+        :param alert_id - alert ID
+        :return - True/False
+        '''
+        self.loaded.wait()
+        if self.db.delete_alerts([alert_id], tg_id):
+            self.index.remove(alert_id)
+            return True
+        return False
+
+
+    def check(self, response):
+        '''
+        Listener of new listings snapshots; sends triggered alerts in background
+
+        :param response - API response with quotes
+        :return:
+        '''
+        self.loaded.wait()
+        triggered = []
+        for symbol, price in response['quotes']:
+            for alert in self.index.trigger(symbol, price):
+                triggered.append(alert + (price,))
+        if not triggered:
+            return
+        logger.info('triggered alerts: %s', len(triggered))
+        # alerts are one-shot
+        self.db.delete_alerts([alert[0] for alert in triggered])
+        # one message per user
+        texts = defaultdict(lambda: '🔔 <b>Price alerts</b>')
+        for _, tg_id, symbol, op, threshold, price in triggered:
+            texts[tg_id] += '\n<code>{} {} {:g}</code> now {}'.format(escape_html(symbol), escape_html(op), threshold, format_price(price))
+        threading.Thread(target=self.broadcaster.send, args=(list(texts.items()),), kwargs={'parse_mode': 'HTML'}, daemon=True).start()
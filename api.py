@@ -1,54 +1,527 @@
-import requests
 import json
+import math
+import random
+import threading
+from datetime import datetime, timedelta, timezone
+from time import monotonic, perf_counter, sleep
+
+import requests
+from requests.adapters import HTTPAdapter
 
-from logger import logger
+import metrics
+import profiling
+from logger import get_logger
 from config import base_url
 
+try:
+    # optional fast JSON parser
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+logger = get_logger(__name__)
+
+TOP_HEADER = "<b>Coin</b> - <b>Price</b>"
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# convert currencies users may choose; USD is always fetched (price history and alerts)
+CURRENCIES = ('USD', 'EUR', 'GBP', 'UAH', 'JPY', 'BTC', 'ETH')
+CURRENCY_SIGNS = {'USD': '$', 'EUR': '€', 'GBP': '£', 'JPY': '¥'}
+
+
+def coin_text(symbol, price, currency='USD'):
+    '''
+    One line of TOP message
+
+    :param symbol - coin symbol
+    :param price - price
+    :param currency - convert currency
+    :return - text with HTML markup
+    '''
+    sign = CURRENCY_SIGNS.get(currency)
+    if sign:
+        return '\n<code>{} - {}{:.2f}</code>'.format(symbol, sign, price)
+    return '\n<code>{} - {:.8g} {}</code>'.format(symbol, price, currency)
+
+
+def format_price(price):
+    '''
+    USD price with precision for small caps (e.g. 0.00001234)
+
+    :param price - price
+    :return - text
+    '''
+    if price >= 1:
+        return '{}{:.2f}'.format(CURRENCY_SIGNS['USD'], price)
+    return CURRENCY_SIGNS['USD'] + '{:.10f}'.format(price).rstrip('0').rstrip('.')
+
+
+def escape_html(text):
+    '''
+    Escapes text for HTML markup
+
+    :param text - text
+    :return - escaped text
+    '''
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def parse_listings(content, converts=('USD',), texts=True):
+    '''
+    Parses body of listings response; shared by API and aio.AsyncAPI
+
+    :param content - response body (bytes)
+    :param converts - requested currencies; the first one is USD
+    :param texts - False - lines of TOP message aren't built (coins and currencies are empty)
+    :return - {'status':1, 'coins':[USD lines], 'currencies':{currency: [lines]}, 'quotes':[(symbol, USD price)],
+               'rows':[(ID, symbol, name, USD price, percent change 24h)], 'credits':...}
+    '''
+    # parsed straight from bytes, without decoding body to str first
+    body = json_loads(content)
+    currencies = {currency: [] for currency in converts} if texts else {}
+    quotes = []
+    rows = []
+    for row in body['data']:
+        for currency in currencies:
+            currencies[currency].append(coin_text(row['symbol'], row['quote'][currency]['price'], currency))
+        quote = row['quote'][converts[0]]
+        quotes.append((row['symbol'], quote['price']))
+        rows.append((row['id'], row['symbol'], row['name'], quote['price'], quote.get('percent_change_24h')))
+    return {
+        'status':1,
+        'coins':currencies.get(converts[0], []),
+        'currencies':currencies,
+        'quotes':quotes,
+        'rows':rows,
+        'credits':(body.get('status') or {}).get('credit_count'), # credits charged for the call
+    }
+
+
+class CreditPlanner():
+
+    def __init__(self, daily_credits=None, ttl=60, coins_per_credit=200, credits_per_convert=1, max_converts=3, currency_ttl=24 * 3600):
+        '''
+        Plans listings fetches within a daily budget of CoinMarketCap call credits
+        (https://coinmarketcap.com/api/documentation/v1/#section/Standards-and-Conventions):
+        currencies wanted by users are merged into one request, and refresh interval
+        is stretched when the budget runs low; registered consumers (caches) get shares of the budget
+
+        :param daily_credits - credits per UTC day; None - no budget
+        :param ttl - refresh interval when budget is enough
+        :param coins_per_credit - coins returned per credit
+        :param credits_per_convert - extra credits per convert currency beyond the first
+        :param max_converts - max number of currencies per request (plan limit)
+        :param currency_ttl - seconds a currency stays in requests after it was last wanted
+        '''
+        self.daily_credits = daily_credits
+        self.base_ttl = ttl
+        self.coins_per_credit = coins_per_credit
+        self.credits_per_convert = credits_per_convert
+        self.max_converts = max_converts
+        self.currency_ttl = currency_ttl
+        self.day = None # UTC date of self.used
+        self.used = {} # consumer -> credits used today
+        self.shares = {} # consumer -> share of daily credits
+        self.wanted = {} # currency -> monotonic time it was last wanted
+        self.since = {} # currency -> monotonic time it has been wanted since (without a gap of currency_ttl)
+        self.lock = threading.Lock()
+
+
+    def register(self, consumer, share=1):
+        '''
+        Gives consumer its own part of the daily budget, so one cache can't spend credits of another
+
+        :param consumer - hashable owner of requests (e.g. ListingsCache)
+        :param share - weight of consumer; budget is split in proportion to weights
+        :return:
+        '''
+        with self.lock:
+            self.shares[consumer] = share
+
+
+    def want(self, currency):
+        '''
+        Registers currency needed by a user
+
+        :param currency - one of CURRENCIES
+        :return:
+        '''
+        with self.lock:
+            now = monotonic()
+            if now - self.wanted.get(currency, -self.currency_ttl) >= self.currency_ttl:
+                self.since[currency] = now
+            self.wanted[currency] = now
+
+
+    def converts(self):
+        '''
+        Currencies of the next request: USD and the longest wanted ones; a currency keeps its place
+        while it's wanted, so users of other currencies get USD instead of pushing it out
+
+        :return - tuple of currencies
+        '''
+        with self.lock:
+            now = monotonic()
+            wanted = sorted((c for c, t in self.wanted.items() if c != 'USD' and now - t < self.currency_ttl), key=self.since.get)
+        return ('USD',) + tuple(wanted[:self.max_converts - 1])
+
+
+    def cost(self, limit, converts):
+        '''
+        Credits of one listings request
+
+        :param limit - number of coins
+        :param converts - currencies
+        :return - number of credits
+        '''
+        return math.ceil(limit / self.coins_per_credit) + self.credits_per_convert * (len(converts) - 1)
+
+
+    def left(self, consumer=None):
+        '''
+        Credits left today
+
+        :param consumer - registered consumer; None - whole budget
+        :return - number of credits or None if there is no budget
+        '''
+        if self.daily_credits is None:
+            return None
+        with self.lock:
+            today = datetime.now(timezone.utc).date()
+            if self.day != today:
+                self.day, self.used = today, {}
+            if consumer is None:
+                return self.daily_credits - sum(self.used.values())
+            share = self.shares.get(consumer, 0) / (sum(self.shares.values()) or 1)
+            return self.daily_credits * share - self.used.get(consumer, 0)
+
+
+    def spend(self, credits, consumer=None):
+        '''
+        Records used credits
+
+        :param credits - number of credits
+        :param consumer - registered consumer which made the request
+        :return:
+        '''
+        self.left() # rolls the day over
+        with self.lock:
+            self.used[consumer] = self.used.get(consumer, 0) + credits
+
+
+    def affordable(self, limit, converts=('USD',), consumer=None):
+        '''
+        Checks whether one more request fits the budget
+
+        :param limit - number of coins
+        :param converts - currencies of the request
+        :param consumer - registered consumer; None - whole budget
+        :return - True/False
+        '''
+        left = self.left(consumer)
+        return left is None or left >= self.cost(limit, converts)
+
+
+    def ttl(self, limit, converts=('USD',), consumer=None):
+        '''
+        Refresh interval which spreads credits left evenly till the end of the UTC day
+
+        :param limit - number of coins
+        :param converts - currencies of every request
+        :param consumer - registered consumer; None - whole budget
+        :return - seconds; infinity while budget is spent
+        '''
+        left = self.left(consumer)
+        if left is None:
+            return self.base_ttl
+        now = datetime.now(timezone.utc)
+        seconds = (datetime.combine(now.date() + timedelta(days=1), datetime.min.time(), timezone.utc) - now).total_seconds()
+        fetches = left // self.cost(limit, converts)
+        if fetches < 1:
+            # budget is spent; snapshot is served until the next day resets it
+            return math.inf
+        return max(self.base_ttl, seconds / fetches)
+
+
 class API():
     
-    def __init__(self, name, key):
+    def __init__(self, name, key, timeout=(3.05, 10), retries=2, backoff=0.5):
         '''
         CoinMarketCap API (https://coinmarketcap.com/api/documentation/v1/)
 
         :param name - API's name
         :param key - API's key
+        :param timeout - (connect, read) timeouts in seconds
+        :param retries - attempts after the first one on network errors and 429/5xx
+        :param backoff - base delay between attempts in seconds
         '''
         self.name = name
         self.key = key # api key
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
         self.headers = {
-            'Accepts':'application/json',
+            'Accept':'application/json',
+            'Accept-Encoding':'gzip, deflate',
             'X-CMC_PRO_API_KEY': self.key
         }
+        # keep-alive connections are reused between calls
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        self.last_timing = None # timing of last call
+
+
+    def get(self, path, parameters):
+        '''
+        GET request with timeouts and bounded retries (jittered exponential backoff)
+
+        :param path - endpoint path
+        :param parameters - query parameters
+        :return - (response, timing dict)
+        '''
+        started = perf_counter()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                with metrics.cmc_latency.time(), profiling.span('cmc.request'):
+                    response = self.session.get(url=base_url + path, params=parameters, timeout=self.timeout)
+                metrics.cmc_requests.inc(status=response.status_code)
+                if response.status_code not in RETRY_STATUSES or attempt > self.retries:
+                    break
+                logger.warning('API request failed; status_code: %s; attempt: %s', response.status_code, attempt)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                metrics.cmc_requests.inc(status=type(e).__name__)
+                if attempt > self.retries:
+                    raise
+                logger.warning('API request failed; error: %s; attempt: %s', e, attempt)
+            sleep(self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+        self.last_timing = {'seconds': perf_counter() - started, 'attempts': attempt}
+        return response, self.last_timing
 
 
-    def latest_listings(self, limit=100):
+    def latest_listings(self, limit=100, converts=('USD',), texts=True):
         '''
         API endpoint for latest listings ordered by MarketCap value in descended order
 
         :param limit - number of requested coins
-        :return - list of coins in text format with HTML markup
+        :param converts - currencies of prices; the first one is USD
+        :param texts - False - lines of TOP message aren't built
+        :return - list of coins in text format with HTML markup, (symbol, price) quotes and timing of the call
         '''
-        logger.info('limit: {}'.format(limit))
+        logger.info('limit: %s; converts: %s', limit, converts)
         try:
-            url = base_url + '/v1/cryptocurrency/listings/latest'
             parameters = {
                 'start':'1',
                 'limit':limit,
-                'convert':'USD',
+                'convert':','.join(converts),
             }
-            response = requests.get(
-                url=url, 
-                params=parameters, 
-                headers=self.headers
-            )
+            response, timing = self.get('/v1/cryptocurrency/listings/latest', parameters)
             if response.status_code != 200:
-                logger.error('API request failed; status_code: {}; reason: {}; text: {}'.format(response.status_code, response.reason, response.text))
-                return {'status':0}
+                logger.error('API request failed; status_code: %s; reason: %s; text: %s', response.status_code, response.reason, response.text)
+                return {'status':0, 'timing':timing}
             else:
-                data = json.loads(response.text)['data']
-                text_coins = []
-                for row in data:
-                    text_coins.append('\n<code>{} - ${:.2f}</code>'.format(row['symbol'], row['quote']['USD']['price']))
-                return {'status':1, 'coins':text_coins}
+                response = parse_listings(response.content, converts, texts)
+                response['timing'] = timing
+                return response
         except Exception as e:
-            logger.exception(e)
\ No newline at end of file
+            logger.exception(e)
+            return {'status':0}
+
+
+class ListingsCache():
+
+    def __init__(self, api, ttl=60, limit=100, max_stale=3600, planner=None, convert=True, min_refetch=15, share=1, texts=True):
+        '''
+        Shared snapshot of latest listings; every caller gets a slice of one top-<limit> fetch
+
+        :param api - API instance
+        :param ttl - seconds before snapshot is refetched
+        :param limit - number of coins in snapshot
+        :param max_stale - seconds the last good snapshot is served while API fails
+        :param planner - CreditPlanner deciding refresh interval and currencies; None - fixed ttl, USD only
+        :param convert - False - USD only even with planner (planner only budgets refreshes)
+        :param min_refetch - min age of snapshot refetched early for a newly wanted currency
+        :param share - weight of this cache in planner's budget
+        :param texts - False - snapshot has no lines of TOP message (only quotes and rows are used)
+        '''
+        self.api = api
+        self.ttl = ttl
+        self.planner = planner
+        self.convert = convert
+        self.min_refetch = min_refetch
+        self.texts = texts
+        self.limit = limit
+        self.max_stale = max_stale
+        self.snapshot = None # last successful response
+        self.fetched = 0 # monotonic time of last successful fetch
+        self.inflight = None # event of running fetch
+        self.listeners = [] # called with every new snapshot
+        self.lock = threading.Lock()
+        if planner:
+            planner.register(self, share)
+
+
+    def subscribe(self, listener):
+        '''
+        Registers function called with every new snapshot (in fetching thread)
+
+        :param listener - function of API response
+        :return:
+        '''
+        self.listeners.append(listener)
+
+
+    def converts(self):
+        '''
+        Currencies of the next fetch of this cache
+
+        :return - tuple of currencies
+        '''
+        return self.planner.converts() if self.planner and self.convert else ('USD',)
+
+
+    def planned_ttl(self):
+        '''
+        Refresh interval within this cache's share of the budget
+
+        :return - seconds
+        '''
+        if not self.planner:
+            return self.ttl
+        return max(self.ttl, self.planner.ttl(self.limit, self.converts(), self))
+
+
+    def want(self, currencies):
+        '''
+        Registers currencies needed soon, so the next fetch includes all of them
+
+        :param currencies - iterable of currencies
+        :return:
+        '''
+        if self.planner:
+            for currency in currencies:
+                self.planner.want(currency)
+
+
+    def top_text(self, limit=100, prefix='', currency='USD'):
+        '''
+        TOP coins message; rendered once per snapshot for every (limit, prefix, currency)
+
+        :param limit - number of coins
+        :param prefix - text before header
+        :param currency - convert currency; USD if snapshot has no such prices
+        :return - {'status':1, 'text':...} or {'status':0} on API error
+        '''
+        with profiling.span('listings.current'):
+            snapshot = self.current(currency)
+        if snapshot is None:
+            return {'status':0}
+        with profiling.span('listings.render'):
+            return {'status':1, 'text':self.render(snapshot, limit, prefix, currency)}
+
+
+    @staticmethod
+    def render(snapshot, limit, prefix, currency='USD'):
+        '''
+        TOP coins message of snapshot; cached in the snapshot
+
+        :param snapshot - API response
+        :param limit - number of coins
+        :param prefix - text before header
+        :param currency - convert currency; USD if snapshot has no such prices
+        :return - text
+        '''
+        if currency not in snapshot.get('currencies', ()):
+            currency = 'USD'
+        key = (limit, prefix, currency)
+        text = snapshot['texts'].get(key)
+        if text is None:
+            coins = snapshot['currencies'][currency] if currency != 'USD' else snapshot['coins']
+            # racing threads may render the same text twice; the result is identical
+            text = snapshot['texts'][key] = prefix + TOP_HEADER + ('').join(coins[:limit])
+        return text
+
+
+    def current(self, currency='USD'):
+        '''
+        Gets fresh snapshot; fetches it if needed or waits for running fetch
+
+        :param currency - currency needed by caller
+        :return - API response or None if there is no usable snapshot
+        '''
+        if self.planner and self.convert:
+            self.planner.want(currency)
+        ttl = self.planned_ttl()
+        if (self.planner and self.convert and self.snapshot is not None and currency not in self.snapshot['currencies']
+                and currency in self.converts() and self.planner.affordable(self.limit, self.converts(), self)):
+            # newly wanted currency is fetched early if budget allows; USD prices are served meanwhile
+            ttl = min(ttl, self.min_refetch)
+        # low budget stretches ttl; snapshot stays usable at least that long
+        max_stale = max(self.max_stale, ttl)
+        with self.lock:
+            age = monotonic() - self.fetched
+            if self.snapshot is not None and age < ttl:
+                return self.snapshot
+            event = self.inflight
+            leader = event is None
+            if leader:
+                event = self.inflight = threading.Event()
+            elif self.snapshot is not None and age < max_stale:
+                # stale-while-revalidate; somebody is already fetching
+                return self.snapshot
+        if leader:
+            self.refresh(event)
+        else:
+            event.wait(timeout=30)
+        with self.lock:
+            if self.snapshot is None or monotonic() - self.fetched >= max_stale:
+                return None
+            return self.snapshot
+
+
+    def prefetch(self):
+        '''
+        Starts fetch in background thread if snapshot is stale; never waits
+
+        :return:
+        '''
+        ttl = self.planned_ttl()
+        with self.lock:
+            if self.inflight is not None or (self.snapshot is not None and monotonic() - self.fetched < ttl):
+                return
+        threading.Thread(target=self.current, daemon=True).start()
+
+
+    def refresh(self, event):
+        '''
+        Fetches new snapshot and wakes up waiting callers
+
+        :param event - event of this fetch
+        :return:
+        '''
+        response = None
+        converts = self.converts()
+        try:
+            response = self.api.latest_listings(limit=self.limit, converts=converts, texts=self.texts)
+            if self.planner and response['status'] == 1:
+                self.planner.spend(response['credits'] or self.planner.cost(self.limit, converts), self)
+                if self.planned_ttl() > self.ttl:
+                    logger.warning('low CMC credits; limit: %s; left: %s; refresh interval: %.0fs', self.limit, self.planner.left(self), self.planned_ttl())
+        finally:
+            with self.lock:
+                if response and response['status'] == 1:
+                    response['texts'] = {} # rendered messages of this snapshot
+                    self.snapshot = response
+                    self.fetched = monotonic()
+                else:
+                    logger.warning('API request failed; serving stale snapshot; age: %s', monotonic() - self.fetched if self.snapshot else None)
+                self.inflight = None
+            event.set()
+        if response and response['status'] == 1:
+            for listener in self.listeners:
+                try:
+                    listener(response)
+                except Exception as e:
+                    logger.exception(e)
@@ -0,0 +1,192 @@
+import json
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter, sleep
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeServer():
+
+    def __init__(self, handler, latency=0):
+        '''
+        Local HTTP server in background thread
+
+        :param handler - request handler class
+        :param latency - seconds added to every response
+        '''
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        self.latency = latency
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server.server_port)
+
+
+    def count(self):
+        with self.lock:
+            self.requests += 1
+
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class JSONHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1' # keep-alive
+    disable_nagle_algorithm = True # headers and body are written separately
+
+    def reply(self, status, payload):
+        '''
+        Sends JSON response
+
+        :param status - HTTP status
+        :param payload - JSON-serializable object
+        :return:
+        '''
+        fake = self.server.fake
+        fake.count()
+        if fake.latency:
+            sleep(fake.latency)
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def params(self):
+        '''
+        Query string and form/JSON body parameters
+
+        :return - dict
+        '''
+        params = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            body = self.rfile.read(length)
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                params.update(json.loads(body))
+            else:
+                params.update({k: v[0] for k, v in parse_qs(body.decode()).items()})
+        return params
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+class CMCHandler(JSONHandler):
+    '''
+    Stand-in for CoinMarketCap /v1/cryptocurrency/listings/latest
+    '''
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/v1/cryptocurrency/listings/latest':
+            self.reply(404, {'status': {'error_code': 404}})
+            return
+        params = self.params()
+        start, limit = int(params.get('start', 1)), int(params.get('limit', 100))
+        convert = params.get('convert', 'USD').split(',')
+        coins = self.server.fake.coins[start - 1:start - 1 + limit]
+        data = [{
+            'id': i,
+            'name': name,
+            'symbol': symbol,
+            'cmc_rank': i,
+            'quote': {c: {'price': price, 'percent_change_24h': 0.0} for c in convert},
+        } for i, (symbol, name, price) in enumerate(coins, start)]
+        self.reply(200, {'status': {'error_code': 0, 'credit_count': 1}, 'data': data})
+
+
+class FakeCMC(FakeServer):
+
+    def __init__(self, coins=5000, latency=0, seed=1):
+        '''
+        CoinMarketCap stand-in with deterministic coins
+
+        :param coins - number of listed coins
+        :param latency - seconds added to every response
+        :param seed - random seed of prices
+        '''
+        super().__init__(CMCHandler, latency)
+        rnd = random.Random(seed)
+        self.coins = [('C{}'.format(i), 'Coin {}'.format(i), rnd.uniform(0.01, 70000)) for i in range(coins)]
+
+
+class TelegramHandler(JSONHandler):
+    '''
+    Stand-in for Telegram Bot API (/bot<token>/<method>)
+    '''
+
+    def do_POST(self):
+        self.handle_method()
+
+
+    def do_GET(self):
+        self.handle_method()
+
+
+    def handle_method(self):
+        fake = self.server.fake
+        method = urlparse(self.path).path.rsplit('/', 1)[-1]
+        params = self.params()
+        with fake.lock:
+            fake.methods[method] = fake.methods.get(method, 0) + 1
+        if method == 'sendMessage' and fake.flood_rate and random.random() < fake.flood_rate:
+            self.reply(429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1', 'parameters': {'retry_after': 1}})
+            return
+        if method == 'getUpdates':
+            offset = int(params.get('offset', 0))
+            with fake.lock:
+                result = [update for update in fake.updates if update['update_id'] >= offset]
+            if not result:
+                # short long-poll, so new updates are picked up quickly
+                sleep(0.01)
+        elif method in ('sendMessage', 'editMessageText'):
+            chat_id = int(params.get('chat_id', 0))
+            with fake.lock:
+                fake.replies.setdefault(chat_id, perf_counter())
+            result = {
+                'message_id': int(params.get('message_id', 1)),
+                'date': 0,
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': params.get('text', ''),
+            }
+        elif method == 'getMyCommands':
+            result = []
+        elif method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+        else:
+            result = True
+        self.reply(200, {'ok': True, 'result': result})
+
+
+class FakeTelegram(FakeServer):
+
+    def __init__(self, latency=0, flood_rate=0):
+        '''
+        Telegram Bot API stand-in
+
+        :param latency - seconds added to every response
+        :param flood_rate - share of sendMessage calls answered with 429
+        '''
+        super().__init__(TelegramHandler, latency)
+        self.flood_rate = flood_rate
+        self.methods = {} # method -> number of calls
+        self.updates = [] # served by getUpdates
+        self.replies = {} # chat ID -> perf_counter() of the first message sent to it
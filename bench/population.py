@@ -0,0 +1,39 @@
+import random
+import sqlite3
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS Users (id INTEGER PRIMARY KEY AUTOINCREMENT, tg_id INTEGER UNIQUE NOT NULL);
+CREATE TABLE IF NOT EXISTS Settings (user_id INTEGER PRIMARY KEY REFERENCES Users(id), coins_number INTEGER NOT NULL DEFAULT 10);
+'''
+
+
+def generate(filename, users, hour=None, seed=1):
+    '''
+    Creates data.db with synthetic users
+
+    :param filename - database file
+    :param users - number of users
+    :param hour - if set, every user is scheduled at this hour (plus random others)
+    :param seed - random seed
+    :return:
+    '''
+    rnd = random.Random(seed)
+    con = sqlite3.connect(filename)
+    con.executescript(SCHEMA)
+    con.executemany('INSERT INTO Users (id, tg_id) VALUES (?, ?)', ((i, 10**8 + i) for i in range(1, users + 1)))
+    con.executemany('INSERT INTO Settings (user_id, coins_number) VALUES (?, ?)', ((i, rnd.choice((5, 10, 10, 20, 50, 100))) for i in range(1, users + 1)))
+    con.commit()
+    con.close()
+    if hour is not None:
+        # creates schedule_mask column
+        from db_worker import DB
+        db = DB(filename)
+        masks = []
+        for i in range(1, users + 1):
+            mask = 1 << hour
+            for h in rnd.sample(range(24), rnd.randint(0, 6)):
+                mask |= 1 << h
+            masks.append((mask, i))
+        with db.transaction() as con:
+            con.executemany('UPDATE Settings SET schedule_mask=? WHERE user_id=?', masks)
+        db.close()
@@ -0,0 +1,81 @@
+# Posts synthetic Telegram updates to a local webhook server (main.py --mode webhook)
+#
+# usage: python -m bench.post_updates [--url http://127.0.0.1:8443/webhook] [--updates 1000] [--chats 100]
+import argparse
+import itertools
+import json
+import threading
+import urllib.error
+import urllib.request
+from time import perf_counter, time
+
+COMMANDS = ('/top', '/top 5', '/settings', '/n 20', '/schedule 8 12 18')
+
+
+def update(update_id, chat_id, text):
+    '''
+    Telegram update with command message
+
+    :param update_id - update ID
+    :param chat_id - chat ID
+    :param text - message text
+    :return - dict
+    '''
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time()), # old messages are shed by admission control
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'bench'},
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}],
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Posts synthetic updates to webhook server')
+    parser.add_argument('--url', default='http://127.0.0.1:8443/webhook')
+    parser.add_argument('--secret', help='X-Telegram-Bot-Api-Secret-Token header')
+    parser.add_argument('--updates', type=int, default=1000)
+    parser.add_argument('--chats', type=int, default=100)
+    parser.add_argument('--first-chat', type=int, default=10**8 + 1)
+    parser.add_argument('--concurrency', type=int, default=20)
+    args = parser.parse_args()
+
+    ids = itertools.count(1)
+    statuses = {}
+    lock = threading.Lock()
+
+    def sender():
+        while True:
+            with lock:
+                update_id = next(ids)
+            if update_id > args.updates:
+                return
+            body = json.dumps(update(update_id, args.first_chat + update_id % args.chats, COMMANDS[update_id % len(COMMANDS)])).encode()
+            request = urllib.request.Request(args.url, data=body, headers={'Content-Type': 'application/json'})
+            if args.secret:
+                request.add_header('X-Telegram-Bot-Api-Secret-Token', args.secret)
+            try:
+                status = urllib.request.urlopen(request).status
+            except urllib.error.HTTPError as e:
+                status = e.code
+            except Exception as e:
+                status = type(e).__name__
+            with lock:
+                statuses[status] = statuses.get(status, 0) + 1
+
+    threads = [threading.Thread(target=sender) for _ in range(args.concurrency)]
+    started = perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    seconds = perf_counter() - started
+    print(json.dumps({'updates': args.updates, 'seconds': round(seconds, 3), 'updates_per_second': round(args.updates / seconds, 1), 'statuses': statuses}))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,49 +1,465 @@
+import hashlib
+import json
+import threading
+from time import time
+
+import telebot.apihelper
 from telebot import TeleBot, types
 
-from logger import logger
+import metrics
+import profiling
+from logger import get_logger
 from config import cmc_key
-from api import API
+from api import API, ListingsCache, CreditPlanner, CURRENCIES, escape_html, format_price
 from db_worker import DB
+from broadcast import Broadcaster, PrioritySender, BROADCAST, INTERACTIVE
+from history import PriceHistory
+from alerts import AlertEngine, OPS
+from scheduler import hour_slot, run_id as slot_run_id
+from outbox import ShardedDelivery, prepare_run, deliver_shard
+from search import PrefixIndex
+from admission import Admission
+
+logger = get_logger(__name__)
+
+ERROR_TEXT = '<b>⚠️error; Please, contact developer</b>'
+TOP_USAGE_TEXT = '⚠️<b>warning;</b> The command you sent is incorrect. Command should have only 1 argument (number [1-100]) or None'
+SCHEDULE_ERROR_TEXT = '❌<b>Please, check you are using command correcly:</b>\nmax 24 numbers;\nonly numbers;\nnumbers between 0 and 23 including them;'
+EDIT_SCHEDULE_TEXT = '⚠️The notification schedule will be cleared. <b>List the hours (max 24 numbers)</b> at which you want to receive notifications.\n\n<b>Usage:</b> <code>/schedule hours</code>\ne.g. <code>/schedule 0 8 12 18</code> is schedule for 00:00, 8:00, 12:00 and 18:00'
+CURRENCY_USAGE_TEXT = '<b>Usage:</b> <code>/currency CODE</code>\nAvailable: ' + ', '.join(CURRENCIES)
+PRICE_USAGE_TEXT = '<b>Usage:</b> <code>/price SYMBOL</code>\ne.g. <code>/price BTC</code>\n\nOr type <code>@bot name</code> in any chat'
+PROFILE_USAGE_TEXT = '<b>Usage:</b>\n<code>/profile on [slow ms]</code> - trace handlers, log slow ones\n<code>/profile off</code>\n<code>/profile cpu|stacks|memory [seconds]</code> - dump profile of live process'
+ALERT_USAGE_TEXT = '❌<b>Usage:</b> <code>/alert SYMBOL &gt; price</code> or <code>/alert SYMBOL &lt; price</code>\ne.g. <code>/alert BTC &gt; 70000</code>'
+
+# Texts and arguments parsing shared by Bot and aio.AsyncBot
+
+def command_name(text):
+    '''
+    Command of message, e.g. /top for "/top@bot 10"
+
+    :param text - message text
+    :return - command
+    '''
+    return text.split(None, 1)[0].split('@')[0]
+
+
+def parse_top(text):
+    '''
+    Parses /top command
+
+    :param text - message text
+    :return - (True, coins number or None if not given) or (False, None) if argument is incorrect
+    '''
+    args = text.split()
+    if len(args) == 1:
+        return True, None
+    # number [1-100]
+    if args[1].isdigit() and 1 <= int(args[1]) <= 100:
+        return True, int(args[1])
+    return False, None
+
+
+def parse_coins_number(text):
+    '''
+    Parses /n command
+
+    :param text - message text
+    :return - coins number [1-100] or None
+    '''
+    args = text.split()
+    if len(args) == 2 and args[1].isdigit() and 1 <= int(args[1]) <= 100:
+        return int(args[1])
+    return None
+
+
+def parse_hours(text):
+    '''
+    Parses /schedule command
+
+    :param text - message text
+    :return - set of hours [0-23] or None
+    '''
+    cmd_args = text.split()
+    if len(cmd_args) == 1 or len(cmd_args) > 25:
+        return None
+    args = set(int(n) for n in cmd_args[1:] if n.isdigit() and 0 <= int(n) <= 23) # get rid of same numbers
+    return args or None
+
+
+def parse_currency(text):
+    '''
+    Parses /currency command
+
+    :param text - message text
+    :return - currency or None
+    '''
+    args = text.split()
+    if len(args) == 2 and args[1].upper() in CURRENCIES:
+        return args[1].upper()
+    return None
+
+
+def parse_alert(text):
+    '''
+    Parses /alert command, e.g. /alert BTC > 70000
+
+    :param text - message text
+    :return - (symbol, op, threshold) or None
+    '''
+    args = text.split()
+    if len(args) != 4 or args[2] not in OPS:
+        return None
+    try:
+        threshold = float(args[3])
+    except ValueError:
+        return None
+    if threshold <= 0:
+        return None
+    return args[1].upper(), args[2], threshold
+
+
+def parse_alert_id(text):
+    '''
+    Parses /unalert command
+
+    :param text - message text
+    :return - alert ID or None
+    '''
+    args = text.split()
+    if len(args) == 2 and args[1].lstrip('#').isdigit():
+        return int(args[1].lstrip('#'))
+    return None
+
+
+def parse_price(text):
+    '''
+    Parses /price command
+
+    :param text - message text
+    :return - query (symbol or beginning of name) or None
+    '''
+    args = text.split(maxsplit=1)
+    if len(args) == 2:
+        return args[1].strip()
+    return None
+
+
+def parse_profile(text):
+    '''
+    Parses /profile command, e.g. /profile on 300 or /profile cpu 30
+
+    :param text - message text
+    :return - (action or None if incorrect, number or None) where action is status, on, off or one of profiling.PROFILES
+    '''
+    args = text.split()
+    if len(args) == 1:
+        return 'status', None
+    if len(args) > 3 or args[1] not in ('on', 'off') + tuple(profiling.PROFILES):
+        return None, None
+    if len(args) == 2:
+        return args[1], None
+    # slow ms [1-60000] or seconds [1-300]
+    if args[1] != 'off' and args[2].isdigit() and 1 <= int(args[2]) <= (60000 if args[1] == 'on' else 300):
+        return args[1], int(args[2])
+    return None, None
+
+
+def alerts_text(alerts):
+    '''
+    List of user's alerts
+
+    :param alerts - list of (alert ID, telegram ID, symbol, op, threshold)
+    :return - text with HTML markup
+    '''
+    text = '🔔 <b>Price alerts</b>'
+    for alert_id, _, symbol, op, threshold in alerts:
+        text += '\n#{} <code>{} {} {:g}</code>'.format(alert_id, escape_html(symbol), escape_html(op), threshold)
+    return text + '\n\n<i>Remove:</i> <code>/unalert id</code>'
+
+
+def alert_symbol_error(symbol, snapshot):
+    '''
+    Checks that alert of the symbol can trigger: alerts are checked against top listings only
+
+    :param symbol - coin symbol
+    :param snapshot - top listings snapshot (API response) or None
+    :return - failure text or None if symbol is in listings
+    '''
+    if snapshot is None:
+        return '⚠️error; prices are unavailable, try later'
+    if symbol not in {quote[0] for quote in snapshot['quotes']}:
+        return '❌failure; {} is not in top {} coins'.format(escape_html(symbol), len(snapshot['quotes']))
+    return None
+
+
+def price_text(coin, change_1h=None):
+    '''
+    Price of one coin found by PrefixIndex
+
+    :param coin - (rank, symbol, name, price, percent change 24h)
+    :param change_1h - percent change over the last hour from PriceHistory; None - unknown
+    :return - text with HTML markup
+    '''
+    rank, symbol, name, price, change = coin
+    text = '<b>{}</b> ({}) #{}\n<code>{}</code>'.format(symbol, escape_html(name), rank, format_price(price))
+    if change_1h is not None:
+        text += ' <i>{:+.2f}% 1h</i>'.format(change_1h)
+    if change is not None:
+        text += ' <i>{:+.2f}% 24h</i>'.format(change)
+    return text
+
+
+def profile_status_text():
+    '''
+    State of tracing and recent slow handler calls
+
+    :return - text with HTML markup
+    '''
+    tracer = profiling.tracer
+    text = '<b>Tracing</b> {}; slow ≥{:.0f}ms; sample {:g}'.format('on' if tracer.enabled else 'off', tracer.slow * 1000, tracer.sample)
+    slow = tracer.slow_text()
+    if slow:
+        # Telegram message limit is 4096 characters
+        text += '\n<pre>{}</pre>'.format(escape_html(slow[:3500]))
+    return text + '\n\n' + PROFILE_USAGE_TEXT
+
+
+def stats_text():
+    '''
+    Summary of metrics for admin
+
+    :return - text with HTML markup
+    '''
+    text = '<b>Stats</b> (count | avg | p95)'
+    for histogram in (metrics.cmc_latency, metrics.db_latency, metrics.telegram_latency, metrics.telegram_wait, metrics.broadcast_latency):
+        for labels, count, mean, p95 in histogram.summary():
+            name = histogram.name + ''.join(' {}={}'.format(k, v) for k, v in labels)
+            text += '\n<code>{} | {} | {:.1f}ms | ≤{}ms</code>'.format(name, count, mean * 1000, p95 * 1000)
+    for counter in (metrics.cmc_requests, metrics.telegram_errors, metrics.broadcast_messages, metrics.admission):
+        for labels, value in counter.items():
+            text += '\n<code>{}{} {}</code>'.format(counter.name, ''.join(' {}={}'.format(k, v) for k, v in labels), value)
+    return text
+
+
+def schedule_text(hours):
+    '''
+    User's notifications schedule
+
+    :param hours - list of hours
+    :return - text with HTML markup
+    '''
+    text_scheduler = ''
+    for hour in hours:
+        text_scheduler += '\n' + str(hour) + ':00'
+    return '⏰ <b>Notifications schedule</b>{}'.format(text_scheduler)
+
+
+def coins_settings_text(coins_number):
+    '''
+    User's coins settings
+
+    :param coins_number - number of TOP coins
+    :return - text with HTML markup
+    '''
+    textHint = '\n\n<i>(click on command to copy)</i>\nChange: <code>/n n[1-100]</code>\nExample: <code>/n 99</code>'
+    return f'\n<b>TOP coins:</b> {coins_number}' + textHint
+
+
+def default_commands():
+    '''
+    Commands shown in menu of private chats
+
+    :return - list of BotCommand
+    '''
+    return [
+        types.BotCommand('start', '1'),
+        types.BotCommand('settings', '1'),
+        types.BotCommand('top', '1')
+    ]
+
+
+def commands_hash(token, commands):
+    '''
+    Fingerprint of registered commands kept in Meta; bot ID is included, so a new token registers them again
+
+    :param token - bot's API key
+    :param commands - list of BotCommand
+    :return - hex digest
+    '''
+    payload = [token.split(':')[0], 'all_private_chats', 'en'] + [command.to_dict() for command in commands]
+    return hashlib.sha256(json.dumps(payload).encode()).hexdigest()
+
+
+def settings_markup():
+    '''
+    Buttons of settings menu
+
+    :return - InlineKeyboardMarkup
+    '''
+    markup = types.InlineKeyboardMarkup()
+    item1 = types.InlineKeyboardButton(text='Notifications', callback_data='markup_notify')
+    item2 = types.InlineKeyboardButton(text='Coins', callback_data='settings_coins')
+    markup.add(item1, item2)
+    return markup
+
+
+def schedule_markup():
+    '''
+    Buttons of notifications schedule
+
+    :return - InlineKeyboardMarkup
+    '''
+    markup = types.InlineKeyboardMarkup()
+    item1 = types.InlineKeyboardButton(text='Edit Schedule', callback_data='edit_schedule')
+    markup.add(item1)
+    return markup
+
+
+class MeteredTeleBot(TeleBot):
+    '''
+    TeleBot which sends every outgoing call through one PrioritySender
+    and records latency and errors of the calls
+    '''
+
+    def __init__(self, *args, rate=30, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sender = PrioritySender(rate)
+
+
+    def call(self, method, priority, func, *args, **kwargs):
+        '''
+        Waits for rate budget of the priority class and calls Bot API method
+
+        :param method - API method name
+        :param priority - one of broadcast.PRIORITIES
+        :param func - TeleBot method
+        :param args - method arguments
+        :return - method result
+        '''
+        def timed(*args, **kwargs):
+            # latency of the call itself, without waiting for budget
+            with metrics.telegram_call(method), profiling.span('request'):
+                return func(*args, **kwargs)
+        # span minus its request is time spent waiting for budget
+        with profiling.span('telegram.' + method):
+            return self.sender.call(priority, timed, *args, **kwargs)
+
+
+    def send_message(self, *args, priority=INTERACTIVE, **kwargs):
+        return self.call('sendMessage', priority, super().send_message, *args, **kwargs)
+
+
+    def edit_message_text(self, *args, priority=INTERACTIVE, **kwargs):
+        return self.call('editMessageText', priority, super().edit_message_text, *args, **kwargs)
+
+
+    def answer_callback_query(self, *args, priority=INTERACTIVE, **kwargs):
+        return self.call('answerCallbackQuery', priority, super().answer_callback_query, *args, **kwargs)
+
+
+    def answer_inline_query(self, *args, priority=INTERACTIVE, **kwargs):
+        return self.call('answerInlineQuery', priority, super().answer_inline_query, *args, **kwargs)
 
 
 class Bot():
 
-    def __init__(self, token):
+    def __init__(self, token, listings_ttl=60, admin_ids=(), shards=1, daily_credits=None, full_listings_ttl=900, full_listings_limit=5000,
+                 chat_rate=0.5, chat_burst=5, rate=30, interactive_reserve=5, full_listings_share=0.2):
         '''
         Telegram bot for monitoring cryptocurrency prices
 
         :param token - bot's API key
+        :param listings_ttl - seconds the listings snapshot is shared between users
+        :param admin_ids - telegram IDs allowed to use admin commands
+        :param shards - number of worker processes of scheduled broadcasts (1 - send in this process)
+        :param daily_credits - CoinMarketCap credits per day; None - no budget
+        :param full_listings_ttl - seconds the full listing of /price and inline queries is shared
+        :param full_listings_limit - number of coins in the full listing
+        :param full_listings_share - part of daily_credits spent on the full listing; the rest refreshes TOP
+        :param chat_rate - commands per second of one chat
+        :param chat_burst - commands one chat may send at once
+        :param rate - Telegram messages per second of the bot (all processes)
+        :param interactive_reserve - messages per second kept for replies while shard workers send a run
         '''
-        self.bot = TeleBot(token=token, exception_handler=logger)
-        self.set_default_commands()
-        self.api = API(name='CoinMarketCap', key=cmc_key)
+        self.admin_ids = set(admin_ids)
+        self.bot = MeteredTeleBot(token=token, exception_handler=logger, rate=rate)
+        # commands are admitted before any DB, CMC or Telegram call
+        self.admission = Admission(chat_rate, chat_burst, sender=self.bot.sender, exempt=self.admin_ids, on_throttled=self.throttled)
         self.db = DB('data.db')
+        # replies don't wait for command registration
+        threading.Thread(target=self.set_default_commands, daemon=True).start()
+        self.api = API(name='CoinMarketCap', key=cmc_key)
+        planner = CreditPlanner(daily_credits, ttl=listings_ttl)
+        self.listings = ListingsCache(self.api, ttl=listings_ttl, planner=planner, share=1 - full_listings_share)
+        # /price and inline queries look coins up in the index of a rarely fetched full listing;
+        # it costs limit / 200 credits per fetch, so it is refreshed much less often than TOP
+        # and only from its own share of the budget; its rows are indexed, no TOP text is built
+        self.full_listings = ListingsCache(self.api, ttl=full_listings_ttl, limit=full_listings_limit, max_stale=full_listings_ttl * 4,
+                                           planner=planner, convert=False, share=full_listings_share, texts=False)
+        self.index = PrefixIndex()
+        self.full_listings.subscribe(self.index.update)
+        # every fetched snapshot is kept for price change queries
+        self.history = PriceHistory('history.bin')
+        self.listings.subscribe(lambda response: self.history.append(time(), response['quotes']))
+        # rate budget is shared with replies; scheduled messages and alerts yield to them
+        self.broadcaster = Broadcaster(self.bot, workers=8, rate=None, priority=BROADCAST)
+        # shard workers share the bot's limit: they get all but interactive_reserve, which this process keeps while they run
+        self.interactive_reserve = interactive_reserve
+        # workers send to the same Bot API server (config.telegram_api_url is applied to telebot.apihelper.API_URL)
+        self.sharded = ShardedDelivery('data.db', shards=shards, rate=rate - interactive_reserve, api_url=telebot.apihelper.API_URL) if shards > 1 else None
+        # price alerts are checked against every fetched snapshot
+        self.alerts = AlertEngine(self.db, self.broadcaster)
+        self.listings.subscribe(self.alerts.check)
+        # first /top after restart finds snapshot already fetched
+        self.listings.prefetch()
         logger.info('Bot started')
     
 
     def set_default_commands(self):
         '''
-        Sets default commands for every private chat
+        Sets default commands for every private chat; Telegram is called only
+        when commands differ from the ones registered before (hash in Meta)
 
         :return:
         '''
-        default_commands = [
-            types.BotCommand('start', '1'),
-            types.BotCommand('settings', '1'),
-            types.BotCommand('top', '1')
-        ]
-        # idk why but it works only when set_my_commands and get_my_commands have same params
-        self.bot.set_my_commands(
-            commands = default_commands,
-            scope = types.BotCommandScopeAllPrivateChats(),
-            language_code = 'en'
-        )
-        self.bot.get_my_commands(
-            scope = types.BotCommandScopeAllPrivateChats(),
-            language_code = 'en'
-        )
+        logger.info('setting default commands')
+        try:
+            commands = default_commands()
+            digest = commands_hash(self.bot.token, commands)
+            if self.db.get_meta('commands_hash') == digest:
+                logger.info('default commands are up to date')
+                return
+            # idk why but it works only when set_my_commands and get_my_commands have same params
+            self.bot.set_my_commands(
+                commands = commands,
+                scope = types.BotCommandScopeAllPrivateChats(),
+                language_code = 'en'
+            )
+            self.bot.get_my_commands(
+                scope = types.BotCommandScopeAllPrivateChats(),
+                language_code = 'en'
+            )
+            self.db.set_meta('commands_hash', digest)
+        except Exception as e:
+            # not saved; registration is retried on next start
+            logger.exception(e)
 
     
+    def throttled(self, chat_id, seconds):
+        '''
+        Tells chat which sends commands too fast to slow down
+
+        :param chat_id - telegram chat ID
+        :param seconds - seconds till the chat may send the next command
+        :return:
+        '''
+        logger.info('chat_id=%s', chat_id)
+        self.bot.send_message(
+            chat_id=chat_id,
+            text='⏳Too many requests; try again in {:.0f}s'.format(max(1, seconds))
+        )
+
+
     def start(self, message):
         '''
         Starts bot
@@ -51,7 +467,7 @@ class Bot():
         :param message - telegram message
         :return:
         '''
-        logger.info('tg_id={}'.format(message.from_user.id))
+        logger.info('tg_id=%s', message.from_user.id)
         try:
             # add user in DB if not yet
             self.db.add_user(message.from_user.id)
@@ -61,7 +477,7 @@ class Bot():
                 text = 'Hello, ' + message.from_user.first_name + ' 😊'
             )
         except Exception as e:
-            logger.exception('message={}'.format(message))
+            logger.exception('message=%s', message)
 
 
     def top(self, message):
@@ -71,76 +487,284 @@ class Bot():
         :param message - telegram message
         :return:
         '''
-        logger.info('tg_id={}'.format(message.from_user.id))
+        logger.info('tg_id=%s', message.from_user.id)
         try:
             # check for command argument - number
-            try:
-                coins_n = message.text.split()[1]
-                # number [1-100]
-                if coins_n.isdigit() and (int(coins_n)>=1 and int(coins_n)<=100):
-                    coins_n = int(coins_n)
-                # sends user tip about how to use command
-                else:
-                    error_message = '⚠️<b>warning;</b> The command you sent is incorrect. Command should have only 1 argument (number [1-100]) or None'
-                    self.bot.send_message(
-                        chat_id=message.from_user.id,
-                        text=error_message,
-                        parse_mode="HTML"
-                    )
-                    return
+            correct, coins_n = parse_top(message.text)
+            # sends user tip about how to use command
+            if not correct:
+                self.bot.send_message(
+                    chat_id=message.from_user.id,
+                    text=TOP_USAGE_TEXT,
+                    parse_mode="HTML"
+                )
+                return
             # no argument - get from user settings
-            except IndexError:
+            if coins_n is None:
                 coins_n = self.db.get_top_coins_number(message.from_user.id)
-            response = self.api.latest_listings(limit=coins_n)
+            response = self.listings.top_text(limit=coins_n, currency=self.db.get_currency(message.from_user.id))
             # api error
             if response['status'] == 0:
                 self.bot.send_message(
                     chat_id=message.from_user.id,
-                    text='<b>⚠️error; Please, contact developer</b>',
+                    text=ERROR_TEXT,
                     parse_mode="HTML"
                 )
             else:
-                text_header = "<b>Coin</b> - <b>Price</b>"
-                format_text = text_header + ('').join(response['coins'])
                 self.bot.send_message(
                     chat_id=message.from_user.id,
-                    text=format_text,
+                    text=response['text'],
                     parse_mode="HTML"
                 )
         except Exception as e:
-            logger.exception('message={}'.format(message))
+            logger.exception('message=%s', message)
 
 
-    def top_all(self):
+    def top_all(self, hour=None, run_id=None):
         '''
-        Sends TOP coins to users who scheduled current time
-        :return:
+        Sends TOP coins to users who scheduled the hour; recipients are enqueued in Outbox first,
+        so a run interrupted by crash is resumed by calling it again with the same run ID
+
+        :param hour - scheduled hour; current hour by default
+        :param run_id - run ID; today's slot of the hour by default
+        :return - broadcast stats
         '''
-        logger.info('')
+        logger.info('hour=%s; run_id=%s', hour, run_id)
         try:
-            response = self.api.latest_listings()
+            slot = hour_slot(time())
+            if hour is not None:
+                slot = slot.replace(hour=int(hour))
+            run_id = run_id or slot_run_id(slot)
+            # snapshot is fetched once here and shared by all shards through RunTexts
+            prepare_run(self.db, run_id, slot.hour, self.scheduled_texts)
+            if self.sharded:
+                with self.bot.sender.reserve(self.interactive_reserve):
+                    stats = self.sharded.send(run_id)
+            else:
+                stats = deliver_shard(self.db, self.broadcaster, run_id)
+            logger.info('run_id=%s; jobs by status: %s', run_id, self.db.finish_run(run_id))
+            return stats
+        except Exception as e:
+            logger.exception(e)
+
+
+    def scheduled_texts(self, variants):
+        '''
+        Scheduled messages of a run; all currencies are requested together
+
+        :param variants - list of (coins number, currency)
+        :return - dict of (coins number, currency) -> text with HTML markup
+        '''
+        self.listings.want(currency for _, currency in variants)
+        texts = {}
+        for coins_number, currency in variants:
+            response = self.listings.top_text(limit=coins_number, prefix='*\n', currency=currency)
             # api error
-            if response['status'] == 0:
-                for user in self.db.get_recipients():
-                    self.bot.send_message(
-                        chat_id=user[0],
-                        text='<b>⚠️error; Please, contact developer</b>',
-                        parse_mode="HTML"
-                    )
+            texts[coins_number, currency] = response['text'] if response['status'] else ERROR_TEXT
+        return texts
+
+
+    def price(self, message):
+        '''
+        Sends price of coin, e.g. /price BTC
+
+        :param message - telegram message
+        :return:
+        '''
+        logger.info('tg_id=%s', message.from_user.id)
+        try:
+            query = parse_price(message.text)
+            text = PRICE_USAGE_TEXT
+            if query:
+                if not self.index.coins:
+                    # first lookup after start; later snapshots are fetched in background
+                    self.full_listings.current()
+                else:
+                    self.full_listings.prefetch()
+                coins = self.index.search(query, limit=1)
+                # top coins have an hour of snapshots in history
+                text = price_text(coins[0], self.history.change(coins[0][1], 3600)) if coins else '❌not found; ' + escape_html(query)
+            self.bot.send_message(
+                chat_id=message.from_user.id,
+                text=text,
+                parse_mode='HTML'
+            )
+        except Exception:
+            logger.exception('message=%s', message)
+
+
+    def inline(self, query):
+        '''
+        Answers inline query (@bot eth) with matching coins; answered from the index only
+
+        :param query - telegram InlineQuery
+        :return:
+        '''
+        logger.info('tg_id=%s', query.from_user.id)
+        try:
+            # never waits for CoinMarketCap; empty answer until the first snapshot is indexed
+            self.full_listings.prefetch()
+            results = []
+            for coin in self.index.search(query.query, limit=20):
+                rank, symbol, name, price, change = coin
+                results.append(types.InlineQueryResultArticle(
+                    id=str(rank),
+                    title='{} · {}'.format(symbol, name),
+                    description='{} · #{}'.format(format_price(price), rank),
+                    input_message_content=types.InputTextMessageContent(price_text(coin), parse_mode='HTML')
+                ))
+            self.bot.answer_inline_query(query.id, results, cache_time=30)
+        except Exception:
+            logger.exception('query=%s', query)
+
+
+    def stats(self, message):
+        '''
+        Sends latency and error stats to admin
+
+        :param message - telegram message
+        :return:
+        '''
+        logger.info('tg_id=%s', message.from_user.id)
+        try:
+            if message.from_user.id not in self.admin_ids:
+                logger.warning('not admin; tg_id=%s', message.from_user.id)
+                return
+            self.bot.send_message(
+                chat_id=message.from_user.id,
+                text=stats_text(),
+                parse_mode='HTML'
+            )
+        except Exception:
+            logger.exception('message=%s', message)
+
+
+    def profile(self, message):
+        '''
+        Switches tracing or takes profile of the live process for admin, e.g. /profile cpu 30
+
+        :param message - telegram message
+        :return:
+        '''
+        logger.info('tg_id=%s', message.from_user.id)
+        try:
+            if message.from_user.id not in self.admin_ids:
+                logger.warning('not admin; tg_id=%s', message.from_user.id)
+                return
+            action, number = parse_profile(message.text)
+            if action is None:
+                text = PROFILE_USAGE_TEXT
+            elif action == 'status':
+                text = profile_status_text()
+            elif action == 'on':
+                profiling.tracer.configure(True, slow=number / 1000 if number else None)
+                text = '✅tracing on; slow ≥{:.0f}ms'.format(profiling.tracer.slow * 1000)
+            elif action == 'off':
+                profiling.tracer.configure(False)
+                text = '✅tracing off'
             else:
-                text_header = "<b>Coin</b> - <b>Price</b>"
-                for user in self.db.get_recipients():
-                    try:
-                        text = '*\n' + text_header + ('').join(response['coins'][:user[1]])
-                        self.bot.send_message(
-                            chat_id=user[0],
-                            text=text,
-                            parse_mode="HTML"
-                        )
-                    except Exception:
-                        logger.exception('tg_id={}'.format(user[0]))
+                # handler thread isn't held for the whole window
+                seconds = number or 30
+                threading.Thread(target=self.send_profile, args=(message.from_user.id, action, seconds), daemon=True).start()
+                text = '⏳{} profile for {}s'.format(action, seconds)
+            self.bot.send_message(
+                chat_id=message.from_user.id,
+                text=text,
+                parse_mode='HTML'
+            )
+        except Exception:
+            logger.exception('message=%s', message)
+
+
+    def send_profile(self, tg_id, kind, seconds):
+        '''
+        Takes profile and sends its summary; full dump is left in profiles/ directory
+
+        :param tg_id - telegram ID of admin
+        :param kind - one of profiling.PROFILES
+        :param seconds - length of window
+        :return:
+        '''
+        logger.info('tg_id=%s; kind=%s; seconds=%s', tg_id, kind, seconds)
+        try:
+            path, summary = profiling.PROFILES[kind](seconds)
+            text = '<b>{} profile</b> {}\n<pre>{}</pre>'.format(kind, escape_html(path or ''), escape_html(summary[:3500]))
         except Exception as e:
             logger.exception(e)
+            text = '❌failure; ' + escape_html(str(e))
+        try:
+            self.bot.send_message(
+                chat_id=tg_id,
+                text=text,
+                parse_mode='HTML'
+            )
+        except Exception as e:
+            logger.exception(e)
+
+
+    def add_alert(self, message):
+        '''
+        Adds price alert, e.g. /alert BTC > 70000
+
+        :param message - telegram message
+        :return:
+        '''
+        logger.info('tg_id=%s', message.from_user.id)
+        try:
+            text = ALERT_USAGE_TEXT
+            alert = parse_alert(message.text)
+            if alert:
+                text = alert_symbol_error(alert[0], self.listings.current())
+            if alert and text is None:
+                alert_id = self.alerts.add(message.from_user.id, *alert)
+                if alert_id is None:
+                    text = '❌failure; max {} alerts'.format(self.alerts.max_per_user)
+                else:
+                    text = '✅success; alert #{}'.format(alert_id)
+            self.bot.send_message(
+                chat_id=message.from_user.id,
+                text=text,
+                parse_mode='HTML'
+            )
+        except Exception:
+            logger.exception('message=%s', message)
+
+
+    def list_alerts(self, message):
+        '''
+        Sends user's price alerts
+
+        :param message - telegram message
+        :return:
+        '''
+        logger.info('tg_id=%s', message.from_user.id)
+        try:
+            self.bot.send_message(
+                chat_id=message.from_user.id,
+                text=alerts_text(self.db.get_alerts(message.from_user.id)),
+                parse_mode='HTML'
+            )
+        except Exception:
+            logger.exception('message=%s', message)
+
+
+    def remove_alert(self, message):
+        '''
+        Removes price alert, e.g. /unalert 5
+
+        :param message - telegram message
+        :return:
+        '''
+        logger.info('tg_id=%s', message.from_user.id)
+        try:
+            alert_id = parse_alert_id(message.text)
+            success = alert_id is not None and self.alerts.remove(message.from_user.id, alert_id)
+            self.bot.send_message(
+                chat_id=message.from_user.id,
+                text='✅success' if success else '❌failure'
+            )
+        except Exception:
+            logger.exception('message=%s', message)
 
 
     def settings(self, message):
@@ -150,21 +774,16 @@ class Bot():
         :param message - telegram message
         :return:
         '''
-        logger.info('tg_id={}'.format(message.from_user.id))
+        logger.info('tg_id=%s', message.from_user.id)
         try:
-            markup = types.InlineKeyboardMarkup()
-            item1 = types.InlineKeyboardButton(text='Notifications', callback_data='markup_notify')
-            item2 = types.InlineKeyboardButton(text='Coins', callback_data='settings_coins')
-            markup.add(item1, item2)
-
             self.bot.send_message(
                 chat_id=message.from_user.id,
                 text='<b>Settings</b>',
                 parse_mode='HTML',
-                reply_markup=markup
+                reply_markup=settings_markup()
             )
         except Exception as e:
-            logger.exception('message={}'.format(message))
+            logger.exception('message=%s', message)
 
         
     def markup_notify(self, call):
@@ -174,29 +793,19 @@ class Bot():
         :param call - user's callback
         :return:
         '''
-        logger.info('tg_id={}'.format(call.from_user.id))
+        logger.info('tg_id=%s', call.from_user.id)
         try:
             tg_id = call.from_user.id
 
-            scheduler_notify = self.db.get_schedule(tg_id)
-            text_scheduler = ''
-            for hour in scheduler_notify:
-                text_scheduler += '\n' + str(hour) + ':00'
-            text = '⏰ <b>Notifications schedule</b>{}'.format(text_scheduler)
-
-            markup = types.InlineKeyboardMarkup()
-            item1 = types.InlineKeyboardButton(text='Edit Schedule', callback_data='edit_schedule')
-            markup.add(item1)
-
             self.bot.edit_message_text(
                 chat_id=tg_id, 
                 message_id=call.message.id, 
-                text=text,  
+                text=schedule_text(self.db.get_schedule(tg_id)),  
                 parse_mode='HTML',
-                reply_markup=markup
+                reply_markup=schedule_markup()
             )
         except Exception as e:
-            logger.exception('call={}'.format(call))
+            logger.exception('call=%s', call)
             try:
                 self.bot.answer_callback_query(callback_query_id=call.id, show_alert=True, text='⚠️error⚠️\nPlease, contact developer')
             except Exception as e:
@@ -210,22 +819,20 @@ class Bot():
         :param call - user's callback
         :return:
         '''
-        logger.info('tg_id={}'.format(call.from_user.id))
+        logger.info('tg_id=%s', call.from_user.id)
         try:
             tg_id = call.from_user.id
             coins_number = self.db.get_top_coins_number(tg_id) # number of TOP coins
-            textHint = '\n\n<i>(click on command to copy)</i>\nChange: <code>/n n[1-100]</code>\nExample: <code>/n 99</code>'
-            text = f'\n<b>TOP coins:</b> {coins_number}' + textHint
 
             self.bot.edit_message_text(
                 chat_id=tg_id, 
                 message_id=call.message.id, 
-                text=text,  
+                text=coins_settings_text(coins_number),  
                 parse_mode='HTML',
                 reply_markup=None
             )
         except Exception as e:
-            logger.exception('call={}'.format(call))
+            logger.exception('call=%s', call)
             try:
                 self.bot.answer_callback_query(callback_query_id=call.id, show_alert=True, text='⚠️error; Please, contact developer')
             except Exception as e:
@@ -239,23 +846,45 @@ class Bot():
         :param message - telegram message
         '''
         try:
-            args = message.text.split()
-            if len(args) == 2:
-                if args[1].isdigit():
-                    n = int(args[1])
-                    if n >= 1 and n <= 100:
-                        if self.db.save_settings(tg_id=message.from_user.id, field="coins_number", val=n):
-                            self.bot.send_message(
-                                chat_id=message.from_user.id,
-                                text='✅success'
-                            )
-                            return
+            n = parse_coins_number(message.text)
+            if n is not None:
+                if self.db.save_settings(tg_id=message.from_user.id, field="coins_number", val=n):
+                    self.bot.send_message(
+                        chat_id=message.from_user.id,
+                        text='✅success'
+                    )
+                    return
             self.bot.send_message(
                 chat_id=message.from_user.id,
                 text='❌failure'
             )
         except Exception:
-            logger.exception('message={}'.format(message))
+            logger.exception('message=%s', message)
+
+
+    def currency(self, message):
+        '''
+        Changes currency of prices, e.g. /currency EUR
+
+        :param message - telegram message
+        :return:
+        '''
+        logger.info('tg_id=%s', message.from_user.id)
+        try:
+            currency = parse_currency(message.text)
+            if currency is None:
+                text = '💱 <b>Currency:</b> {}\n\n'.format(self.db.get_currency(message.from_user.id)) + CURRENCY_USAGE_TEXT
+            elif self.db.save_settings(tg_id=message.from_user.id, field='currency', val=currency):
+                text = '✅success'
+            else:
+                text = '❌failure'
+            self.bot.send_message(
+                chat_id=message.from_user.id,
+                text=text,
+                parse_mode='HTML'
+            )
+        except Exception:
+            logger.exception('message=%s', message)
 
 
     def edit_schedule(self, message):
@@ -265,37 +894,19 @@ class Bot():
         :param message - telegram message
         :return:
         '''
-        logger.info('tg_id={}'.format(message.from_user.id))
+        logger.info('tg_id=%s', message.from_user.id)
         try:
-            cmd_args = message.text.split()
-            length = len(cmd_args)
-            text_error = '❌<b>Please, check you are using command correcly:</b>\nmax 24 numbers;\nonly numbers;\nnumbers between 0 and 23 including them;'
-            if length == 1 or length > 25:
-                self.bot.send_message(
-                    chat_id = message.from_user.id,
-                    text = text_error,
-                    parse_mode='HTML'
-                )
-            else:
-                args = []
-                for n in cmd_args[1:]:
-                    if n.isdigit():
-                        n = int(n)
-                        if n>=0 and n<=23:
-                            args.append(n)
-                args = set(args) # get rid of same numbers
-                status = ''
-                if len(args):
-                    status = '✅success' if self.db.edit_schedule(message.from_user.id, args) else text_error
-                else:
-                    status = text_error
-                self.bot.send_message(
-                    chat_id = message.from_user.id,
-                    text = status,
-                    parse_mode='HTML'
-                )
+            args = parse_hours(message.text)
+            status = SCHEDULE_ERROR_TEXT
+            if args and self.db.edit_schedule(message.from_user.id, args):
+                status = '✅success'
+            self.bot.send_message(
+                chat_id = message.from_user.id,
+                text = status,
+                parse_mode='HTML'
+            )
         except Exception:
-            logger.exception('message={}'.format(message))
+            logger.exception('message=%s', message)
 
 
     def helper(self, call):
@@ -305,17 +916,15 @@ class Bot():
         :param call - user's callback
         :return:
         '''
-        logger.info('tg_id={}'.format(call.from_user.id))
+        logger.info('tg_id=%s', call.from_user.id)
         try:
             tg_id = call.from_user.id
 
             if call.data == 'edit_schedule':
-                text = '⚠️The notification schedule will be cleared. <b>List the hours (max 24 numbers)</b> at which you want to receive notifications.\n\n<b>Usage:</b> <code>/schedule hours</code>\ne.g. <code>/schedule 0 8 12 18</code> is schedule for 00:00, 8:00, 12:00 and 18:00'
-
                 self.bot.edit_message_text(
                     chat_id=tg_id, 
                     message_id=call.message.id, 
-                    text=text,  
+                    text=EDIT_SCHEDULE_TEXT,  
                     parse_mode='HTML',
                     reply_markup=None
                 )
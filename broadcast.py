@@ -0,0 +1,305 @@
+import queue
+import random
+import threading
+from contextlib import contextmanager
+from time import monotonic, sleep
+
+from telebot.apihelper import ApiTelegramException
+
+import metrics
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# priority classes of outgoing Telegram calls, most urgent first
+INTERACTIVE = 'interactive' # replies to commands and callbacks
+BROADCAST = 'broadcast' # scheduled messages and alerts
+PRIORITIES = (INTERACTIVE, BROADCAST)
+
+
+class TokenBucket():
+
+    def __init__(self, rate, capacity=None):
+        '''
+        Thread-safe token bucket
+
+        :param rate - tokens added per second
+        :param capacity - max number of tokens (burst size)
+        '''
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+
+    def take(self):
+        '''
+        Takes token if there is one
+
+        :return - 0 on success or seconds to wait for the next token
+        '''
+        with self.lock:
+            now = monotonic()
+            if now < self.paused_until:
+                return self.paused_until - now
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+    def acquire(self):
+        '''
+        Blocks until token is taken
+
+        :return:
+        '''
+        wait = self.take()
+        while wait:
+            sleep(wait)
+            wait = self.take()
+
+
+    def set_rate(self, rate):
+        '''
+        Changes rate and burst size; tokens above new capacity are dropped
+
+        :param rate - tokens added per second
+        :return:
+        '''
+        with self.lock:
+            now = max(monotonic(), self.updated)
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.rate = self.capacity = rate
+            self.tokens = min(self.tokens, self.capacity)
+
+
+    def pause(self, seconds):
+        '''
+        Stops giving tokens for some time (e.g. after 429 from Telegram)
+
+        :param seconds - pause duration
+        :return:
+        '''
+        with self.lock:
+            self.paused_until = max(self.paused_until, monotonic() + seconds)
+            self.updated = self.paused_until
+            self.tokens = 0
+
+
+class PrioritySender():
+
+    def __init__(self, rate=30):
+        '''
+        Shared rate budget of all outgoing Telegram calls of the bot;
+        a call waits while calls of a more urgent class are waiting
+
+        :param rate - messages per second
+        '''
+        self.bucket = TokenBucket(rate)
+        self.waiting = [0] * len(PRIORITIES) # waiting calls per class
+        self.condition = threading.Condition()
+
+
+    def acquire(self, priority=INTERACTIVE):
+        '''
+        Blocks until the call may be sent
+
+        :param priority - one of PRIORITIES
+        :return:
+        '''
+        rank = PRIORITIES.index(priority)
+        started = monotonic()
+        with self.condition:
+            self.waiting[rank] += 1
+            metrics.telegram_queue_depth.set(self.waiting[rank], priority=priority)
+            try:
+                while True:
+                    # more urgent calls take the next token
+                    wait = 1 / self.bucket.rate if any(self.waiting[:rank]) else self.bucket.take()
+                    if not wait:
+                        break
+                    self.condition.wait(wait)
+            finally:
+                self.waiting[rank] -= 1
+                metrics.telegram_queue_depth.set(self.waiting[rank], priority=priority)
+                self.condition.notify_all()
+        metrics.telegram_wait.observe(monotonic() - started, priority=priority)
+
+
+    @contextmanager
+    def reserve(self, rate):
+        '''
+        Lowers budget of this process while other processes (shard workers) send with the rest of it
+
+        :param rate - messages per second left to this process
+        :return:
+        '''
+        full = self.bucket.rate
+        logger.info('rate=%s; full=%s', rate, full)
+        self.bucket.set_rate(rate)
+        try:
+            yield
+        finally:
+            self.bucket.set_rate(full)
+            with self.condition:
+                self.condition.notify_all()
+
+
+    def call(self, priority, func, *args, **kwargs):
+        '''
+        Calls Telegram within the budget; flood control (429) pauses every class
+
+        :param priority - one of PRIORITIES
+        :param func - Bot API method
+        :param args - method arguments
+        :return - method result
+        '''
+        self.acquire(priority)
+        try:
+            return func(*args, **kwargs)
+        except ApiTelegramException as e:
+            if e.error_code == 429:
+                retry_after = (e.result_json.get('parameters') or {}).get('retry_after', 1)
+                logger.warning('flood control; retry_after=%s', retry_after)
+                self.bucket.pause(retry_after)
+            raise
+
+
+class Broadcaster():
+
+    def __init__(self, bot, workers=8, rate=30, chat_rate=1, retries=3, priority=None):
+        '''
+        Sends messages to many chats through a pool of workers within Telegram limits
+        (https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this)
+
+        :param bot - TeleBot instance
+        :param workers - number of sending threads
+        :param rate - global messages per second; None if bot shapes calls itself (PrioritySender)
+        :param chat_rate - messages per second to one chat
+        :param retries - attempts per message after the first one
+        :param priority - priority class passed to send_message of bot with PrioritySender
+        '''
+        self.bot = bot
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.retries = retries
+        self.priority = priority
+        self.bucket = TokenBucket(rate) if rate else None
+        self.chat_buckets = {}
+        self.lock = threading.Lock()
+
+
+    def chat_bucket(self, chat_id):
+        '''
+        Gets token bucket of the chat
+
+        :param chat_id - telegram chat ID
+        :return - TokenBucket
+        '''
+        with self.lock:
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, capacity=1)
+            return bucket
+
+
+    def send(self, messages, on_result=None, **kwargs):
+        '''
+        Sends messages and waits until all of them are delivered or failed
+
+        :param messages - iterable of (chat ID, text)
+        :param on_result - function of (chat ID, True/False, number of attempts) called in worker thread
+        :param kwargs - extra arguments of send_message (e.g. parse_mode)
+        :return - dict with run stats
+        '''
+        stats = {'sent': 0, 'failed': 0, 'retried': 0}
+        jobs = queue.Queue(maxsize=self.workers * 4)
+        workers = [threading.Thread(target=self.worker, args=(jobs, stats, on_result, kwargs), daemon=True) for _ in range(self.workers)]
+        started = monotonic()
+        for worker in workers:
+            worker.start()
+        try:
+            for chat_id, text in messages:
+                jobs.put((chat_id, text))
+        finally:
+            for _ in workers:
+                jobs.put(None)
+            for worker in workers:
+                worker.join()
+            with self.lock:
+                self.chat_buckets.clear()
+        stats['seconds'] = round(monotonic() - started, 3)
+        metrics.broadcast_latency.observe(stats['seconds'])
+        metrics.broadcast_messages.inc(stats['sent'], result='sent')
+        metrics.broadcast_messages.inc(stats['failed'], result='failed')
+        stats['rate'] = round(stats['sent'] / stats['seconds'], 2) if stats['seconds'] else 0
+        logger.info('broadcast finished; %s', stats)
+        return stats
+
+
+    def worker(self, jobs, stats, on_result, kwargs):
+        '''
+        Takes messages from queue and sends them until stop sign (None)
+
+        :param jobs - queue of (chat ID, text)
+        :param stats - shared stats of the run
+        :param on_result - function of (chat ID, True/False, number of attempts) or None
+        :param kwargs - extra arguments of send_message
+        :return:
+        '''
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            sent, attempts = self.deliver(job[0], job[1], kwargs)
+            with self.lock:
+                stats['sent' if sent else 'failed'] += 1
+                stats['retried'] += attempts - 1
+            if on_result is not None:
+                on_result(job[0], sent, attempts)
+
+
+    def deliver(self, chat_id, text, kwargs):
+        '''
+        Sends one message; retries on flood control and temporary errors
+
+        :param chat_id - telegram chat ID
+        :param text - message text
+        :param kwargs - extra arguments of send_message
+        :return - (True/False, number of attempts)
+        '''
+        attempt = 0
+        while True:
+            attempt += 1
+            self.chat_bucket(chat_id).acquire()
+            if self.bucket:
+                self.bucket.acquire()
+            try:
+                if self.priority:
+                    self.bot.send_message(chat_id=chat_id, text=text, priority=self.priority, **kwargs)
+                else:
+                    self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                return True, attempt
+            except ApiTelegramException as e:
+                if attempt > self.retries or (e.error_code != 429 and e.error_code < 500):
+                    # e.g. 403 - user blocked the bot
+                    logger.warning('tg_id=%s; error_code=%s; description=%s', chat_id, e.error_code, e.description)
+                    return False, attempt
+                if e.error_code == 429:
+                    retry_after = (e.result_json.get('parameters') or {}).get('retry_after', 1)
+                    logger.warning('flood control; retry_after=%s', retry_after)
+                    if self.bucket:
+                        self.bucket.pause(retry_after)
+                else:
+                    sleep(2 ** attempt * random.uniform(0.5, 1))
+            except Exception:
+                if attempt > self.retries:
+                    logger.exception('tg_id=%s', chat_id)
+                    return False, attempt
+                sleep(2 ** attempt * random.uniform(0.5, 1))
@@ -1,22 +1,320 @@
+import queue
 import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
 from datetime import datetime
 from time import time
 
-from logger import logger
+import metrics
+import profiling
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+ALL_HOURS = (1 << 24) - 1 # schedule mask with every hour set
+
+# Settings columns users may change; column names never come from callers
+SETTINGS_UPDATES = {field: f'UPDATE Settings SET {field}=? WHERE user_id=?' for field in ('coins_number', 'currency')}
+
+# Outbox.status
+OUTBOX_PENDING = 0
+OUTBOX_SENDING = 1 # claimed by a sender; result unknown until it reports back
+OUTBOX_SENT = 2
+OUTBOX_FAILED = 3
+
+
+def hours_to_mask(hours):
+    '''
+    Packs hours into 24-bit schedule mask
+
+    :param hours - iterable of hours [0-23]
+    :return - integer with bit <hour> set for every hour
+    '''
+    mask = 0
+    for hour in hours:
+        mask |= 1 << hour
+    return mask
+
+
+def mask_to_hours(mask):
+    '''
+    Unpacks 24-bit schedule mask
+
+    :param mask - schedule mask
+    :return - sorted list of hours
+    '''
+    return [hour for hour in range(24) if mask >> hour & 1]
+
+
+class LRUCache():
+
+    def __init__(self, size):
+        '''
+        Thread-safe dictionary that evicts least recently used keys
+
+        :param size - max number of keys
+        '''
+        self.size = size
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+
+    def get(self, key):
+        '''
+        Gets value by key and marks it as recently used
+
+        :param key - cache key
+        :return - value or None
+        '''
+        with self.lock:
+            try:
+                self.data.move_to_end(key)
+                return self.data[key]
+            except KeyError:
+                return None
+
+
+    def set(self, key, value):
+        '''
+        Sets value by key; evicts the oldest key when cache is full
+
+        :param key - cache key
+        :param value - cached value
+        :return:
+        '''
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            if len(self.data) > self.size:
+                self.data.popitem(last=False)
+
+
+    def pop(self, key):
+        '''
+        Removes key from cache
+
+        :param key - cache key
+        :return:
+        '''
+        with self.lock:
+            self.data.pop(key, None)
+
+
+class GroupCommitWriter():
+
+    def __init__(self, db, max_batch=256):
+        '''
+        Thread which runs write jobs; jobs queued while a commit is running
+        are merged into the next transaction (one savepoint per job)
+
+        :param db - DB instance
+        :param max_batch - max number of jobs per transaction
+        '''
+        self.db = db
+        self.max_batch = max_batch
+        self.jobs = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.run, name='db-writer', daemon=True)
+        self.thread.start()
+
+
+    def submit(self, func, *args):
+        '''
+        Queues write job
+
+        :param func - function of (connection, *args)
+        :param args - function arguments
+        :return - Future resolved after commit
+        '''
+        future = Future()
+        self.jobs.put((future, func, args))
+        return future
+
+
+    def stop(self):
+        '''
+        Commits queued jobs and stops thread
+
+        :return:
+        '''
+        self.jobs.put(None)
+        self.thread.join()
+
+
+    def run(self):
+        '''
+        Takes jobs until stop sign (None) and commits them in batches
+
+        :return:
+        '''
+        stopped = False
+        while not stopped:
+            job = self.jobs.get()
+            if job is None:
+                return
+            batch = [job]
+            while len(batch) < self.max_batch:
+                try:
+                    job = self.jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    stopped = True
+                    break
+                batch.append(job)
+            self.commit(batch)
+
+
+    def commit(self, batch):
+        '''
+        Runs jobs in one transaction; failed job is rolled back alone
+
+        :param batch - list of (future, function, args)
+        :return:
+        '''
+        results = []
+        try:
+            with metrics.db_latency.time(statement='GROUP_COMMIT'), self.db.transaction() as con:
+                for future, func, args in batch:
+                    con.execute('SAVEPOINT job')
+                    try:
+                        results.append((future, func(con, *args), None))
+                        con.execute('RELEASE job')
+                    except Exception as e:
+                        con.execute('ROLLBACK TO job')
+                        con.execute('RELEASE job')
+                        results.append((future, None, e))
+        except Exception as e:
+            logger.exception(e)
+            for future, _, _ in batch:
+                future.set_exception(e)
+            return
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
 
 
 class DB():
 
-    def __init__(self, filename):
+    def __init__(self, filename, cache_size=100000):
         '''
         DataBase manager
         
         :param filename - name of database file
+        :param cache_size - max number of users kept in memory
         '''
         self.filename = filename
+        # tg_id -> {'id': user ID, 'coins_number': ..., 'schedule': ...}
+        self.cache = LRUCache(cache_size)
+        self.local = threading.local() # one connection per thread
+        self.connections = []
+        self.lock = threading.Lock()
+        self.query('CREATE TABLE IF NOT EXISTS Meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.query('''CREATE TABLE IF NOT EXISTS Alerts (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL REFERENCES Users(id),
+                                                         symbol TEXT NOT NULL, op TEXT NOT NULL, threshold REAL NOT NULL)''')
+        self.query('CREATE INDEX IF NOT EXISTS Alerts_user ON Alerts (user_id)')
+        # scheduled deliveries: one run per slot, one job per recipient of the run
+        self.query('CREATE TABLE IF NOT EXISTS Runs (id TEXT PRIMARY KEY, created REAL NOT NULL, finished REAL)')
+        self.query(f'''CREATE TABLE IF NOT EXISTS Outbox (run_id TEXT NOT NULL, tg_id INTEGER NOT NULL, coins_number INTEGER NOT NULL,
+                                                          status INTEGER NOT NULL DEFAULT {OUTBOX_PENDING}, attempts INTEGER NOT NULL DEFAULT 0,
+                                                          currency TEXT NOT NULL DEFAULT 'USD', PRIMARY KEY (run_id, tg_id)) WITHOUT ROWID''')
+        self.query(f'CREATE INDEX IF NOT EXISTS Outbox_pending ON Outbox (run_id) WHERE status={OUTBOX_PENDING}')
+        # messages of the run rendered once by coordinator and read by every shard
+        self.query('''CREATE TABLE IF NOT EXISTS RunTexts (run_id TEXT NOT NULL, coins_number INTEGER NOT NULL, currency TEXT NOT NULL, text TEXT NOT NULL,
+                                                           PRIMARY KEY (run_id, coins_number, currency)) WITHOUT ROWID''')
+        self.migrate()
+        # user and settings writes
+        self.writer = GroupCommitWriter(self)
         logger.info('')
-        
-        
+
+
+    def migrate(self):
+        '''
+        Moves notification schedule from Notify_Time rows (one per user and hour)
+        to Settings.schedule_mask (one 24-bit integer per user); adds Settings.currency
+
+        :return:
+        '''
+        columns = [row[1] for row in self.query('PRAGMA table_info(Settings)')]
+        if columns and 'schedule_mask' not in columns:
+            logger.info('migrating Notify_Time to Settings.schedule_mask')
+            with self.transaction():
+                self.query(f'ALTER TABLE Settings ADD COLUMN schedule_mask INTEGER NOT NULL DEFAULT {ALL_HOURS}')
+                if self.query("SELECT name FROM sqlite_master WHERE type='table' AND name='Notify_Time'"):
+                    # one pass over Notify_Time; users without rows have no notifications
+                    masks = self.query('SELECT SUM(DISTINCT 1 << hour), user_id FROM Notify_Time GROUP BY user_id')
+                    self.query('UPDATE Settings SET schedule_mask=0')
+                    self.connection().executemany('UPDATE Settings SET schedule_mask=? WHERE user_id=?', masks)
+                    self.query('DROP TABLE Notify_Time')
+        if columns and 'currency' not in columns:
+            self.query("ALTER TABLE Settings ADD COLUMN currency TEXT NOT NULL DEFAULT 'USD'")
+
+
+    def connection(self):
+        '''
+        Gets long-lived connection of the current thread (opens it on first use)
+
+        :return - sqlite3 connection
+        '''
+        con = getattr(self.local, 'con', None)
+        if con is None:
+            # autocommit mode; transactions are opened explicitly by self.transaction()
+            con = sqlite3.connect(self.filename, isolation_level=None, cached_statements=256, check_same_thread=False)
+            con.execute('PRAGMA journal_mode=WAL')
+            con.execute('PRAGMA synchronous=NORMAL')
+            con.execute('PRAGMA busy_timeout=5000')
+            self.local.con = con
+            self.local.depth = 0
+            with self.lock:
+                self.connections.append(con)
+        return con
+
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Runs enclosed queries in one transaction; nested calls join the outer one
+
+        :return:
+        '''
+        con = self.connection()
+        if self.local.depth:
+            self.local.depth += 1
+            try:
+                yield con
+            finally:
+                self.local.depth -= 1
+            return
+        con.execute('BEGIN IMMEDIATE')
+        self.local.depth = 1
+        try:
+            yield con
+        except BaseException:
+            con.execute('ROLLBACK')
+            raise
+        else:
+            con.execute('COMMIT')
+        finally:
+            self.local.depth = 0
+
+
+    def close(self):
+        '''
+        Closes all opened connections
+
+        :return:
+        '''
+        self.writer.stop()
+        with self.lock:
+            for con in self.connections:
+                con.close()
+            self.connections.clear()
+        self.local = threading.local()
+
+
     def query(self, sql, iterable=()):
         '''
         Querying database
@@ -25,16 +323,17 @@ class DB():
         :param iterable - values
         :return - list of querying rows
         '''
-        logger.info('sql={}; values={}'.format(sql, iterable))
+        logger.debug('sql=%s; values=%s', sql, iterable)
         try:
-            con = sqlite3.Connection(self.filename)
-            cur = sqlite3.Cursor(con)
-            rows = cur.execute(sql, iterable).fetchall()
-            con.commit()
-            con.close()
-            return rows
+            # label is statement type (SELECT, UPDATE...) to keep number of series small
+            statement = sql.lstrip().split(None, 1)[0].upper()
+            with metrics.db_latency.time(statement=statement), profiling.span('db.' + statement):
+                return self.connection().execute(sql, iterable).fetchall()
         except Exception as e:
             logger.exception(e)
+            # lets enclosing transaction roll back
+            if getattr(self.local, 'depth', 0):
+                raise
 
 
     def is_user(self, tg_id):
@@ -44,14 +343,35 @@ class DB():
         :param tg_id - telegram ID
         :return - user ID or NULL
         '''
-        logger.info('tg_id={}'.format(tg_id))
+        logger.info('tg_id=%s', tg_id)
         try:
+            user = self.cache.get(tg_id)
+            if user is not None:
+                return [(user['id'],)]
             user_id = self.query('SELECT id FROM Users WHERE tg_id=?', (tg_id,))
+            if user_id:
+                self.cache.set(tg_id, {'id': user_id[0][0]})
             return user_id
         except Exception as e:
             logger.exception(e)
 
 
+    def get_user(self, tg_id):
+        '''
+        Gets cached user record; loads user ID from DB on cache miss
+
+        :param tg_id - telegram ID
+        :return - dict with user ID and cached settings
+        '''
+        user = self.cache.get(tg_id)
+        if user is None:
+            self.is_user(tg_id)
+            user = self.cache.get(tg_id)
+            if user is None:
+                raise KeyError('unknown tg_id={}'.format(tg_id))
+        return user
+
+
     def add_user(self, tg_id):
         '''
         Adding user in DB
@@ -59,35 +379,85 @@ class DB():
         :param tg_id - telegram ID
         :return:
         '''
-        logger.info('tg_id={}'.format(tg_id))
+        logger.info('tg_id=%s', tg_id)
         try:
-            if not self.is_user(tg_id):
-                self.query('INSERT INTO Users (tg_id) VALUES (?)', (tg_id,))
-                user_id = self.is_user(tg_id)[0][0]
-                self.query('INSERT INTO Settings (user_id) VALUES (?)', (user_id,))
-
-                # sets default notifications schedule
-                values = ''
-                for i in range(1, 24):
-                    values += f',({user_id}, {i})'
-                self.query(f'INSERT INTO Notify_Time VALUES({user_id}, 0)' + values)
+            if self.is_user(tg_id):
+                return
+            user_id, created = self.write(self.insert_user, tg_id)
+            user = {'id': user_id}
+            if created:
+                # default notifications schedule is every hour (see Settings.schedule_mask)
+                user['schedule'] = list(range(24))
+            self.cache.set(tg_id, user)
         except Exception as e:
             logger.exception(e)
 
 
-    def get_recipients(self):
+    def write(self, func, *args):
+        '''
+        Runs write job in the next group commit and waits for it
+
+        :param func - function of (connection, *args)
+        :param args - function arguments
+        :return - function result
+        '''
+        with profiling.span('db.write'):
+            return self.writer.submit(func, *args).result()
+
+
+    @staticmethod
+    def insert_user(con, tg_id):
         '''
-        Gets users whose schedule coincides with the current time
+        Write job of add_user: inserts user and default settings unless user exists
 
+        :param con - connection of writer
+        :param tg_id - telegram ID
+        :return - (user ID, True if inserted)
+        '''
+        # repeated /start of one user may be queued twice
+        row = con.execute('SELECT id FROM Users WHERE tg_id=?', (tg_id,)).fetchone()
+        if row:
+            return row[0], False
+        user_id = con.execute('INSERT INTO Users (tg_id) VALUES (?)', (tg_id,)).lastrowid
+        con.execute('INSERT INTO Settings (user_id) VALUES (?)', (user_id,))
+        return user_id, True
+
+
+    def get_meta(self, key):
+        '''
+        Gets bot's own state value
+
+        :param key - name of value
+        :return - value or None
+        '''
+        rows = self.query('SELECT value FROM Meta WHERE key=?', (key,))
+        return rows[0][0] if rows else None
+
+
+    def set_meta(self, key, value):
+        '''
+        Saves bot's own state value
+
+        :param key - name of value
+        :param value - new value
+        :return:
+        '''
+        self.query('INSERT OR REPLACE INTO Meta (key, value) VALUES (?, ?)', (key, value))
+
+
+    def get_recipients(self, hour=None):
+        '''
+        Gets users whose schedule coincides with the hour
+
+        :param hour - hour of schedule; current hour by default
         :return - list of (user ID, coins number)
         '''
-        logger.info('')
+        logger.info('hour=%s', hour)
         try:
-            h = datetime.fromtimestamp(time()).hour
-            users = [row for row in self.query('''SELECT tg_id, coins_number FROM Users as u
-                                                    JOIN Notify_Time as nt on u.id=nt.user_id
-                                                    JOIN Settings as s on u.id=s.user_id
-                                                    WHERE nt.hour=?''', (h,))]
+            h = datetime.fromtimestamp(time()).hour if hour is None else int(hour)
+            users = [row for row in self.query(f'''SELECT tg_id, coins_number FROM Settings as s
+                                                    JOIN Users as u on u.id=s.user_id
+                                                    WHERE s.schedule_mask & {1 << h}''')]
             return users
         except Exception as e:
             logger.exception(e)
@@ -100,11 +470,13 @@ class DB():
         :param tg_id - telegram ID
         :return - list of hours
         '''
-        logger.info('tg_id={}'.format(tg_id))
+        logger.info('tg_id=%s', tg_id)
         try:
-            user_id = self.is_user(tg_id)[0][0]
-            schedule = [val[0] for val in self.query('SELECT hour FROM Notify_Time WHERE user_id=? ORDER BY hour ASC', (user_id,))]
-            return schedule
+            user = self.get_user(tg_id)
+            if 'schedule' not in user:
+                # a value saved by edit_schedule while we read is newer than ours, so it isn't overwritten
+                user.setdefault('schedule', mask_to_hours(self.query('SELECT schedule_mask FROM Settings WHERE user_id=?', (user['id'],))[0][0]))
+            return list(user['schedule'])
         except Exception as e:
             logger.exception(e)
 
@@ -116,13 +488,34 @@ class DB():
         :param tg_id - telegram ID
         :return - number of TOP coins
         '''
-        logger.info('tg_id={}'.format(tg_id))
+        logger.info('tg_id=%s', tg_id)
+        try:
+            user = self.get_user(tg_id)
+            if 'coins_number' not in user:
+                # a value saved by save_settings while we read is newer than ours, so it isn't overwritten
+                user.setdefault('coins_number', self.query('SELECT coins_number FROM Settings WHERE user_id=?', (user['id'],))[0][0])
+            return user['coins_number']
+        except Exception as e:
+            logger.exception(e)
+
+
+    def get_currency(self, tg_id):
+        '''
+        Gets user's currency of prices
+
+        :param tg_id - telegram ID
+        :return - currency, e.g. 'USD'
+        '''
+        logger.info('tg_id=%s', tg_id)
         try:
-            user_id = self.is_user(tg_id)[0][0]
-            n = self.query('SELECT coins_number FROM Settings WHERE user_id=?', (user_id,))[0][0]
-            return n
+            user = self.get_user(tg_id)
+            if 'currency' not in user:
+                # a value saved by save_settings while we read is newer than ours, so it isn't overwritten
+                user.setdefault('currency', self.query('SELECT currency FROM Settings WHERE user_id=?', (user['id'],))[0][0])
+            return user['currency']
         except Exception as e:
             logger.exception(e)
+            return 'USD'
 
 
     def save_settings(self, tg_id, field, val):
@@ -130,14 +523,16 @@ class DB():
         Saves user settings
 
         :param tg_id - telegram ID
-        :param field - table field
+        :param field - table field (one of SETTINGS_UPDATES)
         :param val - new value
         :return - True/False
         '''
-        logger.info('tg_id={}; field={}; value={}'.format(tg_id, field, val))
+        logger.info('tg_id=%s; field=%s; value=%s', tg_id, field, val)
         try:
-            user_id = self.is_user(tg_id)[0][0]
-            self.query(f'UPDATE Settings SET {field}=? WHERE user_id=?', (val, user_id,))
+            sql = SETTINGS_UPDATES[field]
+            user = self.get_user(tg_id)
+            self.write(self.update, sql, (val, user['id']))
+            user[field] = val
             return True
         except Exception as e:
             logger.exception(e)
@@ -151,16 +546,221 @@ class DB():
         :param tg_id - telegram ID
         :param args - list of hours
         '''
-        logger.info('tg_id={}; args={}'.format(tg_id, args))
+        logger.info('tg_id=%s; args=%s', tg_id, args)
         try:
-            user_id = self.is_user(tg_id)[0][0]
-            self.query('DELETE FROM Notify_Time WHERE user_id=?', (user_id,))
-            values = ''
-            arg1 = args.pop()
-            for n in args:
-                values += f',({user_id}, {n})'
-            self.query('INSERT INTO Notify_Time VALUES(?, ?)' + values, (user_id, arg1))
+            user = self.get_user(tg_id)
+            mask = hours_to_mask(args)
+            self.write(self.update, 'UPDATE Settings SET schedule_mask=? WHERE user_id=?', (mask, user['id']))
+            user['schedule'] = mask_to_hours(mask)
             return True
         except Exception as e:
             logger.exception(e)
-            return False
\ No newline at end of file
+            return False
+
+
+    @staticmethod
+    def update(con, sql, values):
+        '''
+        Write job running one statement
+
+        :param con - connection of writer
+        :param sql - sql query
+        :param values - values
+        :return:
+        '''
+        con.execute(sql, values)
+
+
+    def add_alert(self, tg_id, symbol, op, threshold):
+        '''
+        Adds price alert
+
+        :param tg_id - telegram ID
+        :param symbol - coin symbol
+        :param op - '>' or '<'
+        :param threshold - price
+        :return - alert ID or None
+        '''
+        logger.info('tg_id=%s; symbol=%s; op=%s; threshold=%s', tg_id, symbol, op, threshold)
+        try:
+            user = self.get_user(tg_id)
+            with self.transaction() as con:
+                return con.execute('INSERT INTO Alerts (user_id, symbol, op, threshold) VALUES (?, ?, ?, ?)', (user['id'], symbol, op, threshold)).lastrowid
+        except Exception as e:
+            logger.exception(e)
+
+
+    def get_alerts(self, tg_id=None):
+        '''
+        Gets price alerts of the user or of everybody
+
+        :param tg_id - telegram ID; None for all users
+        :return - list of (alert ID, telegram ID, symbol, op, threshold)
+        '''
+        logger.info('tg_id=%s', tg_id)
+        try:
+            sql = '''SELECT a.id, u.tg_id, a.symbol, a.op, a.threshold FROM Alerts as a
+                     JOIN Users as u on u.id=a.user_id'''
+            if tg_id is None:
+                return self.query(sql)
+            return self.query(sql + ' WHERE a.user_id=? ORDER BY a.id', (self.get_user(tg_id)['id'],))
+        except Exception as e:
+            logger.exception(e)
+            return []
+
+
+    def delete_alerts(self, ids, tg_id=None):
+        '''
+        Deletes price alerts
+
+        :param ids - list of alert IDs
+        :param tg_id - if set, only alerts of this user are deleted
+        :return - number of deleted alerts
+        '''
+        logger.info('ids=%s; tg_id=%s', ids, tg_id)
+        try:
+            with self.transaction() as con:
+                if tg_id is None:
+                    return con.executemany('DELETE FROM Alerts WHERE id=?', ((i,) for i in ids)).rowcount
+                user_id = self.get_user(tg_id)['id']
+                return con.executemany('DELETE FROM Alerts WHERE id=? AND user_id=?', ((i, user_id) for i in ids)).rowcount
+        except Exception as e:
+            logger.exception(e)
+            return 0
+
+
+    def create_run(self, run_id, hour):
+        '''
+        Enqueues jobs of scheduled delivery for every recipient of the hour in one bulk insert;
+        existing run is resumed instead, so nobody gets the message of a run twice
+
+        :param run_id - run ID (slot of the delivery)
+        :param hour - hour of schedule
+        :return - number of enqueued jobs (0 for resumed run)
+        '''
+        logger.info('run_id=%s; hour=%s', run_id, hour)
+        try:
+            with self.transaction() as con:
+                if con.execute('INSERT OR IGNORE INTO Runs (id, created) VALUES (?, ?)', (run_id, time())).rowcount == 0:
+                    # jobs claimed by a crashed process may have been sent already; at-most-once
+                    lost = con.execute('UPDATE Outbox SET status=? WHERE run_id=? AND status=?', (OUTBOX_FAILED, run_id, OUTBOX_SENDING)).rowcount
+                    logger.warning('resuming run; run_id=%s; jobs with unknown result: %s', run_id, lost)
+                    return 0
+                return con.execute(f'''INSERT INTO Outbox (run_id, tg_id, coins_number, currency)
+                                        SELECT ?, tg_id, coins_number, currency FROM Settings as s
+                                        JOIN Users as u on u.id=s.user_id
+                                        WHERE s.schedule_mask & {1 << int(hour)}''', (run_id,)).rowcount
+        except Exception as e:
+            logger.exception(e)
+            return 0
+
+
+    def claim_outbox(self, run_id, limit, shard=0, shards=1):
+        '''
+        Takes batch of pending jobs of the run
+
+        :param run_id - run ID
+        :param limit - max number of jobs
+        :param shard - number of shard [0, shards)
+        :param shards - number of shards; recipients are partitioned by tg_id % shards
+        :return - list of (telegram ID, coins number, currency)
+        '''
+        logger.debug('run_id=%s; limit=%s; shard=%s/%s', run_id, limit, shard, shards)
+        try:
+            with self.transaction() as con:
+                # status is inlined as a constant, so partial index Outbox_pending is used
+                jobs = con.execute(f'SELECT tg_id, coins_number, currency FROM Outbox WHERE run_id=? AND status={OUTBOX_PENDING} AND tg_id % ?=? LIMIT ?',
+                                   (run_id, shards, shard, limit)).fetchall()
+                con.executemany('UPDATE Outbox SET status=? WHERE run_id=? AND tg_id=?', ((OUTBOX_SENDING, run_id, job[0]) for job in jobs))
+                return jobs
+        except Exception as e:
+            logger.exception(e)
+            return []
+
+
+    def get_run_variants(self, run_id):
+        '''
+        Gets distinct messages of pending jobs of the run
+
+        :param run_id - run ID
+        :return - list of (coins number, currency)
+        '''
+        logger.info('run_id=%s', run_id)
+        try:
+            return self.query(f'SELECT DISTINCT coins_number, currency FROM Outbox WHERE run_id=? AND status={OUTBOX_PENDING}', (run_id,))
+        except Exception as e:
+            logger.exception(e)
+            return []
+
+
+    def save_run_texts(self, run_id, texts):
+        '''
+        Saves rendered messages of the run
+
+        :param run_id - run ID
+        :param texts - dict of (coins number, currency) -> text
+        :return:
+        '''
+        logger.info('run_id=%s; texts=%s', run_id, len(texts))
+        try:
+            with self.transaction() as con:
+                con.executemany('INSERT OR REPLACE INTO RunTexts (run_id, coins_number, currency, text) VALUES (?, ?, ?, ?)',
+                                ((run_id, coins_number, currency, text) for (coins_number, currency), text in texts.items()))
+        except Exception as e:
+            logger.exception(e)
+
+
+    def get_run_texts(self, run_id):
+        '''
+        Gets rendered messages of the run
+
+        :param run_id - run ID
+        :return - dict of (coins number, currency) -> text
+        '''
+        logger.info('run_id=%s', run_id)
+        try:
+            return {(coins_number, currency): text for coins_number, currency, text in self.query('SELECT coins_number, currency, text FROM RunTexts WHERE run_id=?', (run_id,))}
+        except Exception as e:
+            logger.exception(e)
+            return {}
+
+
+    def finish_outbox(self, run_id, results):
+        '''
+        Saves results of sent jobs
+
+        :param run_id - run ID
+        :param results - list of (telegram ID, True/False, number of attempts)
+        :return:
+        '''
+        logger.debug('run_id=%s; results=%s', run_id, len(results))
+        if not results:
+            return
+        try:
+            with self.transaction() as con:
+                con.executemany('UPDATE Outbox SET status=?, attempts=attempts+? WHERE run_id=? AND tg_id=?',
+                                ((OUTBOX_SENT if sent else OUTBOX_FAILED, attempts, run_id, tg_id) for tg_id, sent, attempts in results))
+        except Exception as e:
+            logger.exception(e)
+
+
+    def finish_run(self, run_id, retention=7 * 24 * 3600):
+        '''
+        Marks run as finished if it has no pending jobs; removes runs older than retention
+
+        :param run_id - run ID
+        :param retention - seconds jobs of old runs are kept
+        :return - dict of status -> number of jobs of the run
+        '''
+        logger.info('run_id=%s', run_id)
+        try:
+            with self.transaction() as con:
+                con.execute(f'UPDATE Runs SET finished=? WHERE id=? AND NOT EXISTS (SELECT 1 FROM Outbox WHERE run_id=? AND status={OUTBOX_PENDING})',
+                            (time(), run_id, run_id))
+                con.execute('DELETE FROM Outbox WHERE run_id IN (SELECT id FROM Runs WHERE created < ?)', (time() - retention,))
+                con.execute('DELETE FROM RunTexts WHERE run_id IN (SELECT id FROM Runs WHERE created < ?)', (time() - retention,))
+                con.execute('DELETE FROM Runs WHERE created < ?', (time() - retention,))
+                return dict(con.execute('SELECT status, COUNT(*) FROM Outbox WHERE run_id=? GROUP BY status', (run_id,)).fetchall())
+        except Exception as e:
+            logger.exception(e)
+            return {}
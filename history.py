@@ -0,0 +1,207 @@
+import json
+import math
+import mmap
+import os
+import struct
+import threading
+from array import array
+
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+MAGIC = b'CBHIST01'
+HEADER = struct.Struct('<8sQQQ') # magic, capacity, columns, number of appended rows
+NAN = float('nan')
+
+
+class PriceHistory():
+
+    def __init__(self, filename, capacity=1440, columns=512):
+        '''
+        Price snapshots in memory-mapped ring of float64 rows (one column per coin);
+        the newest <capacity> snapshots are kept, so file size never changes
+
+        File layout: header | timestamps[capacity] | prices[capacity][columns]
+        Coin symbols are interned into column numbers in <filename>.symbols; when all columns are taken,
+        the coin which left the listing longest ago gives its column to a new one
+
+        :param filename - data file
+        :param capacity - number of kept snapshots
+        :param columns - max number of coins
+        '''
+        self.filename = filename
+        self.symbols_file = filename + '.symbols'
+        self.lock = threading.Lock()
+        if os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                magic, capacity, columns, _ = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC:
+                raise ValueError('{} is not a price history file'.format(filename))
+        else:
+            with open(filename, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, capacity, columns, 0))
+                f.truncate(HEADER.size + 8 * capacity * (columns + 1))
+        self.capacity = capacity
+        self.columns = columns
+        self.file = open(filename, 'r+b')
+        self.mmap = mmap.mmap(self.file.fileno(), 0)
+        self.values = memoryview(self.mmap)[HEADER.size:].cast('d')
+        self.timestamps = self.values[:capacity]
+        self.prices = self.values[capacity:]
+        self.empty_row = array('d', [NAN]) * columns
+        self.count = HEADER.unpack_from(self.mmap)[3]
+        self.symbols = {} # symbol -> column
+        self.seen = {} # symbol -> number of the last appended snapshot with the coin (this process only)
+        self.full = False # all columns are used by one snapshot; logged once
+        if os.path.exists(self.symbols_file):
+            with open(self.symbols_file) as f:
+                self.symbols = {symbol: column for column, symbol in enumerate(json.load(f))}
+
+
+    def close(self):
+        '''
+        Flushes data to disk and unmaps file
+
+        :return:
+        '''
+        with self.lock:
+            self.timestamps.release()
+            self.prices.release()
+            self.values.release()
+            self.mmap.flush()
+            self.mmap.close()
+            self.file.close()
+
+
+    def intern(self, symbol, stamp):
+        '''
+        Gets column of the coin; assigns free or recycled column to unknown coin (called under lock)
+
+        :param symbol - coin symbol
+        :param stamp - number of the snapshot being appended
+        :return - column number or None if every column is used by this snapshot
+        '''
+        column = self.symbols.get(symbol)
+        if column is None:
+            if len(self.symbols) < self.columns:
+                column = len(self.symbols)
+            else:
+                # coins not seen since restart count as the oldest
+                old = min(self.symbols, key=lambda s: self.seen.get(s, 0))
+                if self.seen.get(old, 0) == stamp:
+                    if not self.full:
+                        self.full = True
+                        logger.warning('no free column for %s; snapshot has more than %s coins', symbol, self.columns)
+                    return None
+                column = self.symbols.pop(old)
+                self.seen.pop(old, None)
+                self.clear(column)
+                logger.info('column %s of %s is reused for %s', column, old, symbol)
+            self.symbols[symbol] = column
+            tmp = self.symbols_file + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(sorted(self.symbols, key=self.symbols.get), f)
+            os.replace(tmp, self.symbols_file)
+        self.seen[symbol] = stamp
+        return column
+
+
+    def clear(self, column):
+        '''
+        Forgets prices of the column in every row
+
+        :param column - column number
+        :return:
+        '''
+        for row in range(self.capacity):
+            self.prices[row * self.columns + column] = NAN
+
+
+    def append(self, timestamp, quotes):
+        '''
+        Appends snapshot; overwrites the oldest one when store is full
+
+        :param timestamp - unix time of snapshot
+        :param quotes - iterable of (symbol, price)
+        :return:
+        '''
+        with self.lock:
+            row = self.count % self.capacity
+            offset = row * self.columns
+            prices = self.prices
+            prices[offset:offset + self.columns] = self.empty_row
+            for symbol, price in quotes:
+                column = self.intern(symbol, self.count + 1)
+                if column is not None and math.isnan(prices[offset + column]):
+                    prices[offset + column] = price
+            self.timestamps[row] = timestamp
+            # row becomes visible only after it is fully written
+            self.count += 1
+            HEADER.pack_into(self.mmap, 0, MAGIC, self.capacity, self.columns, self.count)
+
+
+    def rows(self):
+        '''
+        Physical rows in chronological order
+
+        :return - (number of rows, function of logical position -> physical row)
+        '''
+        size = min(self.count, self.capacity)
+        start = self.count - size
+        return size, lambda i: (start + i) % self.capacity
+
+
+    def last(self, symbol, n):
+        '''
+        Last <n> prices of the coin
+
+        :param symbol - coin symbol
+        :param n - number of points
+        :return - list of (timestamp, price) from old to new
+        '''
+        with self.lock:
+            column = self.symbols.get(symbol)
+            if column is None:
+                return []
+            size, row = self.rows()
+            points = []
+            for i in range(size - 1, -1, -1):
+                price = self.prices[row(i) * self.columns + column]
+                if not math.isnan(price):
+                    points.append((self.timestamps[row(i)], price))
+                    if len(points) == n:
+                        break
+            points.reverse()
+            return points
+
+
+    def change(self, symbol, window):
+        '''
+        Price change of the coin over time window
+
+        :param symbol - coin symbol
+        :param window - window length in seconds
+        :return - change in percent or None if there is no data old enough
+        '''
+        with self.lock:
+            column = self.symbols.get(symbol)
+            size, row = self.rows()
+            if column is None or not size:
+                return None
+            latest = self.timestamps[row(size - 1)]
+            # binary search of the last snapshot not newer than <latest - window>
+            lo, hi = 0, size
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self.timestamps[row(mid)] <= latest - window:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if lo == 0:
+                return None
+            new = self.prices[row(size - 1) * self.columns + column]
+            old = self.prices[row(lo - 1) * self.columns + column]
+            if math.isnan(new) or math.isnan(old) or not old:
+                return None
+            return (new - old) / old * 100
@@ -1,8 +1,86 @@
+import atexit
 import logging
+import logging.handlers
+import os
+import queue
+
+import config
+
+# optional settings in config.py
+log_file = getattr(config, 'log_file', 'out.log')
+log_level = getattr(config, 'log_level', 'INFO')
+log_levels = getattr(config, 'log_levels', {}) # module name -> level, e.g. {'db_worker': 'DEBUG'}
+log_max_bytes = getattr(config, 'log_max_bytes', 10 * 1024 * 1024)
+log_backup_count = getattr(config, 'log_backup_count', 5)
+log_rotate_when = getattr(config, 'log_rotate_when', None) # e.g. 'midnight'; rotates by time instead of size
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+
+    def prepare(self, record):
+        '''
+        Enqueues record as is; message is formatted by listener thread
+
+        :param record - log record
+        :return - log record
+        '''
+        return record
+
+
+def make_file_handler(filename):
+    '''
+    Rotating file handler configured by log_rotate_when / log_max_bytes
+
+    :param filename - log file
+    :return - handler
+    '''
+    if log_rotate_when:
+        handler = logging.handlers.TimedRotatingFileHandler(filename, when=log_rotate_when, backupCount=log_backup_count, delay=True)
+    else:
+        handler = logging.handlers.RotatingFileHandler(filename, maxBytes=log_max_bytes, backupCount=log_backup_count, delay=True)
+    handler.setFormatter(formatter)
+    return handler
+
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-file_handler = logging.FileHandler('out.log')
+logger.setLevel(log_level)
 formatter = logging.Formatter(fmt='%(levelname)s|%(asctime)s|%(filename)s %(funcName)s on line %(lineno)d|%(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
\ No newline at end of file
+file_handler = make_file_handler(log_file)
+# producers only put records in queue; file is written by background listener
+log_queue = queue.SimpleQueue()
+logger.addHandler(LazyQueueHandler(log_queue))
+listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+listener.start()
+atexit.register(listener.stop)
+
+
+def get_logger(name):
+    '''
+    Gets module logger; its level can be set in config.log_levels
+
+    :param name - module name
+    :return - child of main logger
+    '''
+    child = logger.getChild(name)
+    if name in log_levels:
+        child.setLevel(log_levels[name])
+    return child
+
+
+def use_suffix(suffix):
+    '''
+    Moves logging of this process to its own file, e.g. out.shard0.log;
+    rotating handlers of several processes must not share a file
+
+    :param suffix - inserted before extension of log_file
+    :return - new log file name
+    '''
+    global file_handler
+    root, extension = os.path.splitext(log_file)
+    filename = '{}.{}{}'.format(root, suffix, extension)
+    listener.stop()
+    file_handler.close()
+    file_handler = make_file_handler(filename)
+    listener.handlers = (file_handler,)
+    listener.start()
+    return filename
@@ -1,30 +1,68 @@
-import schedule
+import argparse
+import signal
 import threading
-import time
-from datetime import datetime
+
+import telebot.apihelper
+
+import config
+import metrics
+import profiling
 
 from api import API
-from logger import logger
+from logger import get_logger
 from config import token
-from bot import Bot
+from bot import Bot, command_name
+from scheduler import Scheduler, HourlyDelivery
+
+logger = get_logger(__name__)
+
+# self-hosted Bot API server (https://github.com/tdlib/telegram-bot-api), e.g. 'http://127.0.0.1:8081/bot{0}/{1}'
+if getattr(config, 'telegram_api_url', None):
+    telebot.apihelper.API_URL = config.telegram_api_url
 
-bot = Bot(token)
+# broadcast_shards > 1 sends scheduled broadcasts with that many worker processes (see outbox.py); default 1 sends them in this process.
+# Shards share one Telegram rate and pay for process start-up, so they help only when one process can't reach that rate:
+# CPU-bound sending on a multi-core host (e.g. a self-hosted Bot API with a raised limit). At the default 30 msg/s they don't;
+# bench top_all_sharded with 4 shards sent 1k messages at ~131 msg/s vs ~179 msg/s of one process
+# cmc_daily_credits limits CoinMarketCap credits per day; refresh interval grows when it runs low
+# chat_rate and chat_burst limit commands of one chat (token bucket)
+bot = Bot(token, admin_ids=getattr(config, 'admin_ids', ()), shards=getattr(config, 'broadcast_shards', 1), daily_credits=getattr(config, 'cmc_daily_credits', None),
+          chat_rate=getattr(config, 'chat_rate', 0.5), chat_burst=getattr(config, 'chat_burst', 5))
+scheduler = Scheduler()
 
-@bot.bot.message_handler(commands=['start', 'top', 'settings', 'schedule', 'n'])
+@bot.bot.message_handler(commands=['start', 'top', 'settings', 'schedule', 'n', 'stats', 'alert', 'alerts', 'unalert', 'currency', 'price', 'profile'])
 def message_handler(message):
     try:
-        if message.text == '/start':
-            bot.start(message)
-        elif message.text.startswith('/top'):
-            bot.top(message)
-        elif message.text == '/settings':
-            bot.settings(message)
-        elif message.text.startswith('/schedule'):
-            bot.edit_schedule(message)
-        elif message.text.startswith('/n'):
-            bot.ChangeTopCoinsNumber(message)
-        else:
-            logger.warning('No command handler; message={}'.format(message))
+        # rejected commands cost no DB, CMC or Telegram call; keyed by user, who gets the reply (in groups too)
+        with bot.admission.admit(message.from_user.id, message.text, message.date) as admitted, profiling.trace(command_name(message.text), message.from_user.id):
+            if not admitted:
+                return
+            if message.text == '/start':
+                bot.start(message)
+            elif message.text.startswith('/top'):
+                bot.top(message)
+            elif message.text == '/settings':
+                bot.settings(message)
+            elif message.text.startswith('/schedule'):
+                bot.edit_schedule(message)
+            elif message.text.startswith('/n'):
+                bot.ChangeTopCoinsNumber(message)
+            elif message.text == '/stats':
+                bot.stats(message)
+            elif message.text.startswith('/alerts'):
+                bot.list_alerts(message)
+            elif message.text.startswith('/alert'):
+                bot.add_alert(message)
+            elif message.text.startswith('/unalert'):
+                bot.remove_alert(message)
+            elif message.text.startswith('/currency'):
+                bot.currency(message)
+            elif message.text.startswith('/price'):
+                bot.price(message)
+            elif message.text.startswith('/profile'):
+                bot.profile(message)
+            else:
+                logger.warning('No command handler; message=%s', message)
     except Exception as e:
         logger.exception(e)
 
@@ -32,42 +70,83 @@ def message_handler(message):
 @bot.bot.callback_query_handler(lambda call: True)
 def callback_handler(call):
     try:
-        if call.data.startswith('markup'):
-            if call.data == 'markup_notify':
-                bot.markup_notify(call)
-        elif call.data == 'settings_coins':
-            bot.goCoinsSettings(call)
-        else:
-            bot.helper(call)
+        with bot.admission.admit(call.from_user.id, 'callback ' + call.data) as admitted, profiling.trace('callback ' + call.data, call.from_user.id):
+            if not admitted:
+                return
+            if call.data.startswith('markup'):
+                if call.data == 'markup_notify':
+                    bot.markup_notify(call)
+            elif call.data == 'settings_coins':
+                bot.goCoinsSettings(call)
+            else:
+                bot.helper(call)
     except Exception as e:
         logger.exception(e)
 
 
-# waits until next round hour
-def wait_until_next_hour():
-    dt = datetime.fromtimestamp(time.time())
-    dt = dt.replace(hour=dt.hour+1, minute=0, second=0, microsecond=0)
-    t = datetime.timestamp(dt)
-    while True:
-        if time.time() >= t:
-            break
+# inline mode (@bot eth); must be enabled with /setinline in @BotFather
+@bot.bot.inline_handler(lambda query: True)
+def inline_handler(query):
+    try:
+        with profiling.trace('inline', query.from_user.id):
+            bot.inline(query)
+    except Exception as e:
+        logger.exception(e)
 
 
 # sends messages to all user whose schedule coincides with the current time
 def run_schedule():
     try:
-        wait_until_next_hour()
-        bot.top_all()
-        schedule.every(1).hour.do(bot.top_all)
-        while True:
-            schedule.run_pending()
-            time.sleep(1)
+        HourlyDelivery(scheduler, bot.db, bot.top_all).start()
+        scheduler.run()
     except Exception as e:
         logger.exception(e)
 
 
-if __name__ == "__main__":
+# receives updates by long polling
+def run_polling():
+    bot.bot.remove_webhook()
     t1 = threading.Thread(target=bot.bot.polling)
     t2 = threading.Thread(target=run_schedule)
     t1.start()
-    t2.start()
\ No newline at end of file
+    t2.start()
+
+
+# receives updates on local HTTP server; Telegram (or a proxy in front of it) posts them to config.webhook_url
+def run_webhook():
+    # HTTP server is imported only in webhook mode
+    from webhook import WebhookServer
+    server = WebhookServer(
+        bot.bot,
+        host=getattr(config, 'webhook_host', '127.0.0.1'),
+        port=getattr(config, 'webhook_port', 8443),
+        path=getattr(config, 'webhook_path', '/webhook'),
+        secret=getattr(config, 'webhook_secret', None),
+        workers=getattr(config, 'webhook_workers', 8)
+    )
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stop.set())
+    signal.signal(signal.SIGINT, lambda *args: stop.set())
+    if getattr(config, 'webhook_url', None):
+        bot.bot.set_webhook(url=config.webhook_url, secret_token=getattr(config, 'webhook_secret', None))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    t2 = threading.Thread(target=run_schedule)
+    t2.start()
+    stop.wait()
+    # graceful drain: stop accepting, finish queued updates, stop scheduler
+    server.shutdown()
+    scheduler.stop()
+    t2.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', choices=['polling', 'webhook'], default=getattr(config, 'mode', 'polling'))
+    args = parser.parse_args()
+    # Prometheus endpoint; set metrics_port in config.py to enable
+    if getattr(config, 'metrics_port', None):
+        metrics.start_http_server(config.metrics_port)
+    if args.mode == 'webhook':
+        run_webhook()
+    else:
+        run_polling()
\ No newline at end of file
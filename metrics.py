@@ -0,0 +1,330 @@
+import bisect
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# seconds
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+
+
+def label_text(labels):
+    '''
+    Formats labels in Prometheus notation
+
+    :param labels - tuple of (name, value)
+    :return - text like {name="value"}
+    '''
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + '}'
+
+
+class Counter():
+
+    def __init__(self, name, description):
+        '''
+        Monotonically increasing value per label set
+
+        :param name - metric name
+        :param description - metric help text
+        '''
+        self.name = name
+        self.description = description
+        self.values = {} # labels -> value
+        self.lock = threading.Lock()
+
+
+    def inc(self, value=1, **labels):
+        '''
+        Increases counter
+
+        :param value - increment
+        :param labels - label values
+        :return:
+        '''
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+
+    def items(self):
+        '''
+        Values per label set
+
+        :return - sorted list of (labels, value)
+        '''
+        with self.lock:
+            return sorted(self.values.items())
+
+
+    def render(self):
+        '''
+        Counter in Prometheus text format
+
+        :return - list of lines
+        '''
+        lines = ['# HELP {} {}'.format(self.name, self.description), '# TYPE {} counter'.format(self.name)]
+        for key, value in self.items():
+            lines.append('{}{} {}'.format(self.name, label_text(key), value))
+        return lines
+
+
+class Gauge(Counter):
+    '''
+    Value per label set which goes up and down
+    '''
+
+    def set(self, value, **labels):
+        '''
+        Sets value
+
+        :param value - new value
+        :param labels - label values
+        :return:
+        '''
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = value
+
+
+    def render(self):
+        '''
+        Gauge in Prometheus text format
+
+        :return - list of lines
+        '''
+        lines = super().render()
+        lines[1] = '# TYPE {} gauge'.format(self.name)
+        return lines
+
+
+class Histogram():
+
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        '''
+        Distribution of observed values per label set
+
+        :param name - metric name
+        :param description - metric help text
+        :param buckets - sorted upper bounds of buckets
+        '''
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.values = {} # labels -> [bucket counts..., sum, count]
+        self.lock = threading.Lock()
+
+
+    def observe(self, value, **labels):
+        '''
+        Records observation
+
+        :param value - observed value
+        :param labels - label values
+        :return:
+        '''
+        key = tuple(sorted(labels.items()))
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = [0] * (len(self.buckets) + 3)
+            series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+
+    @contextmanager
+    def time(self, **labels):
+        '''
+        Observes duration of enclosed block in seconds
+
+        :param labels - label values
+        :return:
+        '''
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - started, **labels)
+
+
+    def summary(self):
+        '''
+        Count, mean and approximate 95th percentile per label set
+
+        :return - list of (labels, count, mean, p95)
+        '''
+        rows = []
+        with self.lock:
+            items = sorted((key, list(series)) for key, series in self.values.items())
+        for key, series in items:
+            count = series[-1]
+            target, seen, p95 = count * 0.95, 0, float('inf')
+            for bound, n in zip(self.buckets, series):
+                seen += n
+                if seen >= target:
+                    p95 = bound
+                    break
+            rows.append((key, count, series[-2] / count if count else 0, p95))
+        return rows
+
+
+    def render(self):
+        '''
+        Histogram in Prometheus text format
+
+        :return - list of lines
+        '''
+        lines = ['# HELP {} {}'.format(self.name, self.description), '# TYPE {} histogram'.format(self.name)]
+        with self.lock:
+            items = sorted((key, list(series)) for key, series in self.values.items())
+        for key, series in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + ('+Inf',), series):
+                cumulative += n
+                lines.append('{}_bucket{} {}'.format(self.name, label_text(key + (('le', bound),)), cumulative))
+            lines.append('{}_sum{} {}'.format(self.name, label_text(key), series[-2]))
+            lines.append('{}_count{} {}'.format(self.name, label_text(key), series[-1]))
+        return lines
+
+
+class Registry():
+
+    def __init__(self):
+        '''
+        Collection of metrics
+        '''
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+
+    def register(self, metric):
+        '''
+        Adds metric; returns already registered one with the same name
+
+        :param metric - Counter, Gauge or Histogram
+        :return - registered metric
+        '''
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+
+    def counter(self, name, description):
+        '''
+        Creates and registers Counter
+
+        :param name - metric name
+        :param description - metric help text
+        :return - Counter
+        '''
+        return self.register(Counter(name, description))
+
+
+    def gauge(self, name, description):
+        '''
+        Creates and registers Gauge
+
+        :param name - metric name
+        :param description - metric help text
+        :return - Gauge
+        '''
+        return self.register(Gauge(name, description))
+
+
+    def histogram(self, name, description, buckets=DEFAULT_BUCKETS):
+        '''
+        Creates and registers Histogram
+
+        :param name - metric name
+        :param description - metric help text
+        :param buckets - sorted upper bounds of buckets
+        :return - Histogram
+        '''
+        return self.register(Histogram(name, description, buckets))
+
+
+    def render(self):
+        '''
+        All metrics in Prometheus text format
+
+        :return - text
+        '''
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+cmc_requests = registry.counter('cmc_requests_total', 'CoinMarketCap requests by HTTP status')
+cmc_latency = registry.histogram('cmc_request_seconds', 'CoinMarketCap request latency')
+db_latency = registry.histogram('db_query_seconds', 'SQLite statement latency by statement type')
+telegram_latency = registry.histogram('telegram_request_seconds', 'Telegram Bot API call latency by method')
+telegram_errors = registry.counter('telegram_errors_total', 'Failed Telegram Bot API calls by method and error code')
+telegram_queue_depth = registry.gauge('telegram_queue_depth', 'Telegram calls waiting for rate budget by priority class')
+telegram_wait = registry.histogram('telegram_wait_seconds', 'Time Telegram calls waited for rate budget by priority class')
+broadcast_latency = registry.histogram('broadcast_seconds', 'Duration of broadcast runs')
+broadcast_messages = registry.counter('broadcast_messages_total', 'Broadcast messages by result')
+admission = registry.counter('admission_total', 'Commands and callbacks by admission result')
+
+
+@contextmanager
+def telegram_call(method):
+    '''
+    Records latency and errors of Telegram Bot API call
+
+    :param method - API method name
+    :return:
+    '''
+    started = perf_counter()
+    try:
+        yield
+    except Exception as e:
+        telegram_errors.inc(method=method, code=getattr(e, 'error_code', type(e).__name__))
+        raise
+    finally:
+        telegram_latency.observe(perf_counter() - started, method=method)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        '''
+        Responds with all metrics
+
+        :return:
+        '''
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def start_http_server(port, host='127.0.0.1'):
+    '''
+    Serves metrics for Prometheus at http://<host>:<port>/metrics in background thread
+
+    :param port - TCP port
+    :param host - interface to listen on
+    :return - server
+    '''
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info('metrics server started on %s:%s', host, port)
+    return server
@@ -0,0 +1,204 @@
+# Delivery of Outbox runs: in one process or sharded across worker processes
+#
+# worker usage: python outbox.py RUN_ID --shard 0 --shards 4 [--db data.db]
+# workers coordinate only through the DB file, so they can run on any host which shares it
+# every worker logs to its own file: out.shard<N>.log next to log_file
+import argparse
+import json
+import os
+import subprocess
+import sys
+from collections import deque
+from time import monotonic
+
+import telebot.apihelper
+from telebot import TeleBot
+
+from broadcast import Broadcaster
+from db_worker import DB
+from logger import get_logger, use_suffix
+
+logger = get_logger(__name__)
+
+
+def prepare_run(db, run_id, hour, render):
+    '''
+    Enqueues jobs of the run and renders its messages once, so all shards send the same snapshot
+
+    :param db - DB instance
+    :param run_id - run ID
+    :param hour - hour of schedule
+    :param render - function of list of (coins number, currency) -> dict of (coins number, currency) -> text
+    :return - number of enqueued jobs (0 for resumed run)
+    '''
+    enqueued = db.create_run(run_id, hour)
+    texts = render(db.get_run_variants(run_id))
+    db.save_run_texts(run_id, texts)
+    logger.info('run_id=%s; enqueued=%s; texts=%s', run_id, enqueued, len(texts))
+    return enqueued
+
+
+def save_results(db, run_id, results):
+    '''
+    Saves delivery results collected so far
+
+    :param db - DB instance
+    :param run_id - run ID
+    :param results - deque of (telegram ID, True/False, number of attempts)
+    :return:
+    '''
+    batch = []
+    while results:
+        batch.append(results.popleft())
+    db.finish_outbox(run_id, batch)
+
+
+def outbox_messages(db, run_id, texts, results, batch=500, shard=0, shards=1):
+    '''
+    Yields messages of pending jobs of the shard batch by batch
+
+    :param db - DB instance
+    :param run_id - run ID
+    :param texts - dict of (coins number, currency) -> text of every pending job
+    :param results - deque of (telegram ID, True/False, number of attempts) to save
+    :param batch - jobs claimed at once; at most this many are lost (not duplicated) on crash
+    :param shard - number of shard
+    :param shards - number of shards
+    :return - generator of (telegram ID, text)
+    '''
+    while True:
+        save_results(db, run_id, results)
+        jobs = db.claim_outbox(run_id, batch, shard, shards)
+        if not jobs:
+            return
+        for tg_id, coins_number, currency in jobs:
+            yield tg_id, texts[coins_number, currency]
+
+
+def deliver_shard(db, broadcaster, run_id, shard=0, shards=1, batch=500):
+    '''
+    Sends pending jobs of the shard
+
+    :param db - DB instance
+    :param broadcaster - Broadcaster instance
+    :param run_id - run ID
+    :param shard - number of shard
+    :param shards - number of shards
+    :param batch - jobs claimed at once
+    :return - broadcast stats
+    '''
+    logger.info('run_id=%s; shard=%s/%s', run_id, shard, shards)
+    texts = db.get_run_texts(run_id)
+    results = deque() # filled by broadcast workers, saved by outbox_messages()
+    stats = broadcaster.send(outbox_messages(db, run_id, texts, results, batch, shard, shards),
+                             on_result=lambda *result: results.append(result), parse_mode='HTML')
+    save_results(db, run_id, results)
+    return stats
+
+
+class ShardedDelivery():
+
+    def __init__(self, filename, shards=4, workers=8, rate=30, batch=500, api_url=None, attempts=3):
+        '''
+        Coordinator which sends a run with <shards> worker processes, one per tg_id % shards;
+        Telegram limit is global per bot, so every worker gets rate / shards
+
+        :param filename - DB file shared with workers
+        :param shards - number of worker processes
+        :param workers - sending threads per process
+        :param rate - total messages per second
+        :param batch - jobs claimed at once by every process
+        :param api_url - Telegram Bot API URL template passed to workers (telebot.apihelper.API_URL)
+        :param attempts - runs of a failing shard worker; the rerun sends jobs its predecessor left pending
+        '''
+        self.filename = filename
+        self.shards = shards
+        self.workers = workers
+        self.rate = rate
+        self.batch = batch
+        self.api_url = api_url
+        self.attempts = attempts
+
+
+    def command(self, run_id, shard):
+        '''
+        Command line of worker process
+
+        :param run_id - run ID
+        :param shard - number of shard
+        :return - list of arguments
+        '''
+        command = [sys.executable, os.path.abspath(__file__), run_id, '--shard', str(shard), '--shards', str(self.shards),
+                   '--db', self.filename, '--workers', str(self.workers), '--rate', str(self.rate / self.shards), '--batch', str(self.batch)]
+        if self.api_url:
+            command += ['--api-url', self.api_url]
+        return command
+
+
+    def send(self, run_id):
+        '''
+        Runs worker of every shard and waits for all of them; failed workers are run again,
+        since the slot is marked delivered once this returns
+
+        :param run_id - run ID (prepared by prepare_run)
+        :return - broadcast stats summed over shards; failed_shards - shards which failed every attempt
+        '''
+        logger.info('run_id=%s; shards=%s', run_id, self.shards)
+        started = monotonic()
+        stats = {'sent': 0, 'failed': 0, 'retried': 0}
+        pending = list(range(self.shards))
+        for attempt in range(1, self.attempts + 1):
+            processes = {shard: subprocess.Popen(self.command(run_id, shard), stdout=subprocess.PIPE, text=True) for shard in pending}
+            pending = []
+            for shard, process in processes.items():
+                out, _ = process.communicate()
+                if process.returncode:
+                    # jobs it had claimed are lost (not duplicated); unclaimed ones are sent by the rerun
+                    logger.error('shard worker failed; shard=%s; attempt=%s; returncode=%s', shard, attempt, process.returncode)
+                    pending.append(shard)
+                    continue
+                for key, value in json.loads(out.splitlines()[-1]).items():
+                    if key in stats:
+                        stats[key] += value
+            if not pending:
+                break
+        if pending:
+            logger.error('shards failed every attempt; run_id=%s; shards=%s', run_id, pending)
+        stats['failed_shards'] = pending
+        stats['seconds'] = round(monotonic() - started, 3)
+        stats['rate'] = round(stats['sent'] / stats['seconds'], 2) if stats['seconds'] else 0
+        logger.info('sharded broadcast finished; %s', stats)
+        return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sends one shard of an Outbox run')
+    parser.add_argument('run_id')
+    parser.add_argument('--shard', type=int, default=0)
+    parser.add_argument('--shards', type=int, default=1)
+    parser.add_argument('--db', default='data.db')
+    parser.add_argument('--workers', type=int, default=8, help='sending threads')
+    parser.add_argument('--rate', type=float, default=30, help='messages per second of this shard')
+    parser.add_argument('--batch', type=int, default=500, help='jobs claimed at once')
+    parser.add_argument('--api-url', help='Telegram Bot API URL template')
+    args = parser.parse_args()
+    if not 0 <= args.shard < args.shards:
+        parser.error('shard must be in [0, shards)')
+    # workers of a run write at once; a shared rotating file would be rotated by each of them
+    use_suffix('shard{}'.format(args.shard))
+
+    from config import token
+    if args.api_url:
+        telebot.apihelper.API_URL = args.api_url
+    db = DB(args.db)
+    try:
+        broadcaster = Broadcaster(TeleBot(token=token), workers=args.workers, rate=args.rate)
+        stats = deliver_shard(db, broadcaster, args.run_id, args.shard, args.shards, args.batch)
+    finally:
+        db.close()
+    # last line of stdout is read by ShardedDelivery
+    print(json.dumps(stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,346 @@
+# Opt-in tracing of handlers and on-demand profiles of the live process
+#
+# environment: PROFILE=1 enables tracing at start; PROFILE_SLOW_MS - threshold of slow operations (500);
+# PROFILE_SAMPLE - share of handler calls traced (1.0); admins switch it with /profile at runtime
+import cProfile
+import io
+import os
+import pstats
+import random
+import sys
+import threading
+import tracemalloc
+from collections import Counter, deque
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from time import perf_counter, sleep, strftime
+
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+CURRENT = ContextVar('trace', default=None) # Trace of running handler
+NOOP = nullcontext()
+
+
+class Trace():
+
+    def __init__(self, name, chat_id):
+        '''
+        Spans of one handler call; used by one thread (or task) only
+
+        :param name - handler name (e.g. command)
+        :param chat_id - telegram chat ID
+        '''
+        self.name = name
+        self.chat_id = chat_id
+        self.started = perf_counter()
+        self.seconds = 0
+        self.stack = [] # names of open spans
+        self.spans = {} # path of names -> [count, seconds, offset of first start]
+
+
+    def breakdown(self):
+        '''
+        Spans ordered by first start, nested ones as parent>child
+
+        :return - text
+        '''
+        parts = []
+        for path, (count, seconds, _) in sorted(self.spans.items(), key=lambda item: item[1][2]):
+            parts.append('{} {:.1f}ms{}'.format('>'.join(path), seconds * 1000, ' x{}'.format(count) if count > 1 else ''))
+        # time not covered by top-level spans (own code of handler)
+        own = self.seconds - sum(seconds for path, (_, seconds, _) in self.spans.items() if len(path) == 1)
+        parts.append('own {:.1f}ms'.format(own * 1000))
+        return '; '.join(parts)
+
+
+class Span():
+
+    __slots__ = ('trace', 'name', 'started')
+
+    def __init__(self, trace, name):
+        '''
+        Timed part of traced handler
+
+        :param trace - Trace
+        :param name - operation name
+        '''
+        self.trace = trace
+        self.name = name
+
+
+    def __enter__(self):
+        self.trace.stack.append(self.name)
+        self.started = perf_counter()
+
+
+    def __exit__(self, *exc):
+        seconds = perf_counter() - self.started
+        trace = self.trace
+        path = tuple(trace.stack)
+        trace.stack.pop()
+        entry = trace.spans.get(path)
+        if entry is None:
+            trace.spans[path] = [1, seconds, self.started - trace.started]
+        else:
+            entry[0] += 1
+            entry[1] += seconds
+
+
+class Tracer():
+
+    def __init__(self, enabled=False, slow=0.5, sample=1.0, keep=20):
+        '''
+        Span tracing of handlers: calls slower than <slow> are logged with breakdown by span
+        and kept for /profile; costs one context variable lookup per span when disabled
+
+        :param enabled - trace handler calls
+        :param slow - seconds of slow handler call
+        :param sample - share of handler calls traced [0-1]
+        :param keep - number of kept slow traces
+        '''
+        self.enabled = enabled
+        self.slow = slow
+        self.sample = sample
+        self.recent = deque(maxlen=keep) # slow traces, newest last
+        self.window = None # cProfile.Profile of every handler call while cpu profile is taken
+        self.unprofiled = 0 # handler calls of the window run without profile
+        self.lock = threading.Lock()
+
+
+    def configure(self, enabled, slow=None, sample=None):
+        '''
+        Switches tracing at runtime
+
+        :param enabled - True/False
+        :param slow - seconds of slow handler call; None - unchanged
+        :param sample - share of handler calls traced; None - unchanged
+        :return:
+        '''
+        logger.info('enabled=%s; slow=%s; sample=%s', enabled, slow, sample)
+        self.enabled = enabled
+        if slow is not None:
+            self.slow = slow
+        if sample is not None:
+            self.sample = sample
+
+
+    @contextmanager
+    def trace(self, name, chat_id=None):
+        '''
+        Traces handler call; nested calls are spans of the outer one
+
+        :param name - handler name (e.g. command)
+        :param chat_id - telegram chat ID
+        :return:
+        '''
+        if CURRENT.get() is not None:
+            with self.span(name):
+                yield
+            return
+        trace = Trace(name, chat_id) if self.enabled and random.random() < self.sample else None
+        token = CURRENT.set(trace) if trace else None
+        window = self.window
+        profile = None
+        if window is not None:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # python 3.12+ allows one active profiler at a time; concurrent calls run unprofiled
+                profile = None
+                self.unprofiled += 1
+        try:
+            yield
+        finally:
+            if profile:
+                profile.disable()
+                window.append(profile)
+            if trace:
+                CURRENT.reset(token)
+                self.finish(trace)
+
+
+    def span(self, name):
+        '''
+        Times enclosed block as part of running trace
+
+        :param name - operation name, e.g. db.SELECT
+        :return - context manager
+        '''
+        trace = CURRENT.get()
+        if trace is None:
+            return NOOP
+        return Span(trace, name)
+
+
+    def finish(self, trace):
+        '''
+        Logs trace if it's slow
+
+        :param trace - finished Trace
+        :return:
+        '''
+        trace.seconds = perf_counter() - trace.started
+        if trace.seconds < self.slow:
+            return
+        self.recent.append(trace)
+        logger.warning('slow %s; chat_id=%s; %.1fms; %s', trace.name, trace.chat_id, trace.seconds * 1000, trace.breakdown())
+
+
+    def slow_text(self):
+        '''
+        Recent slow traces, newest first
+
+        :return - text
+        '''
+        lines = []
+        for trace in reversed(self.recent):
+            lines.append('{} {:.0f}ms chat_id={}: {}'.format(trace.name, trace.seconds * 1000, trace.chat_id, trace.breakdown()))
+        return '\n'.join(lines)
+
+
+    def cpu(self, seconds):
+        '''
+        cProfile of all handler calls during <seconds>
+
+        :param seconds - length of window
+        :return - pstats.Stats or None if no handler was called
+        '''
+        with self.lock:
+            if self.window is not None:
+                raise RuntimeError('cpu profile is already being taken')
+            window = self.window = []
+            self.unprofiled = 0
+        try:
+            sleep(seconds)
+        finally:
+            self.window = None
+        # handlers still running append to the old list; only finished ones are read
+        profiles = list(window)
+        if not profiles:
+            return None
+        return pstats.Stats(*profiles)
+
+
+tracer = Tracer(
+    enabled=os.environ.get('PROFILE') == '1',
+    slow=float(os.environ.get('PROFILE_SLOW_MS', 500)) / 1000,
+    sample=float(os.environ.get('PROFILE_SAMPLE', 1))
+)
+trace = tracer.trace
+span = tracer.span
+
+
+def dump_path(directory, kind, extension):
+    '''
+    File name of a profile dump
+
+    :param directory - directory of dumps
+    :param kind - cpu, stacks or memory
+    :param extension - file extension
+    :return - path
+    '''
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, '{}-{}-{}.{}'.format(kind, strftime('%Y%m%d-%H%M%S'), os.getpid(), extension))
+
+
+def cpu_profile(seconds, directory='profiles', top=15):
+    '''
+    cProfile of handler calls for <seconds>; dump is readable by pstats or snakeviz
+
+    :param seconds - length of window
+    :param directory - directory of dumps
+    :param top - number of functions in summary
+    :return - (path or None, summary text)
+    '''
+    logger.info('seconds=%s', seconds)
+    stats = tracer.cpu(seconds)
+    if stats is None:
+        return None, 'no handler calls'
+    path = dump_path(directory, 'cpu', 'prof')
+    stats.dump_stats(path)
+    stream = io.StringIO()
+    if tracer.unprofiled:
+        stream.write('handler calls not profiled (concurrent with profiled ones): {}\n'.format(tracer.unprofiled))
+    stats.stream = stream
+    stats.sort_stats('cumulative').print_stats(top)
+    return path, stream.getvalue()
+
+
+def sample_stacks(seconds, directory='profiles', interval=0.005, top=15):
+    '''
+    Sampling profiler of all threads: stacks are read every <interval> seconds, so the process isn't slowed down;
+    dump has one "frame;frame;... count" line per stack (flamegraph.pl / speedscope format)
+
+    :param seconds - length of window
+    :param directory - directory of dumps
+    :param interval - seconds between samples
+    :param top - number of functions in summary
+    :return - (path, summary text)
+    '''
+    logger.info('seconds=%s', seconds)
+    own = threading.get_ident()
+    stacks = Counter()
+    names = {} # code object -> frame name
+    deadline = perf_counter() + seconds
+    while perf_counter() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                name = names.get(code)
+                if name is None:
+                    name = names[code] = '{}:{}'.format(os.path.basename(code.co_filename), code.co_name)
+                stack.append(name)
+                frame = frame.f_back
+            stacks[';'.join(reversed(stack))] += 1
+        sleep(interval)
+    path = dump_path(directory, 'stacks', 'txt')
+    with open(path, 'w') as f:
+        for stack, count in stacks.most_common():
+            f.write('{} {}\n'.format(stack, count))
+    # where threads are (idle threads show their blocking call)
+    leaves = Counter()
+    for stack, count in stacks.items():
+        leaves[stack.rsplit(';', 1)[-1]] += count
+    total = sum(stacks.values()) or 1
+    return path, '\n'.join('{:5.1f}% {}'.format(count * 100 / total, name) for name, count in leaves.most_common(top))
+
+
+def memory_profile(seconds, directory='profiles', top=15):
+    '''
+    Memory allocated during <seconds> by source line (tracemalloc)
+
+    :param seconds - length of window
+    :param directory - directory of dumps
+    :param top - number of lines in summary
+    :return - (path, summary text)
+    '''
+    logger.info('seconds=%s', seconds)
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start(10)
+    try:
+        before = tracemalloc.take_snapshot()
+        sleep(seconds)
+        after = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        if started:
+            tracemalloc.stop()
+    path = dump_path(directory, 'memory', 'txt')
+    own = (tracemalloc.Filter(False, tracemalloc.__file__),)
+    diff = after.filter_traces(own).compare_to(before.filter_traces(own), 'lineno')
+    with open(path, 'w') as f:
+        for stat in diff:
+            f.write('{}\n'.format(stat))
+    lines = ['traced: {:.1f}MiB; peak: {:.1f}MiB'.format(current / 2**20, peak / 2**20)]
+    lines += [str(stat) for stat in diff[:top]]
+    return path, '\n'.join(lines)
+
+
+PROFILES = {'cpu': cpu_profile, 'stacks': sample_stacks, 'memory': memory_profile}
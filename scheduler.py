@@ -0,0 +1,171 @@
+import heapq
+import itertools
+import threading
+from datetime import datetime, timedelta
+from time import time
+
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+
+def hour_slot(timestamp):
+    '''
+    Gets start of the hour which contains timestamp
+
+    :param timestamp - unix time
+    :return - datetime of round hour
+    '''
+    return datetime.fromtimestamp(timestamp).replace(minute=0, second=0, microsecond=0)
+
+
+def run_id(slot):
+    '''
+    Gets ID of scheduled delivery run (key of its Outbox jobs)
+
+    :param slot - datetime of round hour
+    :return - e.g. '2024-01-31T08'
+    '''
+    return slot.strftime('%Y-%m-%dT%H')
+
+
+class Scheduler():
+
+    def __init__(self):
+        '''
+        Timer loop which sleeps until the earliest job is due
+        '''
+        self.jobs = [] # heap of (due time, sequence number, function, args)
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.stopped = False
+
+
+    def at(self, due, func, *args):
+        '''
+        Schedules function call
+
+        :param due - unix time of call
+        :param func - function
+        :param args - function arguments
+        :return:
+        '''
+        with self.condition:
+            heapq.heappush(self.jobs, (due, next(self.counter), func, args))
+            self.condition.notify()
+
+
+    def stop(self):
+        '''
+        Stops loop
+
+        :return:
+        '''
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+
+    def run(self):
+        '''
+        Runs due jobs until stopped
+
+        :return:
+        '''
+        while True:
+            with self.condition:
+                while not self.stopped:
+                    if self.jobs:
+                        delay = self.jobs[0][0] - time()
+                        if delay <= 0:
+                            break
+                        self.condition.wait(timeout=delay)
+                    else:
+                        self.condition.wait()
+                if self.stopped:
+                    return
+                due, _, func, args = heapq.heappop(self.jobs)
+            try:
+                func(*args)
+            except Exception as e:
+                logger.exception(e)
+
+
+class HourlyDelivery():
+
+    def __init__(self, scheduler, db, deliver, max_catch_up=3):
+        '''
+        Triggers delivery at every round hour; catches up hours missed while bot was down
+
+        :param scheduler - Scheduler instance
+        :param db - DB instance (keeps last delivered hour)
+        :param deliver - function called with hour and run ID of the slot
+        :param max_catch_up - max number of missed hours delivered after restart
+        '''
+        self.scheduler = scheduler
+        self.db = db
+        self.deliver = deliver
+        self.max_catch_up = max_catch_up
+
+
+    def missed_slots(self):
+        '''
+        Gets slots which were not delivered since the last delivery (at most max_catch_up newest ones)
+
+        :return - list of datetimes of round hours
+        '''
+        current = hour_slot(time())
+        last = self.db.get_meta('last_delivery')
+        missed = []
+        if last is not None:
+            slot = datetime.fromtimestamp(float(last)) + timedelta(hours=1)
+            while slot <= current:
+                missed.append(slot)
+                slot += timedelta(hours=1)
+            if len(missed) > self.max_catch_up:
+                logger.warning('skipped slots: %s', missed[:-self.max_catch_up])
+                missed = missed[-self.max_catch_up:]
+        return missed
+
+
+    def mark(self, slot):
+        '''
+        Remembers slot as delivered
+
+        :param slot - datetime of round hour
+        :return:
+        '''
+        last = self.db.get_meta('last_delivery')
+        if last is None or float(last) < datetime.timestamp(slot):
+            self.db.set_meta('last_delivery', datetime.timestamp(slot))
+
+
+    def start(self):
+        '''
+        Schedules missed slots and the next round hour
+
+        :return:
+        '''
+        for slot in self.missed_slots():
+            logger.info('catch up slot: %s', slot)
+            self.scheduler.at(time(), self.run_slot, slot, False)
+        nxt = hour_slot(time()) + timedelta(hours=1)
+        self.scheduler.at(datetime.timestamp(nxt), self.run_slot, nxt, True)
+
+
+    def run_slot(self, slot, reschedule):
+        '''
+        Delivers slot and remembers it as done
+
+        :param slot - datetime of round hour
+        :param reschedule - whether to schedule the next round hour
+        :return:
+        '''
+        if reschedule:
+            # scheduled before delivery so a long broadcast can't shift the timer
+            nxt = slot + timedelta(hours=1)
+            self.scheduler.at(datetime.timestamp(nxt), self.run_slot, nxt, True)
+        try:
+            self.deliver(slot.hour, run_id(slot))
+        finally:
+            self.mark(slot)
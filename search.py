@@ -0,0 +1,115 @@
+import threading
+from bisect import bisect_left, insort
+
+import profiling
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class PrefixIndex():
+
+    def __init__(self):
+        '''
+        Coins looked up by prefix of symbol or name: sorted list of (lowercase key, coin ID),
+        so all keys with a prefix are one contiguous range found by binary search
+        '''
+        self.keys = [] # sorted [(key, coin ID)]
+        self.coins = {} # coin ID -> (rank, symbol, name, price, percent change 24h)
+        self.scan = 8 # ranges longer than scan * limit are searched by rank order
+        self.broad = {} # (prefix, limit) -> result of such search; valid until next update
+        self.lock = threading.Lock()
+
+
+    @staticmethod
+    def entries(coin_id, symbol, name):
+        '''
+        Index keys of a coin
+
+        :param coin_id - CoinMarketCap ID
+        :param symbol - coin symbol
+        :param name - coin name
+        :return - set of (key, coin ID)
+        '''
+        return {(symbol.lower(), coin_id), (name.lower(), coin_id)}
+
+
+    def update(self, response):
+        '''
+        Listener of new listings snapshots; only keys of added, removed and renamed coins are touched
+
+        :param response - API response with rows
+        :return:
+        '''
+        coins = {row[0]: (rank,) + tuple(row[1:]) for rank, row in enumerate(response['rows'], 1)}
+        with self.lock:
+            old = set()
+            for coin_id, coin in self.coins.items():
+                if coin_id not in coins or coins[coin_id][1:3] != coin[1:3]:
+                    old |= self.entries(coin_id, coin[1], coin[2])
+            new = set()
+            for coin_id, coin in coins.items():
+                if coin_id not in self.coins or self.coins[coin_id][1:3] != coin[1:3]:
+                    new |= self.entries(coin_id, coin[1], coin[2])
+            for entry in old - new:
+                i = bisect_left(self.keys, entry)
+                if i < len(self.keys) and self.keys[i] == entry:
+                    del self.keys[i]
+            if len(new) > len(self.keys) // 4:
+                # first snapshot or big change; one sort is cheaper than many inserts
+                self.keys = sorted(set(self.keys) | new)
+            else:
+                for entry in new - old:
+                    insort(self.keys, entry)
+            # prices and ranks change every snapshot; keys don't
+            self.coins = coins # ordered by rank
+            self.broad = {}
+        logger.debug('index updated; coins=%s; keys=%s; removed=%s; added=%s', len(coins), len(self.keys), len(old - new), len(new - old))
+
+
+    def search(self, query, limit=10):
+        '''
+        Coins whose symbol or name starts with query; exact symbol first, then by rank
+
+        :param query - text typed by user
+        :param limit - max number of coins
+        :return - list of (rank, symbol, name, price, percent change 24h)
+        '''
+        prefix = query.strip().lower()
+        if not prefix:
+            return []
+        with profiling.span('index.search'), self.lock:
+            keys = self.keys
+            i = bisect_left(keys, (prefix,))
+            j = bisect_left(keys, (prefix + '\U0010ffff',), i)
+            if j - i <= self.scan * limit:
+                coins = [self.coins[coin_id] for coin_id in {coin_id for _, coin_id in keys[i:j]}]
+            elif (prefix, limit) in self.broad:
+                return self.broad[prefix, limit]
+            else:
+                # short prefix of many coins (first keystrokes); walking them by rank stops after a few matches
+                coins = []
+                for coin in self.coins.values():
+                    if coin[1].lower().startswith(prefix) or coin[2].lower().startswith(prefix):
+                        coins.append(coin)
+                        if len(coins) == limit:
+                            break
+                while i < j and keys[i][0] == prefix:
+                    coins.append(self.coins[keys[i][1]])
+                    i += 1
+                self.broad[prefix, limit] = self.rank(coins, prefix, limit)
+                return self.broad[prefix, limit]
+        return self.rank(coins, prefix, limit)
+
+
+    @staticmethod
+    def rank(coins, prefix, limit):
+        '''
+        Orders found coins: exact symbol first, then by rank
+
+        :param coins - list of (rank, symbol, name, price, percent change 24h)
+        :param prefix - lowercase query
+        :param limit - max number of coins
+        :return - list of (rank, symbol, name, price, percent change 24h)
+        '''
+        return sorted(set(coins), key=lambda coin: (coin[1].lower() != prefix, coin[0]))[:limit]
@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+import types
+
+# modules read settings from config.py (not in repo); tests get a stub which keeps the log out of the tree
+config = types.ModuleType('config')
+config.token = '1:test'
+config.cmc_key = 'test'
+config.base_url = 'http://127.0.0.1:9'
+config.log_file = os.path.join(tempfile.gettempdir(), 'crypto-bot-tests.log')
+sys.modules.setdefault('config', config)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
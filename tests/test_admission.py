@@ -0,0 +1,102 @@
+from time import time
+
+from admission import Admission, ADMITTED, DUPLICATE, THROTTLED, SHED
+from broadcast import PRIORITIES, INTERACTIVE
+
+
+class Sender():
+    # stand-in for PrioritySender; only the number of waiting replies is read
+    def __init__(self):
+        self.waiting = [0] * len(PRIORITIES)
+
+
+def admission(**kwargs):
+    # tokens aren't refilled during a test
+    kwargs.setdefault('rate', 0.001)
+    return Admission(**kwargs)
+
+
+def admit(admission, chat_id, text, sent=None):
+    result = admission.check(chat_id, text, sent)
+    if result == ADMITTED:
+        admission.done(chat_id, text)
+    return result
+
+
+def test_burst_then_throttled():
+    notices = []
+    control = admission(burst=3, on_throttled=lambda chat_id, wait: notices.append(chat_id))
+    assert [admit(control, 1, '/top {}'.format(i)) for i in range(5)] == [ADMITTED] * 3 + [THROTTLED] * 2
+    # chats have own buckets
+    assert admit(control, 2, '/top') == ADMITTED
+    # one notice per notice_interval
+    assert notices == [1]
+
+
+def test_running_command_is_duplicate():
+    control = admission()
+    assert control.check(1, '/top') == ADMITTED
+    assert control.check(1, '/TOP ') == DUPLICATE
+    assert control.check(1, '/settings') == ADMITTED
+    assert control.check(2, '/top') == ADMITTED
+    control.done(1, '/top')
+    assert control.check(1, '/top', sent=int(time()) + 1) == ADMITTED
+
+
+def test_message_sent_before_reply_is_duplicate():
+    control = admission()
+    sent = int(time()) - 5
+    assert admit(control, 1, '/top', sent) == ADMITTED
+    # impatient user repeated the command before the reply came
+    assert admit(control, 1, '/top', sent + 1) == DUPLICATE
+    assert admit(control, 1, '/top', int(time()) + 1) == ADMITTED
+
+
+def test_double_click_of_callback_is_duplicate():
+    control = admission()
+    assert admit(control, 1, 'callback settings_coins') == ADMITTED
+    assert admit(control, 1, 'callback settings_coins') == DUPLICATE
+    control.finished[1, 'callback settings_coins'] -= 2
+    assert admit(control, 1, 'callback settings_coins') == ADMITTED
+
+
+def test_old_message_is_shed_while_busy():
+    sender = Sender()
+    control = admission(sender=sender, max_waiting=10, max_age=30)
+    sender.waiting[PRIORITIES.index(INTERACTIVE)] = 6
+    assert admit(control, 1, '/top', int(time()) - 60) == SHED
+    assert admit(control, 1, '/top', int(time())) == ADMITTED
+
+
+def test_old_message_of_idle_bot_is_served():
+    # backlog delivered after a restart or outage
+    sender = Sender()
+    control = admission(sender=sender, max_waiting=10, max_age=30)
+    sender.waiting[PRIORITIES.index(INTERACTIVE)] = 5
+    assert admit(control, 1, '/top', int(time()) - 600) == ADMITTED
+    assert admit(admission(max_age=30), 1, '/top', int(time()) - 600) == ADMITTED
+
+
+def test_overloaded_sender_sheds():
+    sender = Sender()
+    control = admission(sender=sender, max_waiting=10)
+    sender.waiting[PRIORITIES.index(INTERACTIVE)] = 11
+    assert admit(control, 1, '/top') == SHED
+    sender.waiting[PRIORITIES.index(INTERACTIVE)] = 10
+    assert admit(control, 1, '/top') == ADMITTED
+
+
+def test_exempt_chat_is_always_admitted():
+    control = admission(burst=1, exempt=[1])
+    assert [control.check(1, '/stats', int(time()) - 60) for _ in range(3)] == [ADMITTED] * 3
+
+
+def test_admit_runs_handler_only_if_admitted():
+    control = admission(burst=1)
+    with control.admit(1, '/top') as admitted:
+        assert admitted
+        with control.admit(1, '/top') as again:
+            assert not again
+    assert control.running == set()
+    with control.admit(1, '/n 10') as admitted:
+        assert not admitted
@@ -0,0 +1,89 @@
+import threading
+
+from alerts import AlertEngine, AlertIndex
+
+
+def index(*alerts):
+    index = AlertIndex()
+    for alert_id, (symbol, op, threshold) in enumerate(alerts, 1):
+        index.add(alert_id, 100 + alert_id, symbol, op, threshold)
+    return index
+
+
+def ids(triggered):
+    return sorted(alert[0] for alert in triggered)
+
+
+def test_price_at_threshold_does_not_trigger():
+    alerts = index(('BTC', '>', 70000), ('BTC', '<', 70000))
+    assert alerts.trigger('BTC', 70000) == []
+    assert len(alerts.alerts) == 2
+
+
+def test_crossing_threshold_triggers_once():
+    alerts = index(('BTC', '>', 70000), ('BTC', '<', 60000))
+    assert alerts.trigger('BTC', 70000.01) == [(1, 101, 'BTC', '>', 70000)]
+    assert alerts.trigger('BTC', 59999.99) == [(2, 102, 'BTC', '<', 60000)]
+    # alerts are one-shot
+    assert alerts.trigger('BTC', 80000) == []
+    assert alerts.trigger('BTC', 50000) == []
+    assert alerts.alerts == {}
+
+
+def test_only_crossed_thresholds_trigger():
+    alerts = index(('BTC', '>', 10), ('BTC', '>', 20), ('BTC', '>', 30), ('BTC', '<', 5), ('BTC', '<', 15))
+    assert ids(alerts.trigger('BTC', 20)) == [1]
+    assert ids(alerts.trigger('BTC', 20.5)) == [2]
+    assert ids(alerts.trigger('BTC', 5)) == [5]
+    assert sorted(alerts.alerts) == [3, 4]
+
+
+def test_equal_thresholds_of_several_users():
+    alerts = index(('ETH', '<', 3000), ('ETH', '<', 3000), ('ETH', '>', 3000))
+    assert ids(alerts.trigger('ETH', 2999)) == [1, 2]
+    assert ids(alerts.trigger('ETH', 3001)) == [3]
+
+
+def test_other_symbol_does_not_trigger():
+    alerts = index(('BTC', '>', 1))
+    assert alerts.trigger('ETH', 100) == []
+    assert ids(alerts.trigger('BTC', 100)) == [1]
+
+
+def test_removed_alert_does_not_trigger():
+    alerts = index(('BTC', '>', 10), ('BTC', '>', 10))
+    alerts.remove(1)
+    alerts.remove(1)
+    alerts.remove(42)
+    assert ids(alerts.trigger('BTC', 11)) == [2]
+
+
+class FakeDB():
+    def get_alerts(self, tg_id=None):
+        return []
+
+    def delete_alerts(self, ids, tg_id=None):
+        return True
+
+
+class FakeBroadcaster():
+    def __init__(self):
+        self.messages = []
+        self.sent = threading.Event()
+
+    def send(self, messages, **kwargs):
+        self.messages.extend(messages)
+        self.sent.set()
+
+
+def test_notification_of_sub_cent_coin():
+    broadcaster = FakeBroadcaster()
+    engine = AlertEngine(FakeDB(), broadcaster)
+    engine.loaded.wait(5)
+    engine.index.add(1, 7, 'SHIB', '<', 0.00001)
+    engine.index.add(2, 8, '<B>', '>', 1)
+    engine.check({'quotes': [('SHIB', 0.00000912), ('<B>', 2.5)]})
+    assert broadcaster.sent.wait(5)
+    texts = dict(broadcaster.messages)
+    assert texts[7].endswith('<code>SHIB &lt; 1e-05</code> now $0.00000912')
+    assert texts[8].endswith('<code>&lt;B&gt; &gt; 1</code> now $2.50')
@@ -0,0 +1,54 @@
+import json
+import math
+
+from api import CreditPlanner, parse_listings
+
+
+def test_budget_is_split_between_consumers():
+    planner = CreditPlanner(1000)
+    planner.register('top', 0.8)
+    planner.register('full', 0.2)
+    assert planner.left('top') == 800
+    assert planner.left('full') == 200
+    planner.spend(150, 'full')
+    assert planner.left('full') == 50
+    # one consumer's spending doesn't shrink the other's part
+    assert planner.left('top') == 800
+    assert planner.left() == 850
+
+
+def test_request_is_priced_with_own_converts():
+    planner = CreditPlanner(1000)
+    planner.register('full')
+    planner.want('EUR')
+    planner.want('GBP')
+    assert planner.cost(5000, ('USD',)) == 25
+    assert planner.cost(100, planner.converts()) == 3
+    assert planner.affordable(5000, ('USD',), 'full')
+
+
+def test_spent_budget_stops_refresh_till_next_day():
+    planner = CreditPlanner(100, ttl=60)
+    planner.register('full')
+    assert planner.ttl(5000, ('USD',), 'full') >= 60
+    planner.spend(90, 'full')
+    assert planner.ttl(5000, ('USD',), 'full') == math.inf
+    assert not planner.affordable(5000, ('USD',), 'full')
+
+
+def test_no_budget():
+    planner = CreditPlanner(None, ttl=60)
+    planner.register('top')
+    assert planner.left('top') is None
+    assert planner.ttl(100, ('USD', 'EUR'), 'top') == 60
+
+
+def test_listing_without_texts():
+    content = json.dumps({'status': {'credit_count': 1}, 'data': [
+        {'id': 1, 'symbol': 'BTC', 'name': 'Bitcoin', 'quote': {'USD': {'price': 70000.0, 'percent_change_24h': 1.5}}},
+    ]}).encode()
+    response = parse_listings(content, texts=False)
+    assert response['coins'] == [] and response['currencies'] == {}
+    assert response['quotes'] == [('BTC', 70000.0)]
+    assert response['rows'] == [(1, 'BTC', 'Bitcoin', 70000.0, 1.5)]
+    assert parse_listings(content)['coins'] == ['\n<code>BTC - $70000.00</code>']
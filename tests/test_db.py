@@ -0,0 +1,117 @@
+import sqlite3
+import threading
+
+import pytest
+
+from db_worker import DB, GroupCommitWriter, ALL_HOURS
+
+# tables of the bot's first release; Users and Settings aren't created by DB
+OLD_SCHEMA = '''
+CREATE TABLE Users (id INTEGER PRIMARY KEY AUTOINCREMENT, tg_id INTEGER UNIQUE NOT NULL);
+CREATE TABLE Settings (user_id INTEGER PRIMARY KEY REFERENCES Users(id), coins_number INTEGER NOT NULL DEFAULT 10);
+CREATE TABLE Notify_Time (user_id INTEGER NOT NULL REFERENCES Users(id), hour INTEGER NOT NULL);
+'''
+
+
+def old_db(filename, schedules):
+    con = sqlite3.connect(filename)
+    con.executescript(OLD_SCHEMA)
+    for user_id, hours in schedules.items():
+        con.execute('INSERT INTO Users (id, tg_id) VALUES (?, ?)', (user_id, 1000 + user_id))
+        con.execute('INSERT INTO Settings (user_id) VALUES (?)', (user_id,))
+        con.executemany('INSERT INTO Notify_Time (user_id, hour) VALUES (?, ?)', ((user_id, hour) for hour in hours))
+    con.commit()
+    con.close()
+
+
+@pytest.fixture
+def filename(tmp_path):
+    return str(tmp_path / 'data.db')
+
+
+def test_notify_time_is_migrated_to_schedule_mask(filename):
+    old_db(filename, {1: [8, 12, 18], 2: range(24), 3: [], 4: [5, 5, 0]})
+    db = DB(filename)
+    try:
+        assert db.get_schedule(1001) == [8, 12, 18]
+        assert db.get_schedule(1002) == list(range(24))
+        # user without rows had no notifications
+        assert db.get_schedule(1003) == []
+        # duplicated rows are counted once
+        assert db.get_schedule(1004) == [0, 5]
+        assert sorted(db.get_recipients(5)) == [(1002, 10), (1004, 10)]
+        assert db.get_currency(1001) == 'USD'
+        assert not db.query("SELECT name FROM sqlite_master WHERE name='Notify_Time'")
+    finally:
+        db.close()
+
+
+def test_migrated_db_opens_again(filename):
+    old_db(filename, {1: [8]})
+    DB(filename).close()
+    db = DB(filename)
+    try:
+        assert db.get_schedule(1001) == [8]
+        db.add_user(2002)
+        assert db.query('SELECT schedule_mask FROM Settings JOIN Users ON id=user_id WHERE tg_id=2002') == [(ALL_HOURS,)]
+    finally:
+        db.close()
+
+
+def test_setting_saved_during_read_through_is_kept(filename):
+    old_db(filename, {1: [8]})
+    db = DB(filename)
+    try:
+        query = db.query
+
+        def racing_query(sql, iterable=()):
+            rows = query(sql, iterable)
+            if sql.startswith('SELECT coins_number'):
+                # user changes the setting after our SELECT returned the old value
+                db.save_settings(1001, 'coins_number', 50)
+            return rows
+
+        db.query = racing_query
+        assert db.get_top_coins_number(1001) == 50
+        assert db.get_top_coins_number(1001) == 50
+    finally:
+        db.close()
+
+
+def insert_meta(con, key, fail=False):
+    con.execute('INSERT INTO Meta (key, value) VALUES (?, ?)', (key, 'x'))
+    if fail:
+        raise ValueError(key)
+    return key
+
+
+def test_writer_commits_queued_jobs_on_stop(filename):
+    db = DB(filename)
+    try:
+        writer = GroupCommitWriter(db)
+        futures = [writer.submit(insert_meta, 'k{}'.format(i)) for i in range(20)]
+        writer.stop()
+        assert [future.result(0) for future in futures] == ['k{}'.format(i) for i in range(20)]
+        assert db.query('SELECT COUNT(*) FROM Meta') == [(20,)]
+    finally:
+        db.close()
+
+
+def test_failed_job_is_rolled_back_alone(filename):
+    db = DB(filename)
+    try:
+        writer = GroupCommitWriter(db)
+        release = threading.Event()
+        # the writer is busy while the next jobs are queued, so they are committed in one batch
+        busy = writer.submit(lambda con: release.wait(5))
+        futures = [writer.submit(insert_meta, 'a'), writer.submit(insert_meta, 'b', True), writer.submit(insert_meta, 'c')]
+        release.set()
+        writer.stop()
+        assert busy.result(0)
+        assert futures[0].result(0) == 'a'
+        with pytest.raises(ValueError):
+            futures[1].result(0)
+        assert futures[2].result(0) == 'c'
+        assert db.query('SELECT key FROM Meta ORDER BY key') == [('a',), ('c',)]
+    finally:
+        db.close()
@@ -0,0 +1,102 @@
+import pytest
+
+from history import PriceHistory
+
+
+@pytest.fixture
+def history(tmp_path):
+    history = PriceHistory(str(tmp_path / 'history.bin'), capacity=4, columns=8)
+    yield history
+    history.close()
+
+
+def test_last_before_wraparound(history):
+    history.append(100, [('BTC', 1.0), ('ETH', 10.0)])
+    history.append(160, [('BTC', 2.0)])
+    assert history.last('BTC', 5) == [(100, 1.0), (160, 2.0)]
+    # missing quotes are skipped
+    assert history.last('ETH', 5) == [(100, 10.0)]
+    assert history.last('XRP', 5) == []
+
+
+def test_ring_keeps_newest_rows(history):
+    for i in range(10):
+        history.append(100 + i * 60, [('BTC', float(i))])
+    assert history.count == 10
+    assert history.last('BTC', 10) == [(100 + i * 60, float(i)) for i in range(6, 10)]
+    assert history.last('BTC', 2) == [(580, 8.0), (640, 9.0)]
+
+
+def test_overwritten_row_forgets_old_quotes(history):
+    history.append(100, [('BTC', 1.0), ('ETH', 10.0)])
+    for i in range(1, 5):
+        history.append(100 + i * 60, [('BTC', 1.0)])
+    assert history.last('ETH', 5) == []
+
+
+def test_change(history):
+    history.append(0, [('BTC', 100.0)])
+    history.append(60, [('BTC', 110.0)])
+    history.append(120, [('BTC', 150.0)])
+    assert history.change('BTC', 120) == pytest.approx(50)
+    assert history.change('BTC', 60) == pytest.approx(100 * 40 / 110)
+    # snapshot of the window start is at least <window> old
+    assert history.change('BTC', 61) == pytest.approx(50)
+
+
+def test_change_without_old_enough_data(history):
+    assert history.change('BTC', 60) is None
+    history.append(0, [('BTC', 100.0)])
+    history.append(60, [('BTC', 110.0)])
+    assert history.change('BTC', 61) is None
+    assert history.change('ETH', 60) is None
+    history.append(120, [('ETH', 1.0)])
+    # BTC has no price in the newest snapshot
+    assert history.change('BTC', 60) is None
+
+
+def test_change_after_wraparound(history):
+    for i in range(7):
+        history.append(i * 60, [('BTC', 100.0 + i)])
+    # rows of 0-120s are overwritten; the oldest kept one is 180s
+    assert history.change('BTC', 180) == pytest.approx(100 * 3 / 103)
+    assert history.change('BTC', 240) is None
+
+
+def test_reopen(tmp_path):
+    filename = str(tmp_path / 'history.bin')
+    history = PriceHistory(filename, capacity=4, columns=8)
+    for i in range(6):
+        history.append(i * 60, [('BTC', float(i))])
+    history.close()
+    # capacity and columns are read from the file
+    history = PriceHistory(filename)
+    try:
+        assert (history.capacity, history.columns, history.count) == (4, 8, 6)
+        assert history.last('BTC', 10) == [(i * 60, float(i)) for i in range(2, 6)]
+    finally:
+        history.close()
+
+
+def test_column_of_delisted_coin_is_reused(tmp_path):
+    history = PriceHistory(str(tmp_path / 'history.bin'), capacity=4, columns=2)
+    try:
+        history.append(0, [('BTC', 1.0), ('LUNA', 2.0)])
+        history.append(60, [('BTC', 1.0), ('ETH', 3.0)])
+        assert history.symbols == {'BTC': 0, 'ETH': 1}
+        # prices of the old coin aren't inherited
+        assert history.last('ETH', 5) == [(60, 3.0)]
+        assert history.last('LUNA', 5) == []
+        assert history.last('BTC', 5) == [(0, 1.0), (60, 1.0)]
+    finally:
+        history.close()
+
+
+def test_snapshot_wider_than_table(tmp_path):
+    history = PriceHistory(str(tmp_path / 'history.bin'), capacity=4, columns=2)
+    try:
+        history.append(0, [('BTC', 1.0), ('ETH', 3.0), ('XRP', 0.5)])
+        assert history.last('XRP', 5) == []
+        assert history.last('ETH', 5) == [(0, 3.0)]
+    finally:
+        history.close()
@@ -0,0 +1,78 @@
+import pytest
+
+from db_worker import DB, OUTBOX_SENT, OUTBOX_FAILED
+from outbox import prepare_run, deliver_shard
+
+
+class Crash(Exception):
+    pass
+
+
+class Broadcaster():
+    # stand-in for Broadcaster; the process "crashes" before sending message number <crash_at>
+    def __init__(self, crash_at=None):
+        self.crash_at = crash_at
+        self.sent = []
+
+    def send(self, messages, on_result=None, **kwargs):
+        for tg_id, text in messages:
+            if len(self.sent) == self.crash_at:
+                raise Crash()
+            self.sent.append((tg_id, text))
+            on_result(tg_id, True, 1)
+        return {'sent': len(self.sent)}
+
+
+def render(variants):
+    return {(coins_number, currency): 'top {} {}'.format(coins_number, currency) for coins_number, currency in variants}
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = DB(str(tmp_path / 'data.db'))
+    # Users and Settings aren't created by DB
+    db.query('CREATE TABLE Users (id INTEGER PRIMARY KEY AUTOINCREMENT, tg_id INTEGER UNIQUE NOT NULL)')
+    db.query('''CREATE TABLE Settings (user_id INTEGER PRIMARY KEY REFERENCES Users(id), coins_number INTEGER NOT NULL DEFAULT 10,
+                                       schedule_mask INTEGER NOT NULL DEFAULT 16777215, currency TEXT NOT NULL DEFAULT 'USD')''')
+    for tg_id in range(1001, 1008):
+        db.add_user(tg_id)
+    db.save_settings(1007, 'coins_number', 20)
+    yield db
+    db.close()
+
+
+def test_run_sends_every_job_once(db):
+    assert prepare_run(db, 'r1', 8, render) == 7
+    broadcaster = Broadcaster()
+    deliver_shard(db, broadcaster, 'r1', batch=3)
+    assert sorted(broadcaster.sent) == [(tg_id, 'top 10 USD') for tg_id in range(1001, 1007)] + [(1007, 'top 20 USD')]
+    assert db.finish_run('r1') == {OUTBOX_SENT: 7}
+    # finished run isn't enqueued again
+    assert prepare_run(db, 'r1', 8, render) == 0
+    deliver_shard(db, broadcaster, 'r1', batch=3)
+    assert len(broadcaster.sent) == 7
+
+
+def test_resumed_run_has_no_duplicates(db):
+    prepare_run(db, 'r1', 8, render)
+    # first batch is saved; the crash happens inside the second one
+    crashed = Broadcaster(crash_at=4)
+    with pytest.raises(Crash):
+        deliver_shard(db, crashed, 'r1', batch=3)
+    assert prepare_run(db, 'r1', 8, render) == 0
+    resumed = Broadcaster()
+    deliver_shard(db, resumed, 'r1', batch=3)
+    first, second = {tg_id for tg_id, _ in crashed.sent}, {tg_id for tg_id, _ in resumed.sent}
+    assert not first & second
+    # 3 jobs of the crashed batch have unknown result and aren't retried: 1 was sent, 2 are lost
+    assert len(first) == 4 and len(second) == 1
+    assert db.finish_run('r1') == {OUTBOX_SENT: 4, OUTBOX_FAILED: 3}
+
+
+def test_shards_split_recipients(db):
+    prepare_run(db, 'r1', 8, render)
+    shards = [Broadcaster() for _ in range(3)]
+    for shard, broadcaster in enumerate(shards):
+        deliver_shard(db, broadcaster, 'r1', shard, 3, batch=2)
+        assert {tg_id % 3 for tg_id, _ in broadcaster.sent} == {shard}
+    assert sorted(tg_id for broadcaster in shards for tg_id, _ in broadcaster.sent) == list(range(1001, 1008))
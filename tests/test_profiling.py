@@ -0,0 +1,59 @@
+import threading
+from time import sleep
+
+import profiling
+from profiling import Tracer
+
+
+class ExclusiveProfile():
+    # cProfile.Profile of python 3.12+: one profiler may be active at a time
+    active = None
+
+    def enable(self):
+        if ExclusiveProfile.active is not None:
+            raise ValueError('Another profiling tool is already active')
+        ExclusiveProfile.active = self
+
+    def disable(self):
+        ExclusiveProfile.active = None
+
+
+def run_parallel(tracer, n=2):
+    started = threading.Barrier(n)
+    handled = []
+
+    def handler(chat_id):
+        with tracer.trace('/top', chat_id):
+            # both handlers are inside trace at once
+            started.wait(timeout=5)
+            handled.append(chat_id)
+
+    threads = [threading.Thread(target=handler, args=(chat_id,)) for chat_id in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(handled)
+
+
+def test_concurrent_handlers_run_while_cpu_profile_is_taken(monkeypatch):
+    monkeypatch.setattr(profiling.cProfile, 'Profile', ExclusiveProfile)
+    tracer = Tracer()
+    tracer.window = []
+    assert run_parallel(tracer) == [0, 1]
+    # the second handler ran unprofiled
+    assert len(tracer.window) == 1
+    assert tracer.unprofiled == 1
+
+
+def test_cpu_profile_of_parallel_handlers():
+    tracer = Tracer(enabled=True, slow=10)
+    result = []
+    profiler = threading.Thread(target=lambda: result.append(tracer.cpu(0.5)))
+    profiler.start()
+    while tracer.window is None:
+        sleep(0.001)
+    assert run_parallel(tracer) == [0, 1]
+    profiler.join()
+    assert result[0] is not None
+    assert tracer.window is None
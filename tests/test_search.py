@@ -0,0 +1,72 @@
+from search import PrefixIndex
+
+
+def response(*coins):
+    # rows of API response: (coin ID, symbol, name, price, percent change 24h), ordered by rank
+    return {'rows': [(coin_id, symbol, name, 1.0, 0.0) for coin_id, symbol, name in coins]}
+
+
+def symbols(coins):
+    return [coin[1] for coin in coins]
+
+
+def test_search_by_symbol_and_name():
+    index = PrefixIndex()
+    index.update(response((1, 'BTC', 'Bitcoin'), (2, 'ETH', 'Ethereum'), (3, 'BCH', 'Bitcoin Cash')))
+    assert symbols(index.search('bit')) == ['BTC', 'BCH']
+    assert symbols(index.search('  ETH ')) == ['ETH']
+    assert index.search('') == []
+    assert index.search('xyz') == []
+
+
+def test_exact_symbol_goes_first():
+    index = PrefixIndex()
+    index.update(response((1, 'BTC', 'Bitcoin'), (2, 'ETH', 'Ethereum'), (3, 'ET', 'Ethos')))
+    assert symbols(index.search('et')) == ['ET', 'ETH']
+
+
+def test_renamed_coin():
+    index = PrefixIndex()
+    index.update(response((1, 'BTC', 'Bitcoin'), (2, 'MATIC', 'Polygon')))
+    index.update(response((1, 'BTC', 'Bitcoin'), (2, 'POL', 'Polygon Ecosystem Token')))
+    assert index.search('matic') == []
+    assert symbols(index.search('pol')) == ['POL']
+    assert symbols(index.search('polygon eco')) == ['POL']
+    # each coin has one key per symbol and name
+    assert sorted(index.keys) == sorted({('btc', 1), ('bitcoin', 1), ('pol', 2), ('polygon ecosystem token', 2)})
+
+
+def test_removed_coin():
+    index = PrefixIndex()
+    index.update(response((1, 'BTC', 'Bitcoin'), (2, 'LUNA', 'Terra'), (3, 'LTC', 'Litecoin')))
+    index.update(response((1, 'BTC', 'Bitcoin'), (3, 'LTC', 'Litecoin')))
+    assert index.search('luna') == []
+    assert index.search('terra') == []
+    assert symbols(index.search('l')) == ['LTC']
+    assert 2 not in {coin_id for _, coin_id in index.keys}
+
+
+def test_symbol_taken_by_another_coin():
+    index = PrefixIndex()
+    index.update(response((1, 'UNI', 'Uniswap'), (2, 'ABC', 'Old')))
+    # coin 1 renames, coin 2 takes its symbol
+    index.update(response((1, 'UNIV', 'Uniswap'), (2, 'UNI', 'Universe')))
+    assert [(coin[0], coin[1]) for coin in index.search('uni')] == [(2, 'UNI'), (1, 'UNIV')]
+    assert index.search('abc') == []
+
+
+def test_ranks_follow_latest_snapshot():
+    index = PrefixIndex()
+    index.update(response((1, 'AAA', 'A1'), (2, 'AAB', 'A2')))
+    index.update(response((2, 'AAB', 'A2'), (1, 'AAA', 'A1')))
+    assert symbols(index.search('aa')) == ['AAB', 'AAA']
+
+
+def test_broad_prefix_results_are_refreshed_by_update():
+    index = PrefixIndex()
+    index.scan = 0 # every range is searched by rank order and memoised
+    index.update(response((1, 'BTC', 'Bitcoin'), (2, 'BNB', 'BNB')))
+    assert symbols(index.search('b', limit=1)) == ['BTC']
+    index.update(response((2, 'BNB', 'BNB'), (3, 'ETH', 'Ethereum')))
+    assert symbols(index.search('b', limit=1)) == ['BNB']
+    assert symbols(index.search('b')) == ['BNB']
@@ -0,0 +1,65 @@
+import threading
+
+from telebot import TeleBot, types
+
+from webhook import WebhookServer
+
+
+def update(update_id, **kwargs):
+    return types.Update.de_json(dict(update_id=update_id, **kwargs))
+
+
+def message(text, chat_id=-100, user_id=1):
+    entities = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}] if text.startswith('/') else []
+    return {'message_id': 1, 'date': 0, 'chat': {'id': chat_id, 'type': 'group'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'test'}, 'text': text, 'entities': entities}
+
+
+def callback(data, user_id=1):
+    return {'id': '1', 'chat_instance': '1', 'data': data, 'from': {'id': user_id, 'is_bot': False, 'first_name': 'test'}}
+
+
+def server():
+    bot = TeleBot('1:test', threaded=False)
+    handled = []
+    done = threading.Event()
+
+    @bot.message_handler(commands=['top'])
+    def top(message):
+        handled.append(('top', message.from_user.id, threading.current_thread().name))
+
+    @bot.callback_query_handler(lambda call: True)
+    def on_callback(call):
+        handled.append(('callback', call.from_user.id, threading.current_thread().name))
+        done.set()
+
+    return WebhookServer(bot, port=0, workers=4), handled, done
+
+
+def test_only_registered_commands_are_handled():
+    webhook, handled, done = server()
+    try:
+        for update_id, text in enumerate(['/unknown', 'hello', '/ top', '/top 5']):
+            assert webhook.dispatch(update(update_id, message=message(text)))
+        assert webhook.dispatch(update(9, callback_query=callback('settings_coins')))
+        assert done.wait(5)
+        assert [entry[:2] for entry in handled] == [('top', 1), ('callback', 1)]
+    finally:
+        # serve_forever isn't running, so only the pool and the socket are closed
+        webhook.pool.drain(5)
+        webhook.server.server_close()
+
+
+def test_message_and_callback_of_user_share_lane():
+    webhook, handled, done = server()
+    try:
+        # group chat ID and user ID fall into different lanes
+        webhook.dispatch(update(1, message=message('/top', chat_id=-3, user_id=2)))
+        webhook.dispatch(update(2, callback_query=callback('markup_notify', user_id=2)))
+        assert done.wait(5)
+        assert handled[0][:2] == ('top', 2) and handled[1][:2] == ('callback', 2)
+        assert handled[0][2] == handled[1][2]
+    finally:
+        # serve_forever isn't running, so only the pool and the socket are closed
+        webhook.pool.drain(5)
+        webhook.server.server_close()
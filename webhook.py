@@ -0,0 +1,194 @@
+import json
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telebot import types
+
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class WorkerPool():
+
+    def __init__(self, workers=8, queue_size=100):
+        '''
+        Bounded pool of lanes; every lane is one thread with its own queue,
+        so jobs with the same key (chat) run one by one in arrival order
+
+        :param workers - number of lanes
+        :param queue_size - max number of waiting jobs per lane
+        '''
+        self.lanes = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.threads = [threading.Thread(target=self.worker, args=(lane,), daemon=True) for lane in self.lanes]
+        self.closed = False
+        for thread in self.threads:
+            thread.start()
+
+
+    def submit(self, key, func, *args):
+        '''
+        Queues job without blocking
+
+        :param key - ordering key (e.g. chat ID)
+        :param func - function
+        :param args - function arguments
+        :return - True if queued, False if lane is full or pool is closed
+        '''
+        if self.closed:
+            return False
+        try:
+            self.lanes[hash(key) % len(self.lanes)].put_nowait((func, args))
+            return True
+        except queue.Full:
+            return False
+
+
+    def worker(self, lane):
+        '''
+        Runs jobs of the lane until stop sign (None)
+
+        :param lane - queue of jobs
+        :return:
+        '''
+        while True:
+            job = lane.get()
+            if job is None:
+                return
+            func, args = job
+            try:
+                func(*args)
+            except Exception as e:
+                logger.exception(e)
+
+
+    def drain(self, timeout=None):
+        '''
+        Stops taking jobs and waits until queued ones are done
+
+        :param timeout - seconds to wait for every lane
+        :return:
+        '''
+        self.closed = True
+        for lane in self.lanes:
+            lane.put(None)
+        for thread in self.threads:
+            thread.join(timeout)
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        '''
+        Accepts Telegram update and queues it
+
+        :return:
+        '''
+        server = self.server
+        if self.path != server.path:
+            self.send_error(404)
+            return
+        if server.secret and self.headers.get('X-Telegram-Bot-Api-Secret-Token') != server.secret:
+            self.send_error(403)
+            return
+        try:
+            update = types.Update.de_json(json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0))))
+        except Exception:
+            logger.exception('bad update')
+            self.send_error(400)
+            return
+        # non-2xx makes Telegram redeliver the update later
+        self.send_response(200 if server.dispatch(update) else 503)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class WebhookServer():
+
+    def __init__(self, bot, host='127.0.0.1', port=8443, path='/webhook', secret=None, workers=8, queue_size=100):
+        '''
+        HTTP server receiving Telegram updates (https://core.telegram.org/bots/api#setwebhook)
+        and running handlers registered in the bot on WorkerPool
+
+        :param bot - TeleBot whose message, callback query and inline handlers (with their filters) are used
+        :param host - interface to listen on
+        :param port - TCP port
+        :param path - URL path of webhook
+        :param secret - expected X-Telegram-Bot-Api-Secret-Token header
+        :param workers - number of handler threads
+        :param queue_size - max number of waiting updates per thread
+        '''
+        self.bot = bot
+        self.pool = WorkerPool(workers, queue_size)
+        self.server = ThreadingHTTPServer((host, port), WebhookHandler)
+        self.server.daemon_threads = True
+        self.server.path = path
+        self.server.secret = secret
+        self.server.dispatch = self.dispatch
+
+
+    def handler(self, handlers, obj):
+        '''
+        First registered handler whose filters (commands, func, ...) accept the object, as TeleBot does
+
+        :param handlers - list of handler dicts of TeleBot
+        :param obj - message, callback query or inline query
+        :return - handler function or None
+        '''
+        for handler in handlers:
+            if self.bot._test_message_handler(handler, obj):
+                return handler['function']
+        return None
+
+
+    def dispatch(self, update):
+        '''
+        Queues handler of the update; updates of one user are handled in order
+        (replies go to the user, so messages and button taps of a group share a lane)
+
+        :param update - telegram Update
+        :return - False if update must be redelivered later
+        '''
+        if update.message and update.message.from_user:
+            func = self.handler(self.bot.message_handlers, update.message)
+            if func:
+                return self.pool.submit(update.message.from_user.id, func, update.message)
+        elif update.callback_query:
+            func = self.handler(self.bot.callback_query_handlers, update.callback_query)
+            if func:
+                return self.pool.submit(update.callback_query.from_user.id, func, update.callback_query)
+        elif update.inline_query:
+            func = self.handler(self.bot.inline_handlers, update.inline_query)
+            if func:
+                # answers are useless once the user typed further, so a full lane drops them instead of redelivery
+                self.pool.submit(update.inline_query.from_user.id, func, update.inline_query)
+        # nothing to handle
+        return True
+
+
+    def serve_forever(self):
+        '''
+        Handles requests until shutdown()
+
+        :return:
+        '''
+        logger.info('webhook server started on %s:%s', *self.server.server_address[:2])
+        self.server.serve_forever()
+
+
+    def shutdown(self, timeout=30):
+        '''
+        Stops accepting updates and finishes queued ones
+
+        :param timeout - seconds to wait for queued updates
+        :return:
+        '''
+        self.server.shutdown()
+        self.server.server_close()
+        self.pool.drain(timeout)
+        logger.info('webhook server stopped')